@@ -0,0 +1,405 @@
+import asyncio
+import sys
+from threading import Thread
+import time
+from traceback import print_exc
+
+import aiohttp
+from api import models, outbox
+from api.event_broadcaster import ResetThread
+from api.models import constants
+from peewee import chunked, DoesNotExist
+
+
+# The peers (by guid) and files (by full hash) a sync event touches, the things its order matters for
+# Events that touch neither (e.g. new_tracker) are ordered by the ip they came from
+def _ordering_keys(event):
+    data = event["data"]
+    items = data.get("files") or data.get("keep_alives") or [data]
+
+    keys = []
+    for item in items:
+        if "guid" in item:
+            keys.append(("peer", item["guid"]))
+        for field in ("full_hash", "file_hash"):
+            if field in item:
+                keys.append(("file", item[field]))
+
+    return keys or [("ip", event["event_ip"])]
+
+
+# Returns a group number for each of the events, events that share a peer or a file (even through other
+# events, e.g. a second peer registering a file the first one added) are in the same group
+# Groups are numbered in the order they first appear
+def _event_groups(events):
+    parents = {}
+
+    def find(key):
+        while parents.setdefault(key, key) != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    event_keys = [_ordering_keys(event) for event in events]
+    for keys in event_keys:
+        root = find(keys[0])
+        for key in keys[1:]:
+            parents[find(key)] = root
+
+    group_numbers = {}
+    return [group_numbers.setdefault(find(keys[0]), len(group_numbers)) for keys in event_keys]
+
+
+# Class for broadcasting new events to all known trackers from a single asyncio event loop
+# Has the same interface as EventBroadcaster, set broadcast_engine = "asyncio" in the config to use it
+#
+# The loop runs in its own daemon thread, every other method is called from request threads and hands
+# its work over to the loop. Each tracker gets a task that reads its events out of the outbox, spreads
+# them over ASYNC_CONCURRENCY_PER_TRACKER shards and sends the shards at the same time. Events that touch
+# the same peer or file always share a shard (see _event_groups), so they stay in order, while a slow
+# tracker only ever holds up its own task
+class AsyncEventBroadcaster:
+    # Since we need to ensure the database is actually initialized, don't
+    # initialize everything on class construction
+    def __init__(self):
+        self.initialized = False
+
+    # Only to be called after the database and the outbox are initialized
+    # Events in the outbox that a tracker never got are sent again
+    def initialize(self):
+        self.initialized = True
+        self.tracker_list = {}
+
+        try:
+            trackers = models.get_tracker_list()
+        except DoesNotExist:
+            trackers = []
+
+        # Trackers that were removed can't hold up compaction
+        outbox.prune_destinations(tracker["ip"] for tracker in trackers)
+
+        if not trackers:
+            self.initialized = False
+            return
+
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = Thread(target=self.loop.run_forever, name="AsyncEventBroadcaster", daemon=True)
+        self.loop_thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self._open_session(), self.loop).result()
+
+        for tracker in trackers:
+            acked = outbox.add_destination(tracker["ip"])
+            self.loop.call_soon_threadsafe(self._add_tracker, tracker["id"], tracker["ip"], acked)
+
+    # Start sending events to a new tracker
+    # It just got a copy of the database as of version since, so it only needs the events after that
+    # (by default, the events from now on)
+    def new_tracker(self, tracker, since=None):
+        if not self.initialized:
+            self.initialize()
+
+        acked = outbox.reset_destination(tracker.ip, since)
+        self.loop.call_soon_threadsafe(self._add_tracker, tracker.id, tracker.ip, acked)
+
+    # Add a new event to the outbox for all trackers
+    # It is logged even if there are no trackers yet, see outbox.events_since
+    def new_event(self, event_type, event_ip, event_data):
+        if not self.initialized:
+            self.initialize()
+
+        event = {
+            "event": event_type,
+            "event_ip": event_ip,
+            "data": event_data,
+        }
+
+        outbox.append(event)
+        if self.initialized:
+            self.loop.call_soon_threadsafe(self._wake_all)
+
+    # Stop sending events and forget about the trackers, initialize starts everything up again
+    # Must not be called from the event loop itself
+    def stop(self):
+        # Without trackers initialize never started the loop, there is nothing to stop
+        if not self.initialized:
+            return
+
+        print("Cancelling all the sender tasks")
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+
+        print("Sender tasks cancelled, stopping the event loop")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        print("Event loop stopped")
+
+        self.tracker_list = {}
+        self.initialized = False
+
+    # Remove a tracker from the list of trackers
+    def remove_tracker(self, tracker_id):
+        if not self.initialized:
+            self.initialize()
+
+        try:
+            ip = self.tracker_list[tracker_id]["ip"]
+        except KeyError:
+            return  # Ignore KeyError since it's fine if the tracker wasn't in the list
+
+        models.remove_tracker_by_ip(ip)
+        outbox.remove_destination(ip)
+
+        self.loop.call_soon_threadsafe(self._drop_tracker, tracker_id)
+
+    # Returns the state of each tracker's queue, how long its events took to be delivered (in seconds)
+    # and connection reuse for its session
+    def stats(self):
+        if not self.initialized:
+            return {}
+
+        stats = {}
+        for tid, tracker in list(self.tracker_list.items()):
+            stats[tid] = {
+                "ip": tracker["ip"],
+                "queued_events": outbox.pending_count(tracker["acked"]),
+                "failures": tracker["failures"],
+                "events_sent": tracker["events_sent"],
+                "propagation_latency_avg": tracker["latency_total"] / max(tracker["events_sent"], 1),
+                "propagation_latency_max": tracker["latency_max"],
+                "requests": tracker["requests"],
+                "connections_opened": tracker["connections_opened"],
+                "connections_reused": tracker["requests"] - tracker["connections_opened"],
+            }
+
+        return stats
+
+    # The tracker has an inconsistent database, reset it
+    def reset_db(self, tid):
+        ip = self.tracker_list[tid]["ip"]
+        reset_thread = ResetThread(self, ip)
+        reset_thread.start()
+
+    # Everything below runs on the event loop
+
+    # One session (and connection pool) is shared by every tracker
+    # The connector limits keep the number of sends in flight bounded, in total and per tracker
+    async def _open_session(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=constants.ASYNC_MAX_IN_FLIGHT,
+                limit_per_host=constants.ASYNC_CONCURRENCY_PER_TRACKER,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=constants.HTTP_CONNECT_TIMEOUT,
+                sock_read=constants.HTTP_READ_TIMEOUT,
+            ),
+            trace_configs=[trace_config],
+        )
+
+    async def _shutdown(self):
+        tasks = [tracker["task"] for tracker in self.tracker_list.values()]
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.session.close()
+
+    def _add_tracker(self, tid, ip, acked):
+        self._drop_tracker(tid)
+
+        tracker = {
+            "ip": ip,
+            "acked": acked,   # seq of the last event delivered, see outbox
+            "wakeup": asyncio.Event(),
+            "failures": 0,
+            "events_sent": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+            "requests": 0,
+            "connections_opened": 0,
+        }
+        tracker["task"] = self.loop.create_task(self._run_tracker(tid, tracker))
+
+        self.tracker_list[tid] = tracker
+
+    # Forget a tracker and stop its sender task
+    def _drop_tracker(self, tid):
+        tracker = self.tracker_list.pop(tid, None)
+        if tracker is None:
+            return
+
+        tracker["task"].cancel()
+
+    def _wake_all(self):
+        for tracker in self.tracker_list.values():
+            tracker["wakeup"].set()
+
+    # Sender task for one tracker, runs until cancelled
+    async def _run_tracker(self, tid, tracker):
+        while True:
+            # Cleared before reading, so an event appended after the read still wakes the task up
+            tracker["wakeup"].clear()
+            try:
+                events = await self._get_batch(tracker)
+                if not events:
+                    await tracker["wakeup"].wait()
+                    continue
+
+                if await self._send_shards(events, tid, tracker):
+                    await self.loop.run_in_executor(None, outbox.ack, tracker["ip"], events[-1][0])
+                    tracker["acked"] = events[-1][0]
+                    self._record_latency(tracker, [created for (_, created, _) in events])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Most likely the outbox was busy, the events are still there for the next try
+                print(f"Exception while reading the outbox for tracker with id {tid}:", file=sys.stderr)
+                print_exc()
+                await asyncio.sleep(1)
+
+    # Read the next (seq, created, event) tuples for a tracker out of the outbox, enough for a batch per shard
+    # A read that isn't full is done again once the oldest event has waited for the max batch age
+    async def _get_batch(self, tracker):
+        limit = constants.BROADCAST_BATCH_SIZE * constants.ASYNC_CONCURRENCY_PER_TRACKER
+        events = await self.loop.run_in_executor(None, outbox.read_batch, tracker["acked"], limit)
+
+        if events and len(events) < limit:
+            remaining = events[0][1] + constants.BROADCAST_BATCH_MAX_AGE - time.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                events = await self.loop.run_in_executor(None, outbox.read_batch, tracker["acked"], limit)
+
+        return events
+
+    # Spread the events over the shards, keeping each group of events that depend on each other in one shard,
+    # and send the shards concurrently
+    # The receiver records the version sent with an event as the point it has every change up to (see sync),
+    # so an event only carries its own seq when every earlier event of the batch is in its shard and so was
+    # delivered before it; the rest carry the last seq the receiver is known to have
+    # Returns true if every shard was delivered
+    async def _send_shards(self, events, tid, tracker):
+        groups = _event_groups([event for (_, _, event) in events])
+        shards = {}
+        prefix_shard = groups[0] % constants.ASYNC_CONCURRENCY_PER_TRACKER
+        prefix_seq = tracker["acked"]
+        in_prefix = True
+        for ((seq, _, event), group) in zip(events, groups):
+            shard = group % constants.ASYNC_CONCURRENCY_PER_TRACKER
+            if in_prefix and shard == prefix_shard:
+                prefix_seq = seq
+            else:
+                in_prefix = False
+            version = prefix_seq if shard == prefix_shard else tracker["acked"]
+            shards.setdefault(shard, []).append(dict(event, version=version))
+
+        delivered = await asyncio.gather(*(self._send_shard(shard, tid, tracker) for shard in shards.values()))
+        return all(delivered)
+
+    # Sends one shard's events in order, a batch at a time
+    async def _send_shard(self, events, tid, tracker):
+        for batch in chunked(events, constants.BROADCAST_BATCH_SIZE):
+            if not await self._send_events(batch, tid, tracker):
+                return False
+
+        return True
+
+    # Send a batch of events to the given tracker
+    # A single event is sent on its own, anything more is sent as an array
+    # Returns true if the events were delivered
+    async def _send_events(self, events, tid, tracker):
+        delivered = False
+        keep_trying = True
+        while keep_trying and tid in self.tracker_list:
+            try:
+                async with self.session.patch(
+                    f"http://{tracker['ip']}:{constants.DEFAULT_SERVER_PORT}/tracker_sync",
+                    json=events[0] if len(events) == 1 else events,
+                    trace_request_ctx=tracker,
+                ) as response:
+                    delivered = await self._handle_response(response, tid)
+                keep_trying = not delivered
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(f"Exception while broadcasting to tracker with id {tid}:", file=sys.stderr)
+                print_exc()
+                keep_trying = not self._increment_tracker_fails(tid)
+
+        return delivered
+
+    # Handle a response from trying to send a tracker a new update
+    # Returns true upon successfully handling an event, and false upon failure
+    async def _handle_response(self, response, tid):
+        if response.status != 200:
+            print(f"Got not-ok response code: {response.status} from tracker with id {tid}")
+            return self._increment_tracker_fails(tid)
+
+        try:
+            json = await response.json(content_type=None)  # Parse it like requests would, whatever the header says
+
+            if not json["success"] and "dead_tracker" in json and json["dead_tracker"]:
+                print(f"Recieved message from tracker with id {tid} indicating death, resetting DB")
+                self.reset_db(tid)
+                return True  # This technically counts as successfully handling an event
+            if not json["success"]:
+                print(f"Unsuccessful broadcast to tracker with id {tid}")
+                print(f"Recieved error: {json['error']}")
+                return self._increment_tracker_fails(tid)
+
+            # The batch went through, but individual events may have been rejected, retrying won't fix those
+            for result in json.get("results", []):
+                if not result["success"]:
+                    print(f"Tracker with id {tid} rejected a broadcast event: {result['error']}")
+
+            return True
+        except (ValueError, aiohttp.ContentTypeError):
+            print(f"Could not parse response JSON from tracker with id {tid}:", file=sys.stderr)
+            print_exc()
+            return self._increment_tracker_fails(tid)
+
+    # Increment the number of failures for the tracker with given id
+    # Remove the tracker if number of failures is higher than max tracker failures
+    # Returns true if the tracker was above max and has officially failed, ending the attempts to send events
+    # and false otherwise
+    def _increment_tracker_fails(self, tid):
+        tracker = self.tracker_list.get(tid)
+        if tracker is None:
+            return True  # Another shard already gave up on this tracker
+
+        tracker["failures"] += 1
+
+        if tracker["failures"] > constants.MAX_TRACKER_FAILURES:
+            self._drop_tracker(tid)
+            # Don't block the loop on the databases
+            self.loop.run_in_executor(None, self._remove_tracker_from_db, tracker["ip"])
+            return True
+
+        return False
+
+    def _remove_tracker_from_db(self, ip):
+        try:
+            models.remove_tracker_by_ip(ip)
+            outbox.remove_destination(ip)
+        except Exception:
+            print(f"Exception while removing tracker {ip}:", file=sys.stderr)
+            print_exc()
+
+    # Records how long the given events took from new_event to being delivered to a tracker
+    def _record_latency(self, tracker, created_times):
+        delivered_at = time.time()
+        latencies = [delivered_at - created for created in created_times]
+
+        tracker["events_sent"] += len(latencies)
+        tracker["latency_total"] += sum(latencies)
+        tracker["latency_max"] = max(tracker["latency_max"], max(latencies))
+
+    # Connection reuse counters, the tracker entry is passed along as the trace_request_ctx of every send
+    async def _on_request_start(self, session, context, params):
+        context.trace_request_ctx["requests"] += 1
+
+    async def _on_connection_create_end(self, session, context, params):
+        context.trace_request_ctx["connections_opened"] += 1
@@ -0,0 +1,161 @@
+from collections import OrderedDict
+import datetime
+from threading import local, Lock
+
+from api import constants
+
+# In-memory cache of get_file/get_file_by_hash responses, the same popular files are asked for over and over
+# A cached response is kept until one of its peers could time out, or until models invalidates its file
+# (a host was added or removed, a hosting peer came back to life or moved, the file was deleted)
+# Chunk lists never change once a file is added, they are only dropped when the file is deleted
+# Every invalidation bumps the generation, a response read before an invalidation is never cached after it
+
+# ("id", file id) or ("hash", full hash), with "compact" after them for compact chunk lists:
+# {"file_id", "response", "expires"}, least recently used first
+_files = OrderedDict()
+# file id: list of chunk dicts, least recently used first
+_chunks = OrderedDict()
+# file id: the _files keys holding a response for it
+_file_keys = {}
+
+_lock = Lock()
+_generation = 0
+_stats = {
+    "file_hits": 0,
+    "file_misses": 0,
+    "chunk_hits": 0,
+    "chunk_misses": 0,
+}
+
+# Per thread, the file ids invalidated inside a transaction, invalidated again once it commits
+# (see invalidate_deferred), until then other threads can still read and cache the old rows
+_deferred = local()
+
+
+# The generation to pass to put_file/put_chunks, take it before reading the database
+def generation():
+    return _generation
+
+
+# Returns a copy of the cached response for key, or None
+def get_file(key):
+    with _lock:
+        entry = _files.get(key)
+        if(entry is not None and entry["expires"] <= datetime.datetime.now()):
+            _drop_key(key)
+            entry = None
+
+        if(entry is None):
+            _stats["file_misses"] += 1
+            return None
+
+        _files.move_to_end(key)
+        _stats["file_hits"] += 1
+        return dict(entry["response"])
+
+
+# Caches a successful response for file_id under key until expires
+# Does nothing if something was invalidated since generation was taken
+def put_file(key, file_id, response, expires, generation):
+    if(constants.FILE_CACHE_SIZE <= 0):
+        return
+
+    with _lock:
+        if(generation != _generation):
+            return
+
+        _drop_key(key)
+        _files[key] = {
+            "file_id": file_id,
+            "response": response,
+            "expires": expires,
+        }
+        _file_keys.setdefault(file_id, set()).add(key)
+
+        while(len(_files) > constants.FILE_CACHE_SIZE):
+            _drop_key(next(iter(_files)))
+
+
+# Returns the cached chunk list of a file, or None
+def get_chunks(file_id):
+    with _lock:
+        chunks = _chunks.get(file_id)
+        if(chunks is None):
+            _stats["chunk_misses"] += 1
+            return None
+
+        _chunks.move_to_end(file_id)
+        _stats["chunk_hits"] += 1
+        return chunks
+
+
+# Caches the chunk list of a file
+# Does nothing if something was invalidated since generation was taken
+def put_chunks(file_id, chunks, generation):
+    if(constants.CHUNK_CACHE_SIZE <= 0):
+        return
+
+    with _lock:
+        if(generation != _generation):
+            return
+
+        _chunks[file_id] = chunks
+        while(len(_chunks) > constants.CHUNK_CACHE_SIZE):
+            _chunks.popitem(last=False)
+
+
+# Drops the cached responses for the given files, and their chunk lists if they were deleted
+# in_transaction should be true if the change isn't committed yet, see invalidate_deferred
+def invalidate_files(file_ids, deleted=False, in_transaction=False):
+    global _generation
+
+    file_ids = list(file_ids)
+    with _lock:
+        _generation += 1
+        for file_id in file_ids:
+            for key in list(_file_keys.get(file_id, ())):
+                _drop_key(key)
+            if(deleted):
+                _chunks.pop(file_id, None)
+
+    if(in_transaction):
+        deferred = _deferred.__dict__.setdefault("files", {})
+        for file_id in file_ids:
+            deferred[file_id] = deferred.get(file_id, False) or deleted
+
+
+# Invalidates the files this thread invalidated inside its transaction again, call once it has committed
+def invalidate_deferred():
+    deferred = _deferred.__dict__.pop("files", None)
+    if(deferred):
+        for (file_id, deleted) in deferred.items():
+            invalidate_files([file_id], deleted=deleted)
+
+
+# Drops everything, for when the database is replaced
+def clear():
+    global _generation
+
+    with _lock:
+        _generation += 1
+        _files.clear()
+        _chunks.clear()
+        _file_keys.clear()
+
+
+# Returns the hit and miss counters and the number of cached responses and chunk lists
+def stats():
+    with _lock:
+        return dict(_stats, files_cached=len(_files), chunks_cached=len(_chunks))
+
+
+# Must be called while holding the lock
+def _drop_key(key):
+    entry = _files.pop(key, None)
+    if(entry is None):
+        return
+
+    keys = _file_keys.get(entry["file_id"])
+    keys.discard(key)
+    if(not keys):
+        del _file_keys[entry["file_id"]]
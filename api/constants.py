@@ -2,9 +2,52 @@ from datetime import timedelta
 
 KEEP_ALIVE_TIMEOUT = timedelta(minutes=5)   # default timeout is 5 minutes
 BROADCAST_THREAD_COUNT = 4
+BROADCAST_BATCH_SIZE = 100        # max events sent to a tracker in one /tracker_sync request
+BROADCAST_BATCH_MAX_AGE = 0.5     # max seconds to hold an event back while filling a batch
+BROADCAST_ENGINE = "threaded"     # "threaded" or "asyncio"
+ASYNC_CONCURRENCY_PER_TRACKER = 8  # concurrent sends to each tracker with the asyncio engine
+ASYNC_MAX_IN_FLIGHT = 1024        # concurrent sends to all trackers with the asyncio engine
 MAX_TRACKER_FAILURES = 3
 DEFAULT_SERVER_PORT = 42070
+HTTP_POOL_SIZE = 4                # kept alive connections per destination tracker
+HTTP_CONNECT_TIMEOUT = 5          # seconds to wait for a connection to another tracker
+HTTP_READ_TIMEOUT = 30            # seconds to wait for another tracker's response
 DB_PATH = "./tracker.db"
+OUTBOX_PATH = "./outbox.db"         # undelivered broadcast events, kept separate from the tracker database
+OUTBOX_COMPACT_INTERVAL = 60      # seconds between deleting events every tracker has gotten
+OUTBOX_RETENTION = 60 * 60         # seconds events are kept for trackers catching up with /new_tracker
+DELTA_SYNC_MAX_EVENTS = 10000     # trackers further behind than this get a full database dump instead
+SNAPSHOT_CHUNK_SIZE = 64 * 1024   # bytes read at a time when downloading a snapshot from another tracker
+BOOTSTRAP_PARALLELISM = 3         # trackers asked for a copy of their database at once on startup
+BOOTSTRAP_ATTEMPT_TIMEOUT = 10    # seconds to wait for one tracker's database (and snapshot) on startup
+BOOTSTRAP_LATENCY_WEIGHT = 0.5    # weight of the newest /new_tracker round trip in a tracker's latency average
+DB_PRAGMAS = {                    # sqlite pragmas applied to every connection, see [database] in config.toml
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -64000,         # negative values are in KiB, so 64MB
+    "mmap_size": 268435456,       # 256MB
+    "temp_store": "memory",
+    "busy_timeout": 5000,         # milliseconds
+}
+DB_CONNECTION_MODE = "pooled"     # "pooled" or "per_request"
+DB_MAX_CONNECTIONS = 16           # max pooled connections in use at once
+DB_STALE_TIMEOUT = 300            # seconds before a pooled connection is recycled
+DB_POOL_WAIT_TIMEOUT = 10         # seconds to wait for a free pooled connection
+KEEP_ALIVE_BUFFER = False         # buffer keep alives in memory and write them in batches
+KEEP_ALIVE_FLUSH_INTERVAL = 2     # seconds between writes of the keep alive buffer
+KEEP_ALIVE_FLUSH_BATCH_SIZE = 150  # peers per UPDATE when writing the keep alive buffer (5 variables each)
+KEEP_ALIVE_BATCH_MAX_SIZE = 1000  # most keep alives accepted in one /keep_alive_batch request
+KEEP_ALIVE_EVENT_INTERVAL = 0.5   # seconds between adding the keep alives applied here to the outbox
+CHUNK_INSERT_BATCH_SIZE = 100     # rows per INSERT, keeps each statement under sqlite's bound variable limit
+ADD_FILES_MAX_SIZE = 1000         # most files accepted in one /add_files request
+CHUNK_RANGE_MAX_SIZE = 1000       # most chunks returned by one /file/<id>/chunks request
+FILE_LIST_MAX_LIMIT = 1000        # most files in one /file_list page, and the page size if no limit is given
+FILE_CACHE_SIZE = 1024            # get_file/get_file_by_hash responses kept in memory, 0 turns the cache off
+FILE_CACHE_TTL = 60               # max seconds a cached response is kept, it goes sooner if a peer could time out
+CHUNK_CACHE_SIZE = 4096           # chunk lists kept in memory, 0 turns the cache off
+REAPER_INTERVAL = 10 * 60         # seconds between deleting peers that have been offline past the grace period
+REAPER_GRACE_PERIOD = 24 * 60 * 60  # seconds a peer is kept after it times out (or registers and never keeps alive)
+REAPER_BATCH_SIZE = 250           # peers deleted per transaction, keeps queries under sqlite's bound variable limit
 
 
 def set_keepalive_timeout(seconds):
@@ -1,16 +1,19 @@
-from queue import Empty, Queue
+from collections import deque
+from queue import Empty
 import sys
-from threading import Event, Thread
+from threading import Condition, Event, Thread
+import time
 from traceback import print_exc
 
-from api import models
+from api import models, outbox, sessions, sync
 from api.models import constants
 from peewee import DoesNotExist
 import requests
 import tracker_init
 
 
-# Worker thread for taking events off of the event queue and sending them
+# Worker thread for reading events out of the outbox and sending them
+# Workers sleep until a tracker has events waiting, so an idle tracker never holds up a busy one
 # Can be interrupted by using the interrupt function
 class BroadCasterThread(Thread):
     def __init__(self, event_broadcaster):
@@ -19,49 +22,66 @@ class BroadCasterThread(Thread):
         self._interrupted_event = Event()
 
     def run(self):
-        tracker_list = self.event_broadcaster.tracker_list
         while not self._interrupted():
-            # Need to make a copy of the list of keys so we don't get dictionary size changed during
-            # iteration errors
-            for tid in list(tracker_list.keys()):
-                if self._interrupted():
-                    break
-
-                try:
-                    tracker = tracker_list[tid]
-                    event = tracker["queue"].get(timeout=5)
-                    self._send_event(event, tid, tracker)
-                    tracker["queue"].task_done()
-                except Empty:
-                    continue
-                except KeyError:
-                    # Trackers may be removed from the list while we're iterating through our copy of
-                    # the list of tracker ids, this is fine though so just continue
-                    continue
+            # Wake up every so often to check if the thread was interrupted
+            claimed = self.event_broadcaster.claim_ready_tracker(timeout=1)
+            if claimed is None:
+                continue
+
+            (tid, tracker) = claimed
+            try:
+                events = self._get_batch(tracker)
+                if self._send_events([dict(event, version=seq) for (seq, _, event) in events], tid, tracker):
+                    self.event_broadcaster.acknowledge(tracker, events)
+            except Empty:
+                continue
+            finally:
+                self.event_broadcaster.release_tracker(tid, tracker)
 
     def interrupt(self):
         self._interrupted_event.set()
 
     # Returns a boolean for checking if the thread is interrupted or not
     def _interrupted(self):
-        self._interrupted_event.is_set()
-
-    # Send an event to the given tracker
-    def _send_event(self, event, tid, tracker):
+        return self._interrupted_event.is_set()
+
+    # Read the next batch of (seq, created, event) tuples for a tracker out of the outbox
+    # A batch that isn't full is read again once the oldest event has waited for the max batch age
+    # Raises Empty if there was no event to send
+    def _get_batch(self, tracker):
+        events = outbox.read_batch(tracker["acked"], constants.BROADCAST_BATCH_SIZE)
+        if not events:
+            raise Empty
+
+        if len(events) < constants.BROADCAST_BATCH_SIZE:
+            remaining = events[0][1] + constants.BROADCAST_BATCH_MAX_AGE - time.time()
+            if remaining > 0 and not self._interrupted_event.wait(remaining):
+                events = outbox.read_batch(tracker["acked"], constants.BROADCAST_BATCH_SIZE)
+
+        return events
+
+    # Send a batch of events to the given tracker
+    # A single event is sent on its own, anything more is sent as an array
+    # Returns true if the events were delivered
+    def _send_events(self, events, tid, tracker):
+        delivered = False
         keep_trying = True
         while keep_trying and not self._interrupted():
             try:
-                response = requests.patch(
+                response = tracker["session"].patch(
                     f"http://{tracker['ip']}:{constants.DEFAULT_SERVER_PORT}/tracker_sync",
-                    json=event,
-                    timeout=30,
+                    json=events[0] if len(events) == 1 else events,
+                    timeout=sessions.timeout(),
                 )
-                keep_trying = not self._handle_response(response, tid)
+                delivered = self._handle_response(response, tid)
+                keep_trying = not delivered
             except Exception:
                 print(f"Exception in thread {self.name}:", file=sys.stderr)
                 print_exc()
                 keep_trying = not self._increment_tracker_fails(tid)
 
+        return delivered
+
     # Handle a response from trying to send a tracker a new update
     # Returns true upon successfully handling an event, and false upon failure
     def _handle_response(self, response, tid):
@@ -81,6 +101,11 @@ class BroadCasterThread(Thread):
                 print(f"Recieved error: {json['error']}")
                 return self._increment_tracker_fails(tid)
 
+            # The batch went through, but individual events may have been rejected, retrying won't fix those
+            for result in json.get("results", []):
+                if not result["success"]:
+                    print(f"Tracker with id {tid} rejected a broadcast event: {result['error']}")
+
             return True
         except ValueError:
             print(f"Could not parse response JSON in thread {self.name}:", file=sys.stderr)
@@ -91,11 +116,15 @@ class BroadCasterThread(Thread):
     # Remove the tracker from the tracker list if number of failures is higher than max tracker failures
     # Returns true if the tracker was above max and has officially failed, ending the attempts to send events
     # and false otherwise
+    # (a tracker that failed is not counted as delivered, see _send_events)
     def _increment_tracker_fails(self, tid):
-        tracker_list = self.event_broadcaster.tracker_list
-        tracker_list[tid]["failures"] += 1
+        tracker = self.event_broadcaster.tracker_list.get(tid)
+        if tracker is None:
+            return True  # The tracker was removed (or the broadcaster stopped) while sending to it
+
+        tracker["failures"] += 1
 
-        if tracker_list[tid]["failures"] > constants.MAX_TRACKER_FAILURES:
+        if tracker["failures"] > constants.MAX_TRACKER_FAILURES:
             self.event_broadcaster.remove_tracker(tid)
             return True
 
@@ -112,21 +141,12 @@ class ResetThread(Thread):
     # Private function for doing the DB reset
     def run(self):
         print("Running database reset")
-        print("Interrupting all the threads")
-        map(lambda thread: thread.interrupt(), self.broadcaster.threads)
-
-        print("Threads interrupted, joining")
-        map(lambda thread: thread.join(), self.broadcaster.threads)
-        print("All threads are dead, resetting the database")
-
-        # Resetting broadcaster
-        self.broadcaster.threads = []
-        self.broadcaster.tracker_list = {}
-        self.broadcaster.initialized = False
+        self.broadcaster.stop()
+        print("Broadcaster stopped, resetting the database")
 
         # Set up the tracker list
         try:
-            tracker_list = models.get_tracker_list()
+            tracker_list = [tracker["ip"] for tracker in models.get_tracker_list()]
         except DoesNotExist:
             tracker_list = []
 
@@ -139,9 +159,8 @@ class ResetThread(Thread):
             print("Could not get database for reset, aborting DB reset")
             return
 
-        # Replace the database and add the tracker
-        models.replace_database(new_db)
-        models.add_tracker(ip)
+        # Replace the database (or catch up with the changes) and add the tracker
+        sync.catch_up(new_db, ip)
 
         # Re-initialize the broadcaster
         self.broadcaster.initialize()
@@ -151,26 +170,44 @@ class ResetThread(Thread):
 class EventBroadcaster:
     # Since we need to ensure the database is actually initialized, don't
     # initialize everything on class construction
+    # The ready condition lives as long as the broadcaster, so a thread never waits on one that was replaced
     def __init__(self):
         self.initialized = False
-
-    # Only to be called after the database is initialized
-    def initialize(self):
-        self.initialized = True
         self.tracker_list = {}
         self.threads = []
-        try:
-            trackers = models.get_tracker_list()
-        except DoesNotExist:
-            self.initialized = False
-            return
+        self.last_seq = 0
 
-        for tracker in trackers:
-            self.tracker_list[tracker["id"]] = {
-                "ip": tracker["ip"],
-                "queue": Queue(),
-                "failures": 0,
-            }
+        # Ids of trackers with events waiting that no thread is sending to yet, in the order they became ready
+        self.ready = deque()
+        self.ready_condition = Condition()
+
+    # Only to be called after the database and the outbox are initialized, once at startup and again after stop
+    # Events in the outbox that a tracker never got are sent again
+    # The threads are started even without any trackers, new_tracker hands them the ones that join later
+    def initialize(self):
+        with self.ready_condition:
+            try:
+                trackers = models.get_tracker_list()
+            except DoesNotExist:
+                trackers = []
+
+            # Trackers that were removed can't hold up compaction
+            outbox.prune_destinations(tracker["ip"] for tracker in trackers)
+            self.last_seq = outbox.last_seq()
+
+            self.tracker_list = {}
+            self.ready.clear()
+            for tracker in trackers:
+                self.tracker_list[tracker["id"]] = self._new_tracker_entry(
+                    tracker["ip"],
+                    outbox.add_destination(tracker["ip"]),
+                )
+
+            for tid, tracker in self.tracker_list.items():
+                if tracker["acked"] < self.last_seq:
+                    self._mark_ready(tid, tracker)
+
+            self.initialized = True
 
         for _ in range(0, constants.BROADCAST_THREAD_COUNT):
             thread = BroadCasterThread(self)
@@ -178,40 +215,152 @@ class EventBroadcaster:
             thread.start()
             self.threads.append(thread)
 
-    # Add a new tracker event queue
-    def new_tracker(self, tracker):
-        if not self.initialized:
-            self.initialize()
+    # Start sending events to a new tracker
+    # It just got a copy of the database as of version since, so it only needs the events after that
+    # (by default, the events from now on)
+    # Before initialize (or while stopped) only its outbox cursor is set, initialize picks it up from there
+    def new_tracker(self, tracker, since=None):
+        acked = outbox.reset_destination(tracker.ip, since)
+
+        with self.ready_condition:
+            if not self.initialized:
+                return
+
+            entry = self._new_tracker_entry(tracker.ip, acked)
+            if tracker.id in self.tracker_list:
+                # A tracker that re-registered may still be queued up, it mustn't be queued twice
+                entry["ready"] = self.tracker_list[tracker.id]["ready"]
+
+            self.tracker_list[tracker.id] = entry
+            if acked < self.last_seq:
+                self._mark_ready(tracker.id, entry)
 
-        self.tracker_list[tracker.id] = {
-            "ip": tracker.ip,
-            "queue": Queue(),
+    # Add a new event to the outbox for all trackers
+    # It is logged even if there are no trackers yet, see outbox.events_since
+    def new_event(self, event_type, event_ip, event_data):
+        event = {
+            "event": event_type,
+            "event_ip": event_ip,
+            "data": event_data,
+        }
+
+        with self.ready_condition:
+            self.last_seq = outbox.append(event)
+            for tid, tracker in self.tracker_list.items():
+                self._mark_ready(tid, tracker)
+
+    # Waits up to timeout seconds for a tracker with waiting events and claims it for the calling thread
+    # Returns a tuple of (tracker id, tracker), or None if no tracker became ready
+    # The tracker must be handed back with release_tracker once its events are sent
+    def claim_ready_tracker(self, timeout):
+        with self.ready_condition:
+            if not self.ready_condition.wait_for(lambda: self.ready, timeout):
+                return None
+
+            while self.ready:
+                tid = self.ready.popleft()
+                tracker = self.tracker_list.get(tid)
+                if tracker is None:
+                    continue  # The tracker was removed while it was waiting
+
+                tracker["ready"] = False
+                tracker["busy"] = True
+                return (tid, tracker)
+
+            return None
+
+    # Hands a claimed tracker back, queueing it up again if more events arrived in the meantime
+    def release_tracker(self, tid, tracker):
+        with self.ready_condition:
+            tracker["busy"] = False
+            if tracker["acked"] < self.last_seq and tid in self.tracker_list:
+                self._mark_ready(tid, tracker)
+
+    # Moves the tracker's outbox cursor past the given (seq, created, event) tuples once they are delivered
+    # and records how long they took from new_event to being delivered
+    # Only called by the thread that has the tracker claimed
+    def acknowledge(self, tracker, events):
+        outbox.ack(tracker["ip"], events[-1][0])
+        tracker["acked"] = events[-1][0]
+
+        delivered_at = time.time()
+        latencies = [delivered_at - created for (_, created, _) in events]
+
+        tracker["events_sent"] += len(latencies)
+        tracker["latency_total"] += sum(latencies)
+        tracker["latency_max"] = max(tracker["latency_max"], max(latencies))
+
+    # Queue the tracker up for a thread to send its events, unless it is queued or being sent to already
+    # Only one thread sends to a tracker at a time, so its events arrive in order
+    # Must be called while holding the ready condition
+    def _mark_ready(self, tid, tracker):
+        if not tracker["busy"] and not tracker["ready"]:
+            tracker["ready"] = True
+            self.ready.append(tid)
+            self.ready_condition.notify()
+
+    def _new_tracker_entry(self, ip, acked):
+        return {
+            "ip": ip,
+            "acked": acked,   # seq of the last event delivered, see outbox
+            "ready": False,
+            "busy": False,
+            "session": sessions.new_session(),
             "failures": 0,
+            "events_sent": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
         }
 
-    # Add a new event to all tracker queues
-    def new_event(self, event_type, event_ip, event_data):
-        if not self.initialized:
-            self.initialize()
+    # Stop sending events and forget about the trackers, initialize starts everything up again
+    def stop(self):
+        print("Interrupting all the threads")
+        for thread in self.threads:
+            thread.interrupt()
+
+        print("Threads interrupted, joining")
+        for thread in self.threads:
+            thread.join()
+        print("All threads are dead")
 
-        for tracker in self.tracker_list.values():
-            tracker["queue"].put({
-                "event": event_type,
-                "event_ip": event_ip,
-                "data": event_data,
-            })
+        with self.ready_condition:
+            for tracker in self.tracker_list.values():
+                tracker["session"].close()
+
+            self.threads = []
+            self.tracker_list = {}
+            self.ready.clear()
+            self.initialized = False
 
     # Remove a tracker from the list of trackers
     def remove_tracker(self, tracker_id):
+        tracker = self.tracker_list.pop(tracker_id, None)
+        if tracker is None:
+            return  # It's fine if the tracker wasn't in the list, another thread may have removed it
+
+        models.remove_tracker_by_ip(tracker["ip"])
+        outbox.remove_destination(tracker["ip"])
+        tracker["session"].close()
+
+    # Returns the state of each tracker's queue, how long its events took to be delivered (in seconds)
+    # and connection reuse for its session
+    def stats(self):
         if not self.initialized:
-            self.initialize()
+            return {}
 
-        models.remove_tracker_by_ip(self.tracker_list[tracker_id]["ip"])
+        stats = {}
+        for tid, tracker in list(self.tracker_list.items()):
+            stats[tid] = {
+                "ip": tracker["ip"],
+                "queued_events": outbox.pending_count(tracker["acked"]),
+                "failures": tracker["failures"],
+                "events_sent": tracker["events_sent"],
+                "propagation_latency_avg": tracker["latency_total"] / max(tracker["events_sent"], 1),
+                "propagation_latency_max": tracker["latency_max"],
+                **sessions.session_stats(tracker["session"]),
+            }
 
-        try:
-            del self.tracker_list[tracker_id]
-        except KeyError:
-            pass  # Ignore KeyError since it's fine if the tracker wasn't in the list
+        return stats
 
     # The tracker has an inconsistent database, reset it
     def reset_db(self, tid):
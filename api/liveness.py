@@ -0,0 +1,73 @@
+import datetime
+import heapq
+from threading import Condition
+
+from api import constants
+
+# When each recently keepalived peer times out, in a heap ordered by that time
+# models keeps every file's active_peers count up to date as peers come online and as hosts are added
+# and removed, this is what tells it (through maintenance.ActivePeerExpiryThread) when a peer went offline
+# The heap can hold old entries for a peer that kept alive since, they are skipped when they come up
+
+# (time the peer times out, peer id)
+_heap = []
+# peer id: the latest time it times out
+_expires = {}
+_condition = Condition()
+
+
+# Notes a peer's keep alive timestamp, after it is written to the database
+def watch(peer_id, keep_alive_timestamp):
+    expires = keep_alive_timestamp + constants.KEEP_ALIVE_TIMEOUT
+
+    with _condition:
+        if(expires <= _expires.get(peer_id, datetime.datetime.min)):
+            return
+
+        _expires[peer_id] = expires
+        heapq.heappush(_heap, (expires, peer_id))
+
+        # the expiry thread may be sleeping until a later time
+        if(_heap[0][1] == peer_id):
+            _condition.notify()
+
+
+# Stops watching a peer, for when it is deleted
+def forget(peer_id):
+    with _condition:
+        _expires.pop(peer_id, None)
+
+
+# Forgets every peer, for when the database is replaced
+def reset():
+    with _condition:
+        _heap.clear()
+        _expires.clear()
+        _condition.notify()
+
+
+# Waits up to timeout seconds for peers to time out
+# Returns the ids of the peers that timed out, possibly none
+def wait_for_expired(timeout):
+    with _condition:
+        now = datetime.datetime.now()
+        # a peer is still online at the exact time it times out (see models.peer_timed_out)
+        if(not _heap or _heap[0][0] >= now):
+            wait = timeout if not _heap else min(timeout, (_heap[0][0] - now).total_seconds())
+            _condition.wait(wait)
+            now = datetime.datetime.now()
+
+        expired = []
+        while(_heap and _heap[0][0] < now):
+            (expires, peer_id) = heapq.heappop(_heap)
+            if(_expires.get(peer_id) == expires):
+                del _expires[peer_id]
+                expired.append(peer_id)
+
+        return expired
+
+
+# The number of peers that haven't timed out yet
+def live_count():
+    with _condition:
+        return len(_expires)
@@ -0,0 +1,180 @@
+import datetime
+import sys
+from threading import Event, Thread
+from traceback import print_exc
+
+from api import cache, constants, liveness, models, outbox
+from peewee import chunked
+
+
+# Thread for periodically writing the keep alive buffer to the database
+# Can be interrupted by using the interrupt function
+class KeepAliveFlushThread(Thread):
+    def __init__(self):
+        super().__init__()
+        self.daemon = True
+        self._interrupted_event = Event()
+
+    def run(self):
+        while not self._interrupted_event.wait(constants.KEEP_ALIVE_FLUSH_INTERVAL):
+            try:
+                with models.database_in_use():
+                    models.flush_keep_alive_buffer()
+            except Exception:
+                print(f"Exception in thread {self.name} while flushing keep alives:", file=sys.stderr)
+                print_exc()
+
+        # Write whatever is left before stopping
+        with models.database_in_use():
+            models.flush_keep_alive_buffer()
+
+    def interrupt(self):
+        self._interrupted_event.set()
+
+
+# Thread for periodically adding the keep alives queued by /keep_alive and /keep_alive_batch to the outbox
+# Each ip's keep alives go in as keep_alive_batch events through broadcaster, so a busy tracker adds a few
+# events every interval instead of one per keep alive
+# Can be interrupted by using the interrupt function
+class KeepAliveEventFlushThread(Thread):
+    def __init__(self, broadcaster):
+        super().__init__()
+        self.daemon = True
+        self.broadcaster = broadcaster
+        self._interrupted_event = Event()
+
+    def run(self):
+        while not self._interrupted_event.wait(constants.KEEP_ALIVE_EVENT_INTERVAL):
+            try:
+                self.flush()
+            except Exception:
+                print(f"Exception in thread {self.name} while queueing keep alive events:", file=sys.stderr)
+                print_exc()
+
+        # Add whatever is left before stopping
+        self.flush()
+
+    # Every keep alive is kept, in order, the other trackers check each peer's sequence numbers one by one
+    def flush(self):
+        for (event_ip, keep_alives) in outbox.take_queued_keep_alives().items():
+            for batch in chunked(keep_alives, constants.KEEP_ALIVE_BATCH_MAX_SIZE):
+                self.broadcaster.new_event("keep_alive_batch", event_ip, {"keep_alives": batch})
+
+    def interrupt(self):
+        self._interrupted_event.set()
+
+
+# Thread for periodically deleting the outbox events every tracker has gotten
+# Can be interrupted by using the interrupt function
+class OutboxCompactThread(Thread):
+    def __init__(self):
+        super().__init__()
+        self.daemon = True
+        self._interrupted_event = Event()
+
+    def run(self):
+        while not self._interrupted_event.wait(constants.OUTBOX_COMPACT_INTERVAL):
+            try:
+                compacted = outbox.compact()
+                if compacted:
+                    print(f"Compacted {compacted} delivered events out of the outbox")
+            except Exception:
+                print(f"Exception in thread {self.name} while compacting the outbox:", file=sys.stderr)
+                print_exc()
+
+    def interrupt(self):
+        self._interrupted_event.set()
+
+
+# Thread for recounting the active peers of each file a peer hosts once the peer times out
+# Sleeps until the next peer times out (see liveness)
+# Can be interrupted by using the interrupt function
+class ActivePeerExpiryThread(Thread):
+    def __init__(self):
+        super().__init__()
+        self.daemon = True
+        self._interrupted_event = Event()
+
+    def run(self):
+        while not self._interrupted_event.is_set():
+            # Wake up every so often to check if the thread was interrupted
+            expired = liveness.wait_for_expired(timeout=1)
+            if not expired:
+                continue
+
+            try:
+                with models.database_in_use(), models.db:
+                    for peer_id in expired:
+                        models.recount_peer_files(peer_id)
+            except Exception:
+                print(f"Exception in thread {self.name} while recounting active peers:", file=sys.stderr)
+                print_exc()
+
+                # Watch the peers again so they expire again in a second and get another try
+                # (recounting a file twice is harmless), a peer that kept alive since is already watched
+                retry_at = datetime.datetime.now() + datetime.timedelta(seconds=1)
+                for peer_id in expired:
+                    liveness.watch(peer_id, retry_at - constants.KEEP_ALIVE_TIMEOUT)
+
+    def interrupt(self):
+        self._interrupted_event.set()
+
+
+# Thread for periodically deleting peers that have been offline for longer than the grace period, along with
+# the files no one else hosts, and telling the other trackers about each deleted peer through broadcaster
+# Can be interrupted by using the interrupt function
+class PeerReaperThread(Thread):
+    def __init__(self, broadcaster):
+        super().__init__()
+        self.daemon = True
+        self.broadcaster = broadcaster
+        self._interrupted_event = Event()
+
+    def run(self):
+        try:
+            self.reap_orphans()
+        except Exception:
+            print(f"Exception in thread {self.name} while deleting orphaned rows:", file=sys.stderr)
+            print_exc()
+
+        while not self._interrupted_event.wait(constants.REAPER_INTERVAL):
+            try:
+                self.reap_expired_peers()
+            except Exception:
+                print(f"Exception in thread {self.name} while deleting expired peers:", file=sys.stderr)
+                print_exc()
+
+    # Deletes the expired peers a batch at a time, so requests get the database in between
+    # The database (and a connection) is only held for each batch, so replacing the database doesn't have to
+    # wait for the whole run, and the other trackers are told about a batch once it has been let go of
+    def reap_expired_peers(self):
+        grace = datetime.timedelta(seconds=constants.REAPER_GRACE_PERIOD)
+        reclaimed = {"peers": 0, "hosts": 0, "files": 0, "chunks": 0}
+
+        while not self._interrupted_event.is_set():
+            with models.database_in_use(), models.db.connection_context():
+                (peers, batch_reclaimed) = models.reap_expired_peers(grace, constants.REAPER_BATCH_SIZE)
+                cache.invalidate_deferred()
+
+            if not peers:
+                break
+
+            for peer in peers:
+                self.broadcaster.new_event("reap_peer", peer.ip, {"guid": str(peer.uuid)})
+            for table, rows in batch_reclaimed.items():
+                reclaimed[table] += rows
+
+        if reclaimed["peers"]:
+            print("Reaped {peers} expired peers, {hosts} hosts, {files} files and {chunks} chunks".format(**reclaimed))
+
+    # Deletes the rows older versions of the tracker left without a peer or file
+    def reap_orphans(self):
+        with models.database_in_use(), models.db.connection_context():
+            reclaimed = models.reap_orphans(constants.REAPER_BATCH_SIZE)
+            cache.invalidate_deferred()
+
+        if any(reclaimed.values()):
+            print("Reaped {hosts} orphaned hosts, {files} files and {chunks} chunks".format(**reclaimed))
+
+    def interrupt(self):
+        self._interrupted_event.set()
@@ -1,19 +1,46 @@
+from contextlib import contextmanager
 import datetime
+import hashlib
 from io import StringIO
+from itertools import groupby
+import json
 from operator import itemgetter
+import os
+from pathlib import Path
+import sqlite3
+import tempfile
+from threading import Condition, Lock
 import uuid
+import zlib
 
-from api import app, constants
+from api import app, cache, constants, liveness
 import peewee
-from peewee import DoesNotExist, fn, SqliteDatabase
+from peewee import Case, chunked, DatabaseProxy, DoesNotExist, fn, SqliteDatabase, Tuple
+from playhouse.migrate import migrate, SqliteMigrator
+from playhouse.pool import PooledSqliteDatabase
 
-db = SqliteDatabase(None)
+# The actual database is chosen by load_database, based on constants.DB_CONNECTION_MODE
+db = DatabaseProxy()
+
+
+# Write-behind buffer for keep alives, only used when constants.KEEP_ALIVE_BUFFER is set
+# Maps a peer's uuid (as a string) to its latest keep alive state, see buffered_keep_alive
+keep_alive_buffer = {}
+keep_alive_buffer_lock = Lock()
+
+# The number of requests and threads using the database (see acquire_database), and whether it is being replaced
+# (see database_replacement), both guarded by database_condition
+database_users = 0
+database_replacing = False
+database_condition = Condition()
 
 
 # The base model the other models extend, used to force all other models to use the same database
+# Saves only write the fields that were changed, so they can't overwrite buffered keep alive columns
 class BaseModel(peewee.Model):
     class Meta:
         database = db
+        only_save_dirty = True
 
 
 class Tracker(BaseModel):
@@ -22,10 +49,12 @@ class Tracker(BaseModel):
 
 class Peer(BaseModel):
     ip = peewee.CharField()
-    uuid = peewee.UUIDField()
-    keep_alive_timestamp = peewee.DateTimeField(default=datetime.datetime.min)
+    uuid = peewee.UUIDField(index=True)
+    keep_alive_timestamp = peewee.DateTimeField(default=datetime.datetime.min, index=True)
     expected_seq_number = peewee.IntegerField(default=0)
     ka_expected_seq_number = peewee.IntegerField(default=0)
+    # when the tracker first heard of the peer, so a peer that hasn't kept alive yet isn't reaped right away
+    registered_timestamp = peewee.DateTimeField(default=datetime.datetime.now)
 
     def to_dict_simple(self):
         output_dict = {
@@ -36,8 +65,14 @@ class Peer(BaseModel):
 
 
 class File(BaseModel):
-    name = peewee.CharField()
-    full_hash = peewee.CharField()
+    name = peewee.CharField(index=True)
+    full_hash = peewee.CharField(unique=True)
+    # number of recently keepalived peers hosting the file, kept up to date by recount_active_peers
+    active_peers = peewee.IntegerField(default=0)
+    # digest of the file's chunk list (see manifest_digest), for checking the chunks of another peer's copy
+    manifest_digest = peewee.CharField(null=True)
+    # the file's chunk list in the compact format (see encode_chunk_manifest), served as is by get_file
+    chunk_manifest = peewee.BlobField(null=True)
 
     def to_dict_simple(self):
         output_dict = {
@@ -59,16 +94,41 @@ class File(BaseModel):
         return output_dict
 
 
+# Lists files in the order of ?sort=active_peers (most active first, then by id) without sorting them
+FILE_ACTIVE_PEERS_INDEX = File.index(File.active_peers.desc(), File.id)
+File.add_index(FILE_ACTIVE_PEERS_INDEX)
+
+
+# A chunk hash, stored once however many files have a chunk with it (re-encodes, bundles, duplicate releases)
+class ChunkContent(BaseModel):
+    chunk_hash = peewee.CharField(unique=True)
+
+
+# A file's chunk list is its Chunk rows in chunk_id order, each referring to the hash of its contents
 class Chunk(BaseModel):
     chunk_id = peewee.IntegerField()
-    chunk_hash = peewee.CharField()
     name = peewee.CharField()
-    parent_file = peewee.ForeignKeyField(File, backref="chunks", on_delete='cascade', on_update='cascade')
+    content = peewee.ForeignKeyField(ChunkContent, backref="chunks")
+    # not indexed on its own, the parent_file/chunk_id index below covers looking up a file's chunks
+    parent_file = peewee.ForeignKeyField(
+        File,
+        backref="chunks",
+        on_delete='cascade',
+        on_update='cascade',
+        index=False,
+    )
 
+    class Meta:
+        indexes = (
+            # Specify a multi-column index on parent_file/chunk_id for looking up a file's chunks in order
+            (('parent_file', 'chunk_id'), False),
+        )
+
+    # select the chunk's ChunkContent along with it, or this will look it up
     def to_dict(self):
         output_dict = {
             "id": self.chunk_id,
-            "chunk_hash": self.chunk_hash,
+            "chunk_hash": self.content.chunk_hash,
             "name": self.name,
         }
 
@@ -86,16 +146,187 @@ class Hosts(BaseModel):
         )
 
 
+MODELS = [Tracker, Peer, File, ChunkContent, Chunk, Hosts]
+
+# The version of the schema declared above, stored in the database's user_version pragma
+# Bump this and append a migration to MIGRATIONS whenever the schema changes
+SCHEMA_VERSION = 6
+
+
+# Upgrades a version 0 database (no secondary indexes) to version 1
+def migrate_v1():
+    # full_hash becomes unique, so merge any files that were added twice into the oldest copy
+    duplicates = File.select(File.full_hash, fn.MIN(File.id).alias("keep_id"))\
+        .group_by(File.full_hash)\
+        .having(fn.COUNT(File.id) > 1)
+
+    for duplicate in duplicates:
+        duplicate_files = File.select(File.id)\
+            .where((File.full_hash == duplicate.full_hash) & (File.id != duplicate.keep_id))
+
+        for duplicate_file in duplicate_files:
+            kept_hosts = Hosts.select(Hosts.hosting_peer).where(Hosts.hosted_file == duplicate.keep_id)
+            Hosts.update(hosted_file=duplicate.keep_id)\
+                .where((Hosts.hosted_file == duplicate_file.id) & (Hosts.hosting_peer.not_in(kept_hosts)))\
+                .execute()
+            Hosts.delete().where(Hosts.hosted_file == duplicate_file.id).execute()
+            Chunk.delete().where(Chunk.parent_file == duplicate_file.id).execute()
+            File.delete().where(File.id == duplicate_file.id).execute()
+
+    # columns (and tables) added by later versions are indexed by their migrations
+    for model in MODELS:
+        columns = [column.name for column in db.get_columns(model._meta.table_name)]
+        for index in model._meta.fields_to_index():
+            # descending columns are wrapped in an Ordering, the field is its node
+            index_fields = [getattr(expression, "node", expression) for expression in index._expressions]
+            if(all(field.column_name in columns for field in index_fields)):
+                db.execute(model._schema._create_index(index, safe=True))
+
+
+# Upgrades a version 1 database to version 2, which stores each file's active peer count
+def migrate_v2():
+    columns = [column.name for column in db.get_columns(File._meta.table_name)]
+    if("active_peers" not in columns):
+        migrate(SqliteMigrator(db).add_column(File._meta.table_name, "active_peers", File.active_peers))
+
+    File._schema.create_indexes(safe=True)
+    recount_active_peers()
+
+
+# Upgrades a version 2 database to version 3, which stores when each peer was registered
+# existing peers count as registered during the migration, so none of them are reaped before the grace period
+def migrate_v3():
+    columns = [column.name for column in db.get_columns(Peer._meta.table_name)]
+    if("registered_timestamp" not in columns):
+        migrate(SqliteMigrator(db).add_column(
+            Peer._meta.table_name,
+            "registered_timestamp",
+            Peer.registered_timestamp,
+        ))
+
+
+# Upgrades a version 3 database to version 4, which stores each chunk hash once in ChunkContent
+# and each file's manifest digest
+def migrate_v4():
+    db.create_tables([ChunkContent])
+
+    # chunks keep their ids, the table is rebuilt with a reference to their hash instead of the hash
+    columns = [column.name for column in db.get_columns(Chunk._meta.table_name)]
+    if("chunk_hash" in columns):
+        db.execute_sql("INSERT OR IGNORE INTO chunkcontent (chunk_hash) SELECT DISTINCT chunk_hash FROM chunk")
+        db.execute_sql("ALTER TABLE chunk RENAME TO chunk_v3")
+        Chunk._schema.create_table()
+        db.execute_sql(
+            "INSERT INTO chunk (id, chunk_id, name, content_id, parent_file_id) "
+            "SELECT chunk_v3.id, chunk_v3.chunk_id, chunk_v3.name, chunkcontent.id, chunk_v3.parent_file_id "
+            "FROM chunk_v3 JOIN chunkcontent ON chunkcontent.chunk_hash = chunk_v3.chunk_hash"
+        )
+        db.execute_sql("DROP TABLE chunk_v3")
+    Chunk._schema.create_indexes(safe=True)
+
+    columns = [column.name for column in db.get_columns(File._meta.table_name)]
+    if("manifest_digest" not in columns):
+        migrate(SqliteMigrator(db).add_column(File._meta.table_name, "manifest_digest", File.manifest_digest))
+
+    chunk_query = Chunk.select(Chunk.parent_file, Chunk.chunk_id, Chunk.name, ChunkContent.chunk_hash)\
+        .join(ChunkContent, on=(ChunkContent.id == Chunk.content))\
+        .join(File, on=(File.id == Chunk.parent_file))\
+        .where(File.manifest_digest.is_null())\
+        .order_by(Chunk.parent_file, Chunk.chunk_id)\
+        .tuples()
+
+    for (file_id, chunks) in groupby(chunk_query, key=itemgetter(0)):
+        digest = manifest_digest(chunk[1:] for chunk in chunks)
+        File.update(manifest_digest=digest).where(File.id == file_id).execute()
+
+
+# Upgrades a version 4 database to version 5, which stores each file's encoded compact chunk list
+def migrate_v5():
+    columns = [column.name for column in db.get_columns(File._meta.table_name)]
+    if("chunk_manifest" not in columns):
+        migrate(SqliteMigrator(db).add_column(File._meta.table_name, "chunk_manifest", File.chunk_manifest))
+
+    chunk_query = Chunk.select(Chunk.parent_file, Chunk.chunk_id, Chunk.name, ChunkContent.chunk_hash)\
+        .join(ChunkContent, on=(ChunkContent.id == Chunk.content))\
+        .join(File, on=(File.id == Chunk.parent_file))\
+        .where(File.chunk_manifest.is_null())\
+        .order_by(Chunk.parent_file, Chunk.chunk_id)\
+        .tuples()
+
+    for (file_id, chunks) in groupby(chunk_query, key=itemgetter(0)):
+        chunk_manifest = encode_chunk_manifest(chunk[1:] for chunk in chunks)
+        File.update(chunk_manifest=chunk_manifest).where(File.id == file_id).execute()
+
+
+# Upgrades a version 5 database to version 6, which changes how the manifest digest encodes the chunk list
+# Every digest is recomputed, a database received from another tracker may come from one still on version 5
+def migrate_v6():
+    chunk_query = Chunk.select(Chunk.parent_file, Chunk.chunk_id, Chunk.name, ChunkContent.chunk_hash)\
+        .join(ChunkContent, on=(ChunkContent.id == Chunk.content))\
+        .order_by(Chunk.parent_file, Chunk.chunk_id)\
+        .tuples()
+
+    for (file_id, chunks) in groupby(chunk_query, key=itemgetter(0)):
+        digest = manifest_digest(chunk[1:] for chunk in chunks)
+        File.update(manifest_digest=digest).where(File.id == file_id).execute()
+
+
+# Migrations in order, MIGRATIONS[n] upgrades a database from schema version n to n + 1
+# Migrations must be safe to re-run, since databases received from other trackers report version 0
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6]
+
+
 def load_database(db_path):
-    db.init(str(db_path))
+    if(constants.DB_CONNECTION_MODE == "pooled"):
+        # pooled connections are handed between request threads, so sqlite's same thread check has to go
+        database = PooledSqliteDatabase(
+            str(db_path),
+            pragmas=constants.DB_PRAGMAS,
+            max_connections=constants.DB_MAX_CONNECTIONS,
+            stale_timeout=constants.DB_STALE_TIMEOUT,
+            timeout=constants.DB_POOL_WAIT_TIMEOUT,
+            check_same_thread=False,
+        )
+    else:
+        database = SqliteDatabase(str(db_path), pragmas=constants.DB_PRAGMAS)
+
+    db.initialize(database)
 
     if(not db_path.is_file()):
         create_tables()
+    else:
+        migrate_database()
+
+    # peers may have timed out while the tracker was down
+    rebuild_active_peers()
 
 
 def create_tables():
     with db:
-        db.create_tables([Tracker, Peer, File, Chunk, Hosts])
+        db.create_tables(MODELS)
+        db.pragma("user_version", SCHEMA_VERSION)
+
+
+# returns the values of the configured pragmas as reported by sqlite
+def get_database_settings():
+    with db:
+        return {pragma: db.pragma(pragma) for pragma in constants.DB_PRAGMAS}
+
+
+# Brings an existing database up to SCHEMA_VERSION in place, one migration per transaction
+def migrate_database():
+    with db:
+        # an empty database (e.g. one about to be replaced) has nothing to migrate
+        if(not db.table_exists(File)):
+            return
+
+        version = db.pragma("user_version")
+        while(version < SCHEMA_VERSION):
+            print("Migrating database from schema version {} to {}".format(version, version + 1))
+            with db.atomic():
+                MIGRATIONS[version]()
+                version += 1
+                db.pragma("user_version", version)
 
 
 # returns the tracker table from the database as a list of dicts
@@ -108,37 +339,65 @@ def get_tracker_list():
 
 
 # returns the file list on the tracker as a dict in the specified output format
-def get_file_list():
+# if any of the paging arguments are given, returns a single page of at most limit files
+# after is the id of the last file of the previous page (the next_cursor of the previous response)
+# sort is one of "id", "name" or "active_peers" (most active first)
+# active peer counts are kept up to date as peers come and go (see recount_active_peers), so this only reads
+def get_file_list(limit=None, after=None, sort="id", min_active_peers=None):
     success = True
+    paginated = (limit is not None or after is not None or sort != "id" or min_active_peers is not None)
     file_list_response = {
         "success": success,
         "files": [],
     }
 
     try:
-        file_list_query = File.select()
-        if(not file_list_query.exists()):
+        if(not paginated and not File.select().exists()):
             raise File.DoesNotExist
 
-        timeout_time = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
-        for file in file_list_query:
-            try:
-                peer_query = Peer.select(fn.COUNT(Peer.id).alias("peer_count"))\
-                    .join(Hosts, on=(Peer.id == Hosts.hosting_peer))\
-                    .join(File, on=(File.id == Hosts.hosted_file))\
-                    .where((File.full_hash == file.full_hash) &
-                           (Peer.keep_alive_timestamp >= timeout_time))\
-                    .get()
-
-                file_list_response["files"].append(file.to_dict_full(peer_query.peer_count))
-            except Exception:
-                pass
+        file_list = File.select(File.id, File.name, File.full_hash, File.active_peers)
+
+        if(min_active_peers is not None):
+            file_list = file_list.where(File.active_peers >= min_active_peers)
+
+        # keyset pagination, continue from the position of the cursor file in the requested ordering
+        if(after is not None and sort == "id"):
+            file_list = file_list.where(File.id > after)
+        elif(after is not None and sort == "name"):
+            cursor_file = File.get(File.id == after)
+            file_list = file_list.where(Tuple(File.name, File.id) > Tuple(cursor_file.name, after))
+        elif(after is not None and sort == "active_peers"):
+            cursor_file = File.get(File.id == after)
+            file_list = file_list.where((File.active_peers < cursor_file.active_peers) |
+                                        ((File.active_peers == cursor_file.active_peers) & (File.id > after)))
+
+        if(sort == "name"):
+            file_list = file_list.order_by(File.name, File.id)
+        elif(sort == "active_peers"):
+            file_list = file_list.order_by(File.active_peers.desc(), File.id)
+        else:
+            file_list = file_list.order_by(File.id)
+
+        # fetch one extra file to find out if there is another page
+        if(limit is not None):
+            file_list = file_list.limit(limit + 1)
 
-        if(len(file_list_response["files"]) <= 0):
+        for file in file_list:
+            file_list_response["files"].append(file.to_dict_full(file.active_peers))
+
+        if(paginated):
+            file_list_response["next_cursor"] = None
+            if(limit is not None and len(file_list_response["files"]) > limit):
+                del file_list_response["files"][limit:]
+                file_list_response["next_cursor"] = file_list_response["files"][-1]["id"]
+        elif(len(file_list_response["files"]) <= 0):
             raise Exception("No peers listed for any file on tracker")
 
     except File.DoesNotExist:
-        error = "No files listed on tracker"
+        if(paginated):
+            error = "File with id {} (the cursor) does not exist".format(after)
+        else:
+            error = "No files listed on tracker"
         success = False
     except Exception as e:
         error = str(e)
@@ -153,41 +412,88 @@ def get_file_list():
     return file_list_response
 
 
+# sets active_peers of the given files (or every file) to their number of recently keepalived peers
+# the count is taken from the hosts as they are when it runs, so recounting twice or late is harmless
+def recount_active_peers(file_ids=None):
+    timeout_time = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
+    peer_count = Peer.select(fn.COUNT(Peer.id))\
+        .join(Hosts, on=(Peer.id == Hosts.hosting_peer))\
+        .where((Hosts.hosted_file == File.id) &
+               (Peer.keep_alive_timestamp >= timeout_time))
+
+    recount_query = File.update(active_peers=peer_count)
+    if(file_ids is not None):
+        recount_query = recount_query.where(File.id.in_(file_ids))
+
+    recount_query.execute()
+
+
+# recounts the active peers of every file a peer hosts, for when it comes online or times out
+def recount_peer_files(peer_id):
+    recount_active_peers(Hosts.select(Hosts.hosted_file).where(Hosts.hosting_peer == peer_id))
+
+
+# notes a peer's new keep alive timestamp once it is written, recounting its files if it just came online
+def peer_kept_alive(peer_id, previous_timestamp, keep_alive_timestamp):
+    if(peer_timed_out(previous_timestamp)):
+        recount_peer_files(peer_id)
+
+    liveness.watch(peer_id, keep_alive_timestamp)
+
+
+# recounts every file's active peers and starts watching the recently keepalived peers from scratch
+def rebuild_active_peers():
+    with db:
+        if(not db.table_exists(File)):
+            return
+
+        recount_active_peers()
+
+        liveness.reset()
+        timeout_time = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
+        for peer in Peer.select(Peer.id, Peer.keep_alive_timestamp).where(Peer.keep_alive_timestamp >= timeout_time):
+            liveness.watch(peer.id, peer.keep_alive_timestamp)
+
+
 # returns the data for a specific file
-def get_file(file_id):
+# with compact, the chunks are the file's compact chunk list, as the JSON text to put in the response
+def get_file(file_id, compact=False):
+    cache_key = ("id", file_id, "compact") if compact else ("id", file_id)
+    cached_response = cache.get_file(cache_key)
+    if(cached_response is not None):
+        return cached_response
+
+    generation = cache.generation()
     success = True
     get_file_response = {
         "success": success,
         "name": None,
         "full_hash": None,
+        "manifest_digest": None,
         "chunks": [],
         "peers": [],
     }
 
     try:
-        file_query = File.select(File.name, File.full_hash).where(File.id == file_id).get()
+        file_fields = [File.id, File.name, File.full_hash, File.manifest_digest]
+        if(compact):
+            file_fields.append(File.chunk_manifest)
+        file_query = File.select(*file_fields).where(File.id == file_id).get()
         get_file_response["name"] = file_query.name
         get_file_response["full_hash"] = file_query.full_hash
+        get_file_response["manifest_digest"] = file_query.manifest_digest
 
-        chunk_query = Chunk.select(Chunk.chunk_id, Chunk.chunk_hash, Chunk.name)\
-            .join(File, on=(File.id == Chunk.parent_file))\
-            .where(File.id == file_id)
-
-        timeout_time = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
-        peer_query = Peer.select(Peer.ip)\
-            .join(Hosts, on=(Peer.id == Hosts.hosting_peer))\
-            .join(File, on=(File.id == Hosts.hosted_file))\
-            .where((File.id == file_id) &
-                   (Peer.keep_alive_timestamp >= timeout_time))
-
-        if(len(peer_query) == 0):
+        (peers, expires) = live_peers(file_query.id)
+        if(len(peers) == 0):
             raise Exception("File has no hosting peers currently online")
 
-        for chunk in chunk_query:
-            get_file_response["chunks"].append(chunk.to_dict())
+        if(compact):
+            get_file_response["chunks"] = decode_chunk_manifest(file_query.chunk_manifest)
+        else:
+            get_file_response["chunks"] = file_chunks(file_query.id, generation)
+        get_file_response["peers"] = peers
 
-        for peer in peer_query:
-            get_file_response["peers"].append(peer.to_dict_simple())
+        cache.put_file(cache_key, file_query.id, get_file_response, expires, generation)
 
     except File.DoesNotExist:
         error = "File with id {} does not exist".format(file_id)
@@ -212,40 +518,44 @@ def get_file(file_id):
 
 
 # returns the data for a specific file hash
-def get_file_by_hash(file_full_hash):
+# with compact, the chunks are the file's compact chunk list, as the JSON text to put in the response
+def get_file_by_hash(file_full_hash, compact=False):
+    cache_key = ("hash", file_full_hash, "compact") if compact else ("hash", file_full_hash)
+    cached_response = cache.get_file(cache_key)
+    if(cached_response is not None):
+        return cached_response
+
+    generation = cache.generation()
     success = True
     get_file_by_hash_response = {
         "success": success,
         "name": None,
         "full_hash": None,
+        "manifest_digest": None,
         "chunks": [],
         "peers": [],
     }
 
     try:
-        file_query = File.select(File.name, File.full_hash).where(File.full_hash == file_full_hash).get()
+        file_fields = [File.id, File.name, File.full_hash, File.manifest_digest]
+        if(compact):
+            file_fields.append(File.chunk_manifest)
+        file_query = File.select(*file_fields).where(File.full_hash == file_full_hash).get()
         get_file_by_hash_response["name"] = file_query.name
         get_file_by_hash_response["full_hash"] = file_query.full_hash
+        get_file_by_hash_response["manifest_digest"] = file_query.manifest_digest
 
-        chunk_query = Chunk.select(Chunk.chunk_id, Chunk.chunk_hash, Chunk.name)\
-            .join(File, on=(File.id == Chunk.parent_file))\
-            .where(File.full_hash == file_full_hash)
-
-        timeout_time = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
-        peer_query = Peer.select(Peer.ip)\
-            .join(Hosts, on=(Peer.id == Hosts.hosting_peer))\
-            .join(File, on=(File.id == Hosts.hosted_file))\
-            .where((File.full_hash == file_full_hash) &
-                   (Peer.keep_alive_timestamp >= timeout_time))
-
-        if(len(peer_query) == 0):
+        (peers, expires) = live_peers(file_query.id)
+        if(len(peers) == 0):
             raise Exception("File has no hosting peers currently online")
 
-        for chunk in chunk_query:
-            get_file_by_hash_response["chunks"].append(chunk.to_dict())
+        if(compact):
+            get_file_by_hash_response["chunks"] = decode_chunk_manifest(file_query.chunk_manifest)
+        else:
+            get_file_by_hash_response["chunks"] = file_chunks(file_query.id, generation)
+        get_file_by_hash_response["peers"] = peers
 
-        for peer in peer_query:
-            get_file_by_hash_response["peers"].append(peer.to_dict_simple())
+        cache.put_file(cache_key, file_query.id, get_file_by_hash_response, expires, generation)
 
     except File.DoesNotExist:
         error = "File with hash {} does not exist".format(file_full_hash)
@@ -269,8 +579,223 @@ def get_file_by_hash(file_full_hash):
     return get_file_by_hash_response
 
 
-# TODO: need to check if chunk hashes match if the file already exists
-#       shouldnt be adding chunks to existing files
+# returns a window of a file's chunks, for clients that only need some of them (e.g. to start streaming)
+# the chunks with ids from chunk_from up to but not including chunk_to, at most limit of them (see get_chunk_range)
+def get_file_chunks(file_id, chunk_from=None, chunk_to=None, limit=None):
+    return get_chunk_range(
+        File.id == file_id,
+        "File with id {} does not exist".format(file_id),
+        chunk_from,
+        chunk_to,
+        limit,
+    )
+
+
+# get_file_chunks for a specific file hash
+def get_file_chunks_by_hash(file_full_hash, chunk_from=None, chunk_to=None, limit=None):
+    return get_chunk_range(
+        File.full_hash == file_full_hash,
+        "File with hash {} does not exist".format(file_full_hash),
+        chunk_from,
+        chunk_to,
+        limit,
+    )
+
+
+# returns the file data and peers as get_file does, with the chunks in a range of chunk ids in place of all of them
+# the file is the one matching file_condition, missing_error is the error if there isn't one
+# the chunks are read with a range scan of the parent_file/chunk_id index, so the time it takes doesn't depend on
+# how many chunks the file has
+# next_from is the chunk_from of the next window if limit cut this one short, otherwise None
+def get_chunk_range(file_condition, missing_error, chunk_from, chunk_to, limit):
+    limit = constants.CHUNK_RANGE_MAX_SIZE if limit is None else limit
+    success = True
+    chunk_range_response = {
+        "success": success,
+        "name": None,
+        "full_hash": None,
+        "manifest_digest": None,
+        "chunks": [],
+        "peers": [],
+        "next_from": None,
+    }
+
+    try:
+        file_query = File.select(File.id, File.name, File.full_hash, File.manifest_digest).where(file_condition).get()
+        chunk_range_response["name"] = file_query.name
+        chunk_range_response["full_hash"] = file_query.full_hash
+        chunk_range_response["manifest_digest"] = file_query.manifest_digest
+
+        (peers, _) = live_peers(file_query.id)
+        if(len(peers) == 0):
+            raise Exception("File has no hosting peers currently online")
+        chunk_range_response["peers"] = peers
+
+        chunk_query = Chunk.select(Chunk.chunk_id, ChunkContent.chunk_hash, Chunk.name)\
+            .join(ChunkContent, on=(ChunkContent.id == Chunk.content))\
+            .where(Chunk.parent_file == file_query.id)
+        if(chunk_from is not None):
+            chunk_query = chunk_query.where(Chunk.chunk_id >= chunk_from)
+        if(chunk_to is not None):
+            chunk_query = chunk_query.where(Chunk.chunk_id < chunk_to)
+
+        # fetch one extra chunk to find out if there is another window
+        chunk_query = chunk_query.order_by(Chunk.chunk_id).limit(limit + 1).tuples()
+        chunk_range_response["chunks"] = [
+            {"id": chunk_id, "chunk_hash": chunk_hash, "name": name}
+            for (chunk_id, chunk_hash, name) in chunk_query
+        ]
+
+        if(len(chunk_range_response["chunks"]) > limit):
+            del chunk_range_response["chunks"][limit:]
+            chunk_range_response["next_from"] = chunk_range_response["chunks"][-1]["id"] + 1
+
+    except File.DoesNotExist:
+        error = missing_error
+        success = False
+    except Exception as e:
+        error = str(e)
+        success = False
+
+    if(not success):
+        chunk_range_response = {
+            "success": success,
+            "error": error,
+        }
+
+    return chunk_range_response
+
+
+# returns the chunks of a file as dicts, from the cache if they're in it
+# generation is the cache generation taken before the file was read
+def file_chunks(file_id, generation):
+    chunks = cache.get_chunks(file_id)
+    if(chunks is None):
+        chunk_query = Chunk.select(Chunk.chunk_id, ChunkContent.chunk_hash, Chunk.name)\
+            .join(ChunkContent, on=(ChunkContent.id == Chunk.content))\
+            .where(Chunk.parent_file == file_id)\
+            .order_by(Chunk.chunk_id)\
+            .tuples()
+        # tuples skip building a Chunk and a ChunkContent for every row, the dicts are the same as Chunk.to_dict's
+        chunks = [
+            {"id": chunk_id, "chunk_hash": chunk_hash, "name": name}
+            for (chunk_id, chunk_hash, name) in chunk_query
+        ]
+
+        cache.put_chunks(file_id, chunks, generation)
+
+    return chunks
+
+
+# returns the digest of a file's chunk list, given as (id, name, hash) tuples in id order
+# the sha256 (as hex) of the chunks as a JSON array of [<id>, "<name>", "<hash>"] arrays, utf-8 encoded,
+# with no whitespace and non-ascii characters escaped (json.dumps with separators=(",", ":"))
+# JSON quotes and escapes the names and hashes, so two different chunk lists can't encode the same way
+def manifest_digest(chunks):
+    chunk_list = [[chunk_id, name, chunk_hash] for (chunk_id, name, chunk_hash) in chunks]
+
+    return hashlib.sha256(json.dumps(chunk_list, separators=(",", ":")).encode()).hexdigest()
+
+
+# returns a file's chunk list in the compact format, given as (id, name, hash) tuples in id order
+# one array per field rather than an object per chunk, as JSON compressed with zlib:
+# {"ids": [<chunk id>, ...], "names": ["<chunk filename>", ...], "hashes": ["<hash of chunk>", ...]}
+def encode_chunk_manifest(chunks):
+    chunk_manifest = {"ids": [], "names": [], "hashes": []}
+    for (chunk_id, name, chunk_hash) in chunks:
+        chunk_manifest["ids"].append(chunk_id)
+        chunk_manifest["names"].append(name)
+        chunk_manifest["hashes"].append(chunk_hash)
+
+    return zlib.compress(json.dumps(chunk_manifest, separators=(",", ":")).encode())
+
+
+# returns the JSON text of an encoded compact chunk list
+def decode_chunk_manifest(chunk_manifest):
+    return zlib.decompress(chunk_manifest).decode()
+
+
+# adds the chunks of a newly created file, given as /add_file chunk dicts in id order
+# each chunk hash the tracker doesn't have yet is added to ChunkContent
+def create_chunks(file_id, chunks):
+    chunk_hashes = list({chunk_data["hash"] for chunk_data in chunks})
+    content_ids = {}
+    for hash_batch in chunked(chunk_hashes, constants.CHUNK_INSERT_BATCH_SIZE):
+        ChunkContent.insert_many([{"chunk_hash": chunk_hash} for chunk_hash in hash_batch])\
+            .on_conflict_ignore()\
+            .execute()
+        for content in ChunkContent.select().where(ChunkContent.chunk_hash.in_(hash_batch)):
+            content_ids[content.chunk_hash] = content.id
+
+    chunk_rows = [
+        {
+            "chunk_id": chunk_data["id"],
+            "name": chunk_data["name"],
+            "content": content_ids[chunk_data["hash"]],
+            "parent_file": file_id,
+        }
+        for chunk_data in chunks
+    ]
+    for chunk_batch in chunked(chunk_rows, constants.CHUNK_INSERT_BATCH_SIZE):
+        Chunk.insert_many(chunk_batch).execute()
+
+    chunk_manifest = encode_chunk_manifest(map(itemgetter("id", "name", "hash"), chunks))
+    File.update(chunk_manifest=chunk_manifest).where(File.id == file_id).execute()
+
+
+# deletes the chunks of the given files (a list or a query of ids), and the chunk hashes no other file has
+# returns the number of chunks deleted
+def delete_chunks(file_ids):
+    other_chunks = Chunk.alias()
+    shared_content = other_chunks.select()\
+        .where((other_chunks.content == ChunkContent.id) & other_chunks.parent_file.not_in(file_ids))
+    ChunkContent.delete()\
+        .where(ChunkContent.id.in_(Chunk.select(Chunk.content).where(Chunk.parent_file.in_(file_ids))) &
+               ~fn.EXISTS(shared_content))\
+        .execute()
+
+    return Chunk.delete().where(Chunk.parent_file.in_(file_ids)).execute()
+
+
+# returns the recently keepalived peers hosting a file as dicts, and when the first of them times out
+# (at most constants.FILE_CACHE_TTL from now), which is how long the list can be cached for
+def live_peers(file_id):
+    now = datetime.datetime.now()
+    expires = now + datetime.timedelta(seconds=constants.FILE_CACHE_TTL)
+
+    peer_query = Peer.select(Peer.ip, Peer.keep_alive_timestamp)\
+        .join(Hosts, on=(Peer.id == Hosts.hosting_peer))\
+        .where((Hosts.hosted_file == file_id) &
+               (Peer.keep_alive_timestamp >= now - constants.KEEP_ALIVE_TIMEOUT))
+
+    peers = []
+    for peer in peer_query:
+        peers.append(peer.to_dict_simple())
+        expires = min(expires, peer.keep_alive_timestamp + constants.KEEP_ALIVE_TIMEOUT)
+
+    return (peers, expires)
+
+
+# drops the cached responses for the given files (and their chunks, if they were deleted)
+# inside a transaction, they are dropped again once it commits, see cache.invalidate_deferred
+def invalidate_files(file_ids, deleted=False):
+    cache.invalidate_files(file_ids, deleted=deleted, in_transaction=db.in_transaction())
+
+
+# drops the cached responses for the files a peer hosts, for when it comes back online or its ip changes
+def invalidate_peer_files(peer_id):
+    hosts_query = Hosts.select(Hosts.hosted_file).where(Hosts.hosting_peer == peer_id)
+    invalidate_files(host.hosted_file_id for host in hosts_query)
+
+
+# returns true if a peer with this keep alive timestamp has timed out
+def peer_timed_out(keep_alive_timestamp):
+    return keep_alive_timestamp < datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
+
+
+# adds a file, or a host for a file the tracker already has
+# the file's chunks are checked against the tracker's by manifest digest, a peer adding itself as a host of a
+# file the tracker has can send the digest (as "manifest_digest") instead of the chunks
 def add_file(add_file_data, peer_ip):
     success = True
     add_file_response = {
@@ -280,74 +805,74 @@ def add_file(add_file_data, peer_ip):
     }
 
     try:
-        if(len(add_file_data["chunks"]) <= 0):
+        if("chunks" in add_file_data and len(add_file_data["chunks"]) <= 0):
             raise Exception("File is invalid, has no chunks")
 
-        # if client has no guid, add them as a peer, generate a guid, and set their sequence number
-        # else get the peer
-        if(add_file_data["guid"] is None):
-            peer = add_peer(peer_ip)
-            peer.expected_seq_number = add_file_data["seq_number"]
-        else:
-            peer = Peer.get(Peer.uuid == add_file_data["guid"])
-            if(peer.ip != peer_ip):
-                peer.ip = peer_ip
-                peer.save()
-
-        if(peer.expected_seq_number != add_file_data["seq_number"]):
-            raise Exception("Tracker is expecting sequence number {} (sequence number {} was sent)"
-                            .format(peer.expected_seq_number, add_file_data["seq_number"]))
-
-        # add the file to the db (or create new one if it didn't exist)
-        new_file, file_created = File().get_or_create(
-            full_hash=add_file_data["full_hash"],
-            defaults={"name": add_file_data["name"]},
-        )
-
-        # if the file doesn't exist, add the chunks to the db and associate them with the file
-        if(file_created):
-            for chunk_data in sorted(add_file_data["chunks"], key=itemgetter('id')):
-                Chunk().create(
-                    chunk_id=chunk_data["id"],
-                    name=chunk_data["name"],
-                    chunk_hash=chunk_data["hash"],
-                    parent_file=new_file,
+        # everything below is applied as a single transaction, so a failure part way through leaves no trace
+        with db.atomic():
+            # if client has no guid, add them as a peer, generate a guid, and set their sequence number
+            # else get the peer
+            if(add_file_data["guid"] is None):
+                peer = add_peer(peer_ip)
+                peer.expected_seq_number = add_file_data["seq_number"]
+            else:
+                peer = Peer.get(Peer.uuid == add_file_data["guid"])
+                if(peer.ip != peer_ip):
+                    peer.ip = peer_ip
+                    peer.save()
+                    invalidate_peer_files(peer.id)
+
+            if(peer.expected_seq_number != add_file_data["seq_number"]):
+                raise Exception("Tracker is expecting sequence number {} (sequence number {} was sent)"
+                                .format(peer.expected_seq_number, add_file_data["seq_number"]))
+
+            if("chunks" in add_file_data):
+                chunks = sorted(add_file_data["chunks"], key=itemgetter('id'))
+                digest = manifest_digest(map(itemgetter("id", "name", "hash"), chunks))
+
+                # add the file to the db (or create new one if it didn't exist)
+                new_file, file_created = File().get_or_create(
+                    full_hash=add_file_data["full_hash"],
+                    defaults={"name": add_file_data["name"], "manifest_digest": digest},
                 )
-
-            # add relationship for the file and client
-            Hosts().create(
-                hosted_file=new_file,
-                hosting_peer=peer,
-            )
-        else:
-            # if the file does exist, check that the submitted chunks match the existing chunks
-            chunk_query = Chunk.select(Chunk.chunk_id, Chunk.chunk_hash, Chunk.name)\
-                            .join(File, on=(File.id == Chunk.parent_file))\
-                            .where(File.full_hash == add_file_data["full_hash"])
-
-            if(len(chunk_query) != len(add_file_data["chunks"])):
-                raise Exception("File invalid, chunks do not match tracker version")
-
-            for chunk_data, chunk_query_data in\
-                    zip(sorted(add_file_data["chunks"], key=itemgetter('id')), chunk_query):
-                if((chunk_data["id"] != chunk_query_data.chunk_id) or
-                   (chunk_data["name"] != chunk_query_data.name) or
-                   (chunk_data["hash"] != chunk_query_data.chunk_hash)):
+            else:
+                # without the chunks, the file can only be one the tracker already has
+                digest = add_file_data["manifest_digest"]
+                new_file = File.get(File.full_hash == add_file_data["full_hash"])
+                file_created = False
+
+            # if the file doesn't exist, add the chunks to the db and associate them with the file
+            if(file_created):
+                create_chunks(new_file.id, chunks)
+
+                # add relationship for the file and client
+                Hosts().create(
+                    hosted_file=new_file,
+                    hosting_peer=peer,
+                )
+            else:
+                # if the file does exist, check that the submitted chunks match the existing chunks
+                if(new_file.manifest_digest != digest):
                     raise Exception("File invalid, chunks do not match tracker version")
 
-            # add relationship for the file and client (if a relationship does not already exist)
-            # else error
-            _, host_created = Hosts().get_or_create(
-                hosted_file=new_file,
-                hosting_peer=peer,
-            )
+                # add relationship for the file and client (if a relationship does not already exist)
+                # else error
+                _, host_created = Hosts().get_or_create(
+                    hosted_file=new_file,
+                    hosting_peer=peer,
+                )
+
+                if(not host_created):
+                    raise Exception("Peer with guid {} (you) is already hosting this file"
+                                    .format(add_file_data["guid"]))
 
-            if(not host_created):
-                raise Exception("Peer with guid {} (you) is already hosting this file".format(add_file_data["guid"]))
+            # increment the peer's expected seq number
+            peer.expected_seq_number += 1
+            peer.save()
 
-        # increment the peer's expected seq number
-        peer.expected_seq_number += 1
-        peer.save()
+            # the file has a new host
+            invalidate_files([new_file.id])
+            recount_active_peers([new_file.id])
 
         add_file_response["file_id"] = new_file.id
         add_file_response["guid"] = peer.uuid
@@ -355,6 +880,9 @@ def add_file(add_file_data, peer_ip):
     except Peer.DoesNotExist:
         error = "Peer with guid {} does not exist".format(add_file_data["guid"])
         success = False
+    except File.DoesNotExist:
+        error = "File with hash {} does not exist, send its chunks to add it".format(add_file_data["full_hash"])
+        success = False
     except Exception as e:
         error = str(e)
         success = False
@@ -368,6 +896,47 @@ def add_file(add_file_data, peer_ip):
     return add_file_response
 
 
+# add_file for many files at once, in order and in one transaction (see /add_files)
+# each file is added in its own savepoint, so one that fails leaves the others alone
+# files without a guid are added for the same new peer, which is created by the first of them
+# returns an add_file response for each file, in order
+def add_files(add_files_data, peer_ip):
+    responses = []
+    new_peer_guid = None
+
+    with db.atomic():
+        for add_file_data in add_files_data:
+            if(add_file_data["guid"] is None and new_peer_guid is not None):
+                add_file_data = dict(add_file_data, guid=new_peer_guid)
+
+            add_file_response = add_file(add_file_data, peer_ip)
+            if(add_file_data["guid"] is None and add_file_response["success"]):
+                new_peer_guid = str(add_file_response["guid"])
+
+            responses.append(add_file_response)
+
+    return responses
+
+
+# returns the /add_file request to pass on to the other trackers for a file that was just added
+# a peer that sent the file's manifest digest has the chunks filled in from the file's compact chunk list,
+# the other trackers may not have the file yet
+def add_file_sync_data(add_file_data):
+    if("chunks" in add_file_data):
+        return add_file_data
+
+    file = File.get(File.full_hash == add_file_data["full_hash"])
+    chunk_manifest = json.loads(decode_chunk_manifest(file.chunk_manifest))
+    sync_data = {key: value for (key, value) in add_file_data.items() if key != "manifest_digest"}
+    sync_data["chunks"] = [
+        {"id": chunk_id, "name": name, "hash": chunk_hash}
+        for (chunk_id, name, chunk_hash)
+        in zip(chunk_manifest["ids"], chunk_manifest["names"], chunk_manifest["hashes"])
+    ]
+
+    return sync_data
+
+
 # creates a new peer with a random guid
 def add_peer(peer_ip):
     peer_uuid = uuid.uuid4()
@@ -387,6 +956,9 @@ def keep_alive(keep_alive_data, peer_ip):
         "success": success,
     }
 
+    if(constants.KEEP_ALIVE_BUFFER):
+        return buffered_keep_alive(keep_alive_data, peer_ip)
+
     try:
         peer = Peer.get(Peer.uuid == keep_alive_data["guid"])
 
@@ -394,12 +966,20 @@ def keep_alive(keep_alive_data, peer_ip):
             raise Exception("Tracker is expecting keep_alive sequence number {} (sequence number {} was sent)"
                             .format(peer.ka_expected_seq_number, keep_alive_data["ka_seq_number"]))
 
+        # the peer's files get a new peer list if it was offline or moved
+        peer_changed = (peer.ip != peer_ip) or peer_timed_out(peer.keep_alive_timestamp)
+        previous_timestamp = peer.keep_alive_timestamp
+
         # update ip, increment the peer's expected keep_alive seq number
         if(peer.ip != peer_ip):
             peer.ip = peer_ip
         peer.keep_alive_timestamp = datetime.datetime.now()
         peer.ka_expected_seq_number += 1
         peer.save()
+
+        if(peer_changed):
+            invalidate_peer_files(peer.id)
+        peer_kept_alive(peer.id, previous_timestamp, peer.keep_alive_timestamp)
     except Peer.DoesNotExist:
         error = "Peer with guid {} does not exist".format(keep_alive_data["guid"])
         success = False
@@ -416,6 +996,204 @@ def keep_alive(keep_alive_data, peer_ip):
     return keep_alive_response
 
 
+# keep_alive for when the keep alive buffer is enabled
+# sequence numbers are checked against the buffer, and only the buffer is updated unless the peer's
+# timestamp in the db could expire before the next flush (or its ip changed), then it's written through
+# this way the db never shows a live peer as timed out, so readers of the db need not know about the buffer
+def buffered_keep_alive(keep_alive_data, peer_ip):
+    success = True
+    keep_alive_response = {
+        "success": success,
+    }
+
+    try:
+        peer_uuid = str(uuid.UUID(keep_alive_data["guid"]))
+
+        with keep_alive_buffer_lock:
+            buffered = keep_alive_buffer.get(peer_uuid)
+            if(buffered is None):
+                peer = Peer.get(Peer.uuid == peer_uuid)
+                buffered = {
+                    "id": peer.id,
+                    "ip": peer.ip,
+                    "keep_alive_timestamp": peer.keep_alive_timestamp,
+                    "persisted_timestamp": peer.keep_alive_timestamp,
+                    "ka_expected_seq_number": peer.ka_expected_seq_number,
+                    "dirty": False,
+                }
+
+            if(buffered["ka_expected_seq_number"] != keep_alive_data["ka_seq_number"]):
+                raise Exception("Tracker is expecting keep_alive sequence number {} (sequence number {} was sent)"
+                                .format(buffered["ka_expected_seq_number"], keep_alive_data["ka_seq_number"]))
+
+            now = datetime.datetime.now()
+            buffered["keep_alive_timestamp"] = now
+            buffered["ka_expected_seq_number"] += 1
+
+            flush_margin = datetime.timedelta(seconds=2 * constants.KEEP_ALIVE_FLUSH_INTERVAL)
+            if((buffered["ip"] != peer_ip) or
+               (buffered["persisted_timestamp"] + constants.KEEP_ALIVE_TIMEOUT <= now + flush_margin)):
+                Peer.update(
+                    ip=peer_ip,
+                    keep_alive_timestamp=now,
+                    ka_expected_seq_number=buffered["ka_expected_seq_number"],
+                ).where(Peer.id == buffered["id"]).execute()
+
+                if((buffered["ip"] != peer_ip) or peer_timed_out(buffered["persisted_timestamp"])):
+                    invalidate_peer_files(buffered["id"])
+                peer_kept_alive(buffered["id"], buffered["persisted_timestamp"], now)
+
+                buffered["ip"] = peer_ip
+                buffered["persisted_timestamp"] = now
+                buffered["dirty"] = False
+            else:
+                buffered["dirty"] = True
+
+            keep_alive_buffer[peer_uuid] = buffered
+    except Peer.DoesNotExist:
+        error = "Peer with guid {} does not exist".format(keep_alive_data["guid"])
+        success = False
+    except Exception as e:
+        error = str(e)
+        success = False
+
+    if(not success):
+        keep_alive_response = {
+            "success": success,
+            "error": error,
+        }
+
+    return keep_alive_response
+
+
+# keep_alive for many peers at once, for hosts running many peers behind one ip (see /keep_alive_batch)
+# every peer is looked up in one query, and the ones whose sequence number matches are updated with one
+# UPDATE per batch of peers, all in one transaction
+# returns a keep_alive response for each keep alive, in order
+def keep_alive_batch(keep_alives, peer_ip):
+    if(constants.KEEP_ALIVE_BUFFER):
+        with db.atomic():
+            return [buffered_keep_alive(keep_alive_data, peer_ip) for keep_alive_data in keep_alives]
+
+    responses = []
+    with db.atomic():
+        peer_uuids = set()
+        for keep_alive_data in keep_alives:
+            try:
+                peer_uuids.add(uuid.UUID(keep_alive_data["guid"]))
+            except ValueError:
+                pass
+
+        peers = {}
+        for uuid_batch in chunked(peer_uuids, constants.KEEP_ALIVE_FLUSH_BATCH_SIZE):
+            peer_query = Peer.select(
+                Peer.id,
+                Peer.uuid,
+                Peer.ip,
+                Peer.keep_alive_timestamp,
+                Peer.ka_expected_seq_number,
+            ).where(Peer.uuid.in_(uuid_batch))
+            for peer in peer_query:
+                peers[peer.uuid] = peer
+
+        # check the sequence numbers in order, a peer can be in the batch more than once
+        kept_alive = {}
+        for keep_alive_data in keep_alives:
+            try:
+                peer = peers.get(uuid.UUID(keep_alive_data["guid"]))
+                if(peer is None):
+                    raise Peer.DoesNotExist
+
+                if(peer.ka_expected_seq_number != keep_alive_data["ka_seq_number"]):
+                    raise Exception("Tracker is expecting keep_alive sequence number {} (sequence number {} was sent)"
+                                    .format(peer.ka_expected_seq_number, keep_alive_data["ka_seq_number"]))
+
+                peer.ka_expected_seq_number += 1
+                kept_alive[peer.id] = peer
+                responses.append({"success": True})
+            except Peer.DoesNotExist:
+                responses.append({
+                    "success": False,
+                    "error": "Peer with guid {} does not exist".format(keep_alive_data["guid"]),
+                })
+            except Exception as e:
+                responses.append({
+                    "success": False,
+                    "error": str(e),
+                })
+
+        now = datetime.datetime.now()
+        for batch in chunked(list(kept_alive.values()), constants.KEEP_ALIVE_FLUSH_BATCH_SIZE):
+            seq_numbers = Case(Peer.id, [(peer.id, peer.ka_expected_seq_number) for peer in batch])
+            Peer.update(
+                ip=peer_ip,
+                keep_alive_timestamp=now,
+                ka_expected_seq_number=seq_numbers,
+            ).where(Peer.id.in_([peer.id for peer in batch])).execute()
+
+        # the files of peers that were offline or moved get a new peer list, see keep_alive
+        # and the files of peers that were offline have one more active peer
+        came_online = [peer.id for peer in kept_alive.values() if peer_timed_out(peer.keep_alive_timestamp)]
+        changed = [peer.id for peer in kept_alive.values() if peer.ip != peer_ip] + came_online
+        for batch in chunked(changed, constants.KEEP_ALIVE_FLUSH_BATCH_SIZE):
+            hosts_query = Hosts.select(Hosts.hosted_file).distinct().where(Hosts.hosting_peer.in_(batch))
+            invalidate_files(host.hosted_file_id for host in hosts_query)
+        for batch in chunked(came_online, constants.KEEP_ALIVE_FLUSH_BATCH_SIZE):
+            recount_active_peers(Hosts.select(Hosts.hosted_file).where(Hosts.hosting_peer.in_(batch)))
+
+        for peer_id in kept_alive:
+            liveness.watch(peer_id, now)
+
+    return responses
+
+
+# writes the buffered keep alives to the db in one transaction, with one UPDATE per batch of peers
+# entries of peers that have not sent a keep alive within the timeout are dropped from the buffer
+# returns the number of peers written
+def flush_keep_alive_buffer():
+    with keep_alive_buffer_lock:
+        now = datetime.datetime.now()
+        dirty = [buffered for buffered in keep_alive_buffer.values() if buffered["dirty"]]
+
+        with db.atomic():
+            for batch in chunked(dirty, constants.KEEP_ALIVE_FLUSH_BATCH_SIZE):
+                # never move a timestamp backwards, add_file/deregister_file may have written a newer one
+                timestamps = Case(Peer.id, [
+                    (buffered["id"], str(buffered["keep_alive_timestamp"])) for buffered in batch
+                ])
+                seq_numbers = Case(Peer.id, [
+                    (buffered["id"], buffered["ka_expected_seq_number"]) for buffered in batch
+                ])
+
+                Peer.update(
+                    keep_alive_timestamp=fn.MAX(Peer.keep_alive_timestamp, timestamps),
+                    ka_expected_seq_number=seq_numbers,
+                ).where(Peer.id.in_([buffered["id"] for buffered in batch])).execute()
+
+        for buffered in dirty:
+            buffered["persisted_timestamp"] = buffered["keep_alive_timestamp"]
+            buffered["dirty"] = False
+            liveness.watch(buffered["id"], buffered["keep_alive_timestamp"])
+
+        for peer_uuid, buffered in list(keep_alive_buffer.items()):
+            if(buffered["keep_alive_timestamp"] + constants.KEEP_ALIVE_TIMEOUT < now):
+                del keep_alive_buffer[peer_uuid]
+
+    return len(dirty)
+
+
+# returns the expected keep-alive sequence number of a peer from the keep alive buffer,
+# or default if the buffer does not know the peer
+def buffered_ka_expected_seq(puuid, default):
+    with keep_alive_buffer_lock:
+        buffered = keep_alive_buffer.get(str(puuid))
+
+    if(buffered is None):
+        return default
+
+    return buffered["ka_expected_seq_number"]
+
+
 # removes a peer from the hosts list of a file
 # if the file has no hosts remaining, removes it
 def deregister_file(deregister_file_data, peer_ip):
@@ -427,11 +1205,17 @@ def deregister_file(deregister_file_data, peer_ip):
     try:
         # check if peer with guid exists, if so updates the peer's ip and timestamp
         peer = Peer.get(Peer.uuid == deregister_file_data["guid"])
+        peer_changed = (peer.ip != peer_ip) or peer_timed_out(peer.keep_alive_timestamp)
+        previous_timestamp = peer.keep_alive_timestamp
         if(peer.ip != peer_ip):
             peer.ip = peer_ip
         peer.keep_alive_timestamp = datetime.datetime.now()
         peer.save()
 
+        if(peer_changed):
+            invalidate_peer_files(peer.id)
+        peer_kept_alive(peer.id, previous_timestamp, peer.keep_alive_timestamp)
+
         if(peer.expected_seq_number != deregister_file_data["seq_number"]):
             raise Exception("Tracker is expecting sequence number {} (sequence number {} was sent)"
                             .format(peer.expected_seq_number, deregister_file_data["seq_number"]))
@@ -446,8 +1230,13 @@ def deregister_file(deregister_file_data, peer_ip):
         # if there is no one hosting the file, delete it
         try:
             Hosts.get(Hosts.hosted_file == deregister_file_data["file_id"])
+            invalidate_files([host_relationship.hosted_file_id])
+            recount_active_peers([host_relationship.hosted_file_id])
         except Hosts.DoesNotExist:
+            delete_chunks([host_relationship.hosted_file_id])
+
             File.get(File.id == deregister_file_data["file_id"]).delete_instance()
+            invalidate_files([host_relationship.hosted_file_id], deleted=True)
 
         # increment the peer's expected seq number
         peer.expected_seq_number += 1
@@ -484,10 +1273,14 @@ def deregister_file_by_hash(deregister_file_by_hash_data, peer_ip):
     try:
         # check if peer with guid exists, if so updates the peer's ip and timestamp
         peer = Peer.get(Peer.uuid == deregister_file_by_hash_data["guid"])
+        peer_changed = (peer.ip != peer_ip)
         if(peer.ip != peer_ip):
             peer.ip = peer_ip
         peer.save()
 
+        if(peer_changed):
+            invalidate_peer_files(peer.id)
+
         if(peer.expected_seq_number != deregister_file_by_hash_data["seq_number"]):
             raise Exception("Tracker is expecting sequence number {} (sequence number {} was sent)"
                             .format(peer.expected_seq_number, deregister_file_by_hash_data["seq_number"]))
@@ -508,13 +1301,14 @@ def deregister_file_by_hash(deregister_file_by_hash_data, peer_ip):
                 .where((File.full_hash == deregister_file_by_hash_data["file_hash"]) &
                        (Hosts.hosted_file == File.id))\
                 .get()
+            invalidate_files([host_relationship.hosted_file_id])
+            recount_active_peers([host_relationship.hosted_file_id])
         except Hosts.DoesNotExist:
             file_to_delete = File.get(File.full_hash == deregister_file_by_hash_data["file_hash"])
-            Chunk.delete()\
-                .where(Chunk.parent_file == file_to_delete.id)\
-                .execute()
+            delete_chunks([file_to_delete.id])
 
             File.get(File.full_hash == deregister_file_by_hash_data["file_hash"]).delete_instance()
+            invalidate_files([file_to_delete.id], deleted=True)
 
         # increment the peer's expected seq number
         peer.expected_seq_number += 1
@@ -541,6 +1335,105 @@ def deregister_file_by_hash(deregister_file_by_hash_data, peer_ip):
     return deregister_file_by_hash_response
 
 
+# the condition for peers that haven't kept alive (or registered, if they never kept alive) since cutoff
+def inactive_since(cutoff):
+    return (Peer.keep_alive_timestamp < cutoff) & (Peer.registered_timestamp < cutoff)
+
+
+# deletes up to limit peers that have been offline for longer than grace (a timedelta) past the keep alive
+# timeout, see reap_peers, in a transaction of its own
+# returns a tuple of (the deleted peers, with their ip and uuid, and the rows deleted as in reap_peers)
+def reap_expired_peers(grace, limit):
+    cutoff = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT - grace
+
+    # take the write lock up front, the peers picked must not keep alive before they're deleted
+    with db.atomic("IMMEDIATE"):
+        peers = list(Peer.select(Peer.id, Peer.ip, Peer.uuid).where(inactive_since(cutoff)).limit(limit))
+        reclaimed = reap_peers(peers)
+
+    return (peers, reclaimed)
+
+
+# deletes the peer with the given uuid, see reap_peers, if it has timed out here too
+# for when another tracker reaped it, returns true if the peer was deleted
+def reap_peer(peer_guid):
+    cutoff = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
+    peers = list(Peer.select(Peer.id).where((Peer.uuid == peer_guid) & inactive_since(cutoff)))
+    reap_peers(peers)
+
+    return len(peers) > 0
+
+
+# deletes the given peers, which must have timed out, along with their hosts
+# the files no one else hosts are deleted as well, with their chunks
+# the peers aren't counted in any file's active peers, so the counts stay as they are
+# returns the number of rows deleted from each table as a dict
+def reap_peers(peers):
+    reclaimed = {"peers": 0, "hosts": 0, "files": 0, "chunks": 0}
+    if(not peers):
+        return reclaimed
+
+    peer_ids = [peer.id for peer in peers]
+    with db.atomic():
+        other_hosts = Hosts.alias()
+        hosted_elsewhere = other_hosts.select()\
+            .where((other_hosts.hosted_file == Hosts.hosted_file) & other_hosts.hosting_peer.not_in(peer_ids))
+        orphaned_files = [
+            host.hosted_file_id for host in Hosts.select(Hosts.hosted_file).distinct()
+            .where(Hosts.hosting_peer.in_(peer_ids) & ~fn.EXISTS(hosted_elsewhere))
+        ]
+
+        reclaimed["hosts"] = Hosts.delete().where(Hosts.hosting_peer.in_(peer_ids)).execute()
+        reclaimed["peers"] = Peer.delete().where(Peer.id.in_(peer_ids)).execute()
+        for file_batch in chunked(orphaned_files, constants.REAPER_BATCH_SIZE):
+            reclaimed["chunks"] += delete_chunks(file_batch)
+            reclaimed["files"] += File.delete().where(File.id.in_(file_batch)).execute()
+
+        invalidate_files(orphaned_files, deleted=True)
+
+    for peer_id in peer_ids:
+        liveness.forget(peer_id)
+
+    return reclaimed
+
+
+# deletes the hosts of missing peers or files, the files no one hosts and the chunks of missing files
+# these are only left behind by older versions of the tracker (or databases copied from them), so it
+# only needs to run once, limit rows are deleted per transaction
+# returns the number of rows deleted from each table as a dict
+def reap_orphans(limit):
+    reclaimed = {"hosts": 0, "files": 0, "chunks": 0}
+
+    orphaned_hosts = Hosts.select(Hosts.id)\
+        .where(~fn.EXISTS(Peer.select().where(Peer.id == Hosts.hosting_peer)) |
+               ~fn.EXISTS(File.select().where(File.id == Hosts.hosted_file)))
+    orphaned_files = File.select(File.id)\
+        .where(~fn.EXISTS(Hosts.select().where(Hosts.hosted_file == File.id)))
+    orphaned_chunks = Chunk.select(Chunk.parent_file).distinct()\
+        .where(~fn.EXISTS(File.select().where(File.id == Chunk.parent_file)))
+
+    # the rows are found without holding the write lock, each batch is checked again as it's deleted
+    for host_batch in chunked([host.id for host in orphaned_hosts], limit):
+        with db.atomic():
+            reclaimed["hosts"] += Hosts.delete()\
+                .where(Hosts.id.in_(orphaned_hosts.where(Hosts.id.in_(host_batch))))\
+                .execute()
+
+    for file_batch in chunked([file.id for file in orphaned_files], limit):
+        with db.atomic("IMMEDIATE"):
+            file_ids = [file.id for file in orphaned_files.where(File.id.in_(file_batch))]
+            reclaimed["chunks"] += delete_chunks(file_ids)
+            reclaimed["files"] += File.delete().where(File.id.in_(file_ids)).execute()
+            invalidate_files(file_ids, deleted=True)
+
+    for file_batch in chunked([chunk.parent_file_id for chunk in orphaned_chunks], limit):
+        with db.atomic("IMMEDIATE"):
+            file_ids = [chunk.parent_file_id for chunk in orphaned_chunks.where(Chunk.parent_file.in_(file_batch))]
+            reclaimed["chunks"] += delete_chunks(file_ids)
+
+    return reclaimed
+
+
 # returns the peers status on the tracker as a dict in the specified output format
 # contains files the peer is hosting, and the peer's expected sequence numbers
 def get_peer_status(peer_guid):
@@ -565,7 +1458,10 @@ def get_peer_status(peer_guid):
                 peer_status_response["files"].append(file.to_dict_simple())
 
         peer_status_response["expected_seq_number"] = selected_peer.expected_seq_number
-        peer_status_response["ka_expected_seq_number"] = selected_peer.ka_expected_seq_number
+        peer_status_response["ka_expected_seq_number"] = buffered_ka_expected_seq(
+            selected_peer.uuid,
+            selected_peer.ka_expected_seq_number,
+        )
 
     except Peer.DoesNotExist:
         error = "No peer with guid {} is known to tracker".format(peer_guid)
@@ -620,11 +1516,13 @@ def peer_expected_seq(puuid):
 # returns the expected keep-alive sequence number for the given peer uuid
 def peer_expected_ka_seq(puuid):
     peer = Peer.get(Peer.uuid == puuid)
-    return peer.ka_expected_seq_number
+    return buffered_ka_expected_seq(peer.uuid, peer.ka_expected_seq_number)
 
 
 # dumps the db to a dictionary for new trackers
 def new_tracker_dump():
+    flush_keep_alive_buffer()
+
     con = db.connection()
     output = StringIO()
     for line in con.iterdump():
@@ -633,15 +1531,136 @@ def new_tracker_dump():
     return output.getvalue()
 
 
-# Replaces the database at the given path with the contents of the given sql string
+# Copies the database into a new file next to it for /snapshot, using sqlite's online backup
+# The copy is made in one step, which only needs a read transaction, so requests keep writing to the
+# database (through the write-ahead log) while it runs
+# The rows for exclude_tracker_ip are deleted from the copy, a tracker can't be in its own tracker list
+# Returns the path of the copy and the hex SHA-256 of its contents
+def create_snapshot(exclude_tracker_ip=None):
+    flush_keep_alive_buffer()
+
+    (handle, snapshot_path) = tempfile.mkstemp(dir=Path(constants.DB_PATH).parent, prefix="snapshot-", suffix=".db")
+    os.close(handle)
+
+    try:
+        source = sqlite3.connect(str(constants.DB_PATH))
+        destination = sqlite3.connect(snapshot_path)
+        try:
+            source.backup(destination)
+
+            # A single file, without a write-ahead log to go with it
+            destination.execute("PRAGMA journal_mode = DELETE")
+            if(exclude_tracker_ip is not None):
+                with destination:
+                    destination.execute(
+                        f"DELETE FROM \"{Tracker._meta.table_name}\" WHERE ip = ?",
+                        (str(exclude_tracker_ip),),
+                    )
+        finally:
+            destination.close()
+            source.close()
+
+        digest = hashlib.sha256()
+        with open(snapshot_path, "rb") as snapshot_file:
+            for chunk in iter(lambda: snapshot_file.read(constants.SNAPSHOT_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    except Exception:
+        os.unlink(snapshot_path)
+        raise
+
+    return (snapshot_path, digest.hexdigest())
+
+
+# Streams the snapshot at snapshot_path gzip compressed, a chunk at a time
+# The snapshot is left in place, see remove_snapshot
+def stream_snapshot(snapshot_path):
+    compressor = zlib.compressobj(wbits=31)  # wbits=31 makes it a gzip stream
+    with open(snapshot_path, "rb") as snapshot_file:
+        for chunk in iter(lambda: snapshot_file.read(constants.SNAPSHOT_CHUNK_SIZE), b""):
+            compressed = compressor.compress(chunk)
+            if(compressed):
+                yield compressed
+
+    yield compressor.flush()
+
+
+# Deletes a snapshot made by create_snapshot once it has been sent, or couldn't be
+def remove_snapshot(snapshot_path):
+    try:
+        os.unlink(snapshot_path)
+    except FileNotFoundError:
+        pass
+
+
+# Returns true if the file at snapshot_path is an intact sqlite database
+def check_snapshot(snapshot_path):
+    try:
+        connection = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+        try:
+            return connection.execute("PRAGMA quick_check").fetchone()[0] == "ok"
+        finally:
+            connection.close()
+    except sqlite3.DatabaseError:
+        return False
+
+
+# Replaces the database with the contents of the given sql string
+# The dump is loaded into a new file that then takes the database's place, so the database is never
+# seen half replaced, even if the tracker dies midway
 def replace_database(sql_str):
-    db.close()
+    (handle, new_path) = tempfile.mkstemp(dir=Path(constants.DB_PATH).parent, prefix="restore-", suffix=".db")
+    os.close(handle)
 
-    # Truncate the db_path file
-    open(constants.DB_PATH, "w").close()
+    try:
+        connection = sqlite3.connect(new_path)
+        try:
+            # Nothing reads the file until it is complete, so it doesn't need a journal
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.executescript(sql_str)
+        finally:
+            connection.close()
+
+        # synchronous is off, so make sure it's all on disk before it takes the database's place
+        with open(new_path, "rb+") as new_file:
+            os.fsync(new_file.fileno())
+    except Exception:
+        os.unlink(new_path)
+        raise
+
+    replace_database_from_snapshot(new_path)
+
+
+# Replaces the database with the sqlite database at snapshot_path (see create_snapshot), by renaming it
+# into place, so the database is never seen half replaced, even if the tracker dies midway
+def replace_database_from_snapshot(snapshot_path):
+    # Requests and the maintenance threads would otherwise have the connections they use closed under them
+    with database_replacement():
+        close_database()
+
+        # Write everything in the write-ahead log back and empty it, its frames belong to the old database
+        # and would otherwise be replayed onto the new one
+        connection = sqlite3.connect(str(constants.DB_PATH))
+        try:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            connection.close()
+
+        for suffix in ("-wal", "-shm"):
+            try:
+                os.unlink(str(constants.DB_PATH) + suffix)
+            except FileNotFoundError:
+                pass
+
+        os.replace(snapshot_path, constants.DB_PATH)
 
-    load_database(constants.DB_PATH)
-    db.connection().executescript(sql_str)
+        # Anything still buffered belongs to the old database
+        with keep_alive_buffer_lock:
+            keep_alive_buffer.clear()
+        cache.clear()
+
+        # Brings the schema up to date as well, a dump does not carry the schema version
+        load_database(Path(constants.DB_PATH))
 
 
 # removes the tracker with specified id from the tracker list
@@ -649,14 +1668,83 @@ def remove_tracker_by_ip(ip):
     Tracker.delete().where(Tracker.ip == ip).execute()
 
 
+# closes this thread's connection, and every connection if the database is pooled
+# the pool's connections are closed even if another thread is using one, see database_replacement
+def close_database():
+    db.close()
+
+    if(isinstance(db.obj, PooledSqliteDatabase)):
+        db.close_all()
+
+
+# Marks the database as in use by this thread until release_database, waiting while it is being replaced
+# A thread must release it before acquiring it again, a replacement waiting in between would never start
+def acquire_database():
+    global database_users
+
+    with database_condition:
+        while(database_replacing):
+            database_condition.wait()
+        database_users += 1
+
+
+def release_database():
+    global database_users
+
+    with database_condition:
+        database_users -= 1
+        database_condition.notify_all()
+
+
+# acquire_database and release_database around a with block, for the maintenance threads
+@contextmanager
+def database_in_use():
+    acquire_database()
+    try:
+        yield
+    finally:
+        release_database()
+
+
+# Waits for the requests and threads using the database to finish with it, and holds off new ones until the
+# with block is done, so the database can be closed and replaced without pulling connections out from under them
+@contextmanager
+def database_replacement():
+    global database_replacing
+
+    with database_condition:
+        while(database_replacing):
+            database_condition.wait()
+        database_replacing = True
+
+        while(database_users > 0):
+            database_condition.wait()
+
+    try:
+        yield
+    finally:
+        with database_condition:
+            database_replacing = False
+            database_condition.notify_all()
+
+
 # Decorators to explicitly manage connections
 # These functions should maybe not be in this file? I'm not sure
+# In pooled mode closing the connection hands it back to the pool instead of closing it
 @app.before_request
 def before_request():
+    acquire_database()
     db.connect()
 
 
-@app.after_request
-def after_request(response):
-    db.close()
-    return response
+# Teardown runs even if the view raised, unlike after_request, so the connection is never leaked
+@app.teardown_request
+def teardown_request(exception):
+    try:
+        if(not db.is_closed()):
+            db.close()
+    finally:
+        release_database()
+
+    # Whatever the request changed is committed by now
+    cache.invalidate_deferred()
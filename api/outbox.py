@@ -0,0 +1,260 @@
+import json
+from threading import Lock
+import time
+
+from api import constants
+import peewee
+from peewee import DatabaseProxy, EXCLUDED, fn
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.sqlite_ext import AutoIncrementField
+
+# Events waiting to be broadcast to other trackers, kept on disk so they survive a restart
+# Every change this tracker applies goes through here, so the log doubles as the tracker's change log:
+# the seq of the last event is the tracker's version, and a tracker that was away only needs the events
+# after the version it last saw (see events_since)
+# The outbox has its own database file (constants.OUTBOX_PATH) since the tracker database gets
+# replaced wholesale when this tracker resyncs
+outbox_db = DatabaseProxy()
+
+
+class OutboxModel(peewee.Model):
+    class Meta:
+        database = outbox_db
+
+
+# Append-only log of broadcast events
+# seq is never reused, even after the events before it are compacted away
+class OutboxEvent(OutboxModel):
+    seq = AutoIncrementField()
+    created = peewee.FloatField()   # unix time the event was queued
+    event = peewee.TextField()      # the sync event as JSON
+
+
+# How far along the log each tracker is, every event with seq <= acked_seq has been delivered to it
+class OutboxCursor(OutboxModel):
+    tracker_ip = peewee.CharField(unique=True)
+    acked_seq = peewee.IntegerField()
+
+
+# The latest version of each other tracker's change log this tracker has seen
+class SyncState(OutboxModel):
+    tracker_ip = peewee.CharField(unique=True)
+    version = peewee.IntegerField()
+
+
+# How quickly each other tracker answered /new_tracker, a running average in seconds
+# Used to decide which trackers to ask first for a copy of their database
+class TrackerLatency(OutboxModel):
+    tracker_ip = peewee.CharField(unique=True)
+    latency = peewee.FloatField()
+    updated = peewee.FloatField()   # unix time of the last round trip
+
+
+OUTBOX_MODELS = [OutboxEvent, OutboxCursor, SyncState, TrackerLatency]
+
+# Keep alives applied on this tracker that haven't gone into the log yet, by the ip they came from, in order
+# They are added a batch at a time (see maintenance.KeepAliveEventFlushThread), not one event per request
+queued_keep_alives = {}
+queued_keep_alives_lock = Lock()
+
+
+# Every call checks a connection out for just the one operation, the outbox is written from request
+# threads and read from broadcaster threads
+def load_outbox(outbox_path):
+    database = PooledSqliteDatabase(
+        str(outbox_path),
+        pragmas=constants.DB_PRAGMAS,
+        max_connections=constants.DB_MAX_CONNECTIONS,
+        stale_timeout=constants.DB_STALE_TIMEOUT,
+        timeout=constants.DB_POOL_WAIT_TIMEOUT,
+        check_same_thread=False,
+    )
+    outbox_db.initialize(database)
+
+    with outbox_db:
+        outbox_db.create_tables(OUTBOX_MODELS)
+
+
+def close_outbox():
+    outbox_db.close_all()
+
+
+# Adds an event to the end of the log, returns its seq
+def append(event):
+    with outbox_db:
+        return OutboxEvent.insert(created=time.time(), event=json.dumps(event)).execute()
+
+
+# Queues keep alives from event_ip to be added to the log with the next batch
+def queue_keep_alives(event_ip, keep_alives):
+    with queued_keep_alives_lock:
+        queued_keep_alives.setdefault(event_ip, []).extend(keep_alives)
+
+
+# Returns the queued keep alives as a dict of event ip: keep alives, and empties the queue
+def take_queued_keep_alives():
+    global queued_keep_alives
+    with queued_keep_alives_lock:
+        (taken, queued_keep_alives) = (queued_keep_alives, {})
+
+    return taken
+
+
+# The seq of the last event ever appended, or 0 if there never was one
+def last_seq():
+    with outbox_db:
+        return _last_seq()
+
+
+def _last_seq():
+    cursor = outbox_db.execute_sql(
+        "SELECT seq FROM sqlite_sequence WHERE name = ?",
+        (OutboxEvent._meta.table_name,),
+    )
+    row = cursor.fetchone()
+
+    return 0 if row is None else row[0]
+
+
+# Starts tracking a tracker, returns the seq of the last event it got
+# A tracker that already has a cursor keeps it, so events it missed while this tracker was down get replayed
+def add_destination(tracker_ip):
+    with outbox_db:
+        OutboxCursor.insert(tracker_ip=tracker_ip, acked_seq=_last_seq()).on_conflict_ignore().execute()
+        return OutboxCursor.get(OutboxCursor.tracker_ip == tracker_ip).acked_seq
+
+
+# Starts tracking a tracker from the given seq, or the current end of the log, returns the seq of the last event
+# Used for trackers that just got a copy of the database, which already has every earlier event in it
+def reset_destination(tracker_ip, acked_seq=None):
+    with outbox_db:
+        if(acked_seq is None):
+            acked_seq = _last_seq()
+        OutboxCursor.replace(tracker_ip=tracker_ip, acked_seq=acked_seq).execute()
+        return acked_seq
+
+
+def remove_destination(tracker_ip):
+    with outbox_db:
+        OutboxCursor.delete().where(OutboxCursor.tracker_ip == tracker_ip).execute()
+
+
+# Drops the cursors of every tracker not in tracker_ips, their events can then be compacted
+def prune_destinations(tracker_ips):
+    with outbox_db:
+        OutboxCursor.delete().where(OutboxCursor.tracker_ip.not_in(list(tracker_ips))).execute()
+
+
+# Moves a tracker's cursor forward, every event up to and including seq was delivered
+def ack(tracker_ip, seq):
+    with outbox_db:
+        OutboxCursor.update(acked_seq=seq).where(OutboxCursor.tracker_ip == tracker_ip).execute()
+
+
+# Returns up to limit (seq, created, event) tuples for the events after after_seq, oldest first
+def read_batch(after_seq, limit):
+    with outbox_db:
+        query = (OutboxEvent
+                 .select(OutboxEvent.seq, OutboxEvent.created, OutboxEvent.event)
+                 .where(OutboxEvent.seq > after_seq)
+                 .order_by(OutboxEvent.seq)
+                 .limit(limit)
+                 .tuples())
+
+        return [(seq, created, json.loads(event)) for (seq, created, event) in query]
+
+
+# The number of events after after_seq
+def pending_count(after_seq):
+    with outbox_db:
+        return OutboxEvent.select().where(OutboxEvent.seq > after_seq).count()
+
+
+# Returns the events after version as sync events, each with its own version, for a tracker catching up
+# Returns None if the tracker has to get a full copy of the database instead, because some of the events
+# were already compacted away, there are more than max_events of them, or the version isn't from this log
+def events_since(version, max_events):
+    with outbox_db:
+        last_seq = _last_seq()
+        if(version > last_seq or last_seq - version > max_events):
+            return None
+
+        oldest_kept = OutboxEvent.select(fn.MIN(OutboxEvent.seq)).scalar()
+        if(version < last_seq and (oldest_kept is None or oldest_kept > version + 1)):
+            return None
+
+        query = (OutboxEvent
+                 .select(OutboxEvent.seq, OutboxEvent.event)
+                 .where(OutboxEvent.seq > version)
+                 .order_by(OutboxEvent.seq)
+                 .tuples())
+
+        return [dict(json.loads(event), version=seq) for (seq, event) in query]
+
+
+# Deletes the events every tracker has gotten that are older than the retention period
+# Returns how many were deleted
+def compact():
+    with outbox_db:
+        oldest_needed = OutboxCursor.select(fn.MIN(OutboxCursor.acked_seq)).scalar()
+        if(oldest_needed is None):
+            oldest_needed = _last_seq()
+
+        return (OutboxEvent
+                .delete()
+                .where((OutboxEvent.seq <= oldest_needed)
+                       & (OutboxEvent.created < time.time() - constants.OUTBOX_RETENTION))
+                .execute())
+
+
+# Records that this tracker has seen another tracker's change log up to version
+def record_sync_version(tracker_ip, version):
+    with outbox_db:
+        (SyncState
+         .insert(tracker_ip=tracker_ip, version=version)
+         .on_conflict(
+             conflict_target=[SyncState.tracker_ip],
+             update={SyncState.version: fn.MAX(SyncState.version, EXCLUDED.version)},
+         )
+         .execute())
+
+
+# The latest version of another tracker's change log this tracker has seen, or None
+def sync_version(tracker_ip):
+    with outbox_db:
+        state = SyncState.get_or_none(SyncState.tracker_ip == tracker_ip)
+        return None if state is None else state.version
+
+
+# Forgets every version this tracker has seen, for when its database gets replaced
+def forget_sync_versions():
+    with outbox_db:
+        SyncState.delete().execute()
+
+
+# Adds a /new_tracker round trip (or a timeout) to a tracker's latency average
+def record_latency(tracker_ip, seconds):
+    weight = constants.BOOTSTRAP_LATENCY_WEIGHT
+    with outbox_db:
+        (TrackerLatency
+         .insert(tracker_ip=tracker_ip, latency=seconds, updated=time.time())
+         .on_conflict(
+             conflict_target=[TrackerLatency.tracker_ip],
+             update={
+                 TrackerLatency.latency: TrackerLatency.latency * (1 - weight) + EXCLUDED.latency * weight,
+                 TrackerLatency.updated: EXCLUDED.updated,
+             },
+         )
+         .execute())
+
+
+# Returns the tracker ips sorted by their latency average, quickest first
+# Trackers that were never asked keep their order and go after the rest
+def order_by_latency(tracker_ips):
+    with outbox_db:
+        latencies = dict(TrackerLatency
+                         .select(TrackerLatency.tracker_ip, TrackerLatency.latency)
+                         .where(TrackerLatency.tracker_ip.in_(list(tracker_ips)))
+                         .tuples())
+
+    return sorted(tracker_ips, key=lambda ip: (ip not in latencies, latencies.get(ip, 0)))
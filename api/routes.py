@@ -1,17 +1,25 @@
+import json
 import sys
 from traceback import print_exc
 
-from api import app, models, schemas
+from api import app, cache, constants, models, outbox, schemas, sync
 from api.event_broadcaster import EventBroadcaster
-from flask import jsonify, request
+from flask import jsonify, request, Response
 from jsonschema import FormatChecker, validate, ValidationError
 from peewee import DoesNotExist
 
 broadcaster = EventBroadcaster()
 
+# Media type a client can Accept to get compact chunk lists from /file and /file_by_hash (same as ?chunks=compact)
+COMPACT_CHUNKS_MIMETYPE = "application/vnd.p2pflix.compact-chunks+json"
+
 # Gets the list of files the tracker knows about
 # --- INPUT ---
-# Nothing
+# Nothing, or any of the optional paging query parameters:
+#   limit=<max files per page, at most FILE_LIST_MAX_LIMIT and FILE_LIST_MAX_LIMIT if not given>,
+#   after=<next_cursor of the previous page>,
+#   sort=id|name|active_peers, min_active_peers=<minimum active peers>
+# e.g. /file_list?limit=100&sort=active_peers
 # --- OUTPUT ---
 # Returns a JSON blob of the form:
 '''
@@ -25,7 +33,8 @@ broadcaster = EventBroadcaster()
             "active_peers": <number of recently keepalived peer>
         },
         ...
-    ]
+    ],
+    "next_cursor": <id to pass as after for the next page, or null> # only when paging
 }
 '''
 # --- ON ERROR ---
@@ -38,9 +47,35 @@ broadcaster = EventBroadcaster()
 '''
 @app.route('/file_list', methods=['GET'])
 def get_file_list():
-    # pull the list of file ids and names from db and convert to json
+    success = True
 
-    file_list_response = models.get_file_list()
+    try:
+        # query parameters arrive as strings, convert the numeric ones before validating
+        request_args = request.args.to_dict()
+        for arg in ("limit", "after", "min_active_peers"):
+            if arg in request_args and request_args[arg].lstrip("-").isdigit():
+                request_args[arg] = int(request_args[arg])
+
+        validate(request_args, schemas.FILE_LIST_SCHEMA)
+
+        # a page is never bigger than the largest limit, even if no limit was given
+        if request_args and "limit" not in request_args:
+            request_args["limit"] = constants.FILE_LIST_MAX_LIMIT
+
+        # pull the list of file ids and names from db and convert to json
+        file_list_response = models.get_file_list(**request_args)
+    except ValidationError as e:
+        error = str(e)
+        success = False
+    except Exception as e:
+        error = str(e)
+        success = False
+
+    if(not success):
+        file_list_response = {
+            "success": success,
+            "error": error,
+        }
 
     return jsonify(file_list_response)
 
@@ -51,6 +86,7 @@ def get_file_list():
 # Gets the information about a specific file id
 # --- INPUT ---
 # The file's id (as known by the tracker) via the url
+# Optionally chunks=full|compact as a query parameter, or an Accept header of COMPACT_CHUNKS_MIMETYPE for compact
 # --- OUTPUT ---
 # Returns a JSON blob of the form:
 '''
@@ -58,6 +94,7 @@ def get_file_list():
     "success": true,
     "name": "<file name>",
     "file_hash": "<hash of the full file>",
+    "manifest_digest": "<digest of the chunk list, see /add_file>",
     "peers": [
         {"ip": "<peer's ip>"},
         ...
@@ -72,6 +109,14 @@ def get_file_list():
     ]
 }
 '''
+# or with compact chunks, one array per chunk field, in chunk id order:
+'''
+    "chunks": {
+        "ids": [<chunk id for sequencing>, ...],
+        "names": ["<chunk filename>", ...],
+        "hashes": ["<hash of chunk>", ...]
+    }
+'''
 # --- ON ERROR ---
 # Returns a JSON blob in the form:
 '''
@@ -82,11 +127,19 @@ def get_file_list():
 '''
 @app.route('/file/<file_id>', methods=['GET'])
 def get_file(file_id):
+    try:
+        compact = wants_compact_chunks()
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e),
+        })
+
     # pull the file metadata from the db (name, list of peers, list of chunks, etc)
 
-    get_file_response = models.get_file(file_id)
+    get_file_response = models.get_file(file_id, compact)
 
-    return jsonify(get_file_response)
+    return file_response(get_file_response, compact)
 
 
 # TODO: consider giving the chunk an id as well to make the chunk order clear
@@ -94,6 +147,7 @@ def get_file(file_id):
 # Gets the information about a specific file hash
 # --- INPUT ---
 # The file's id (as known by the tracker) via the url
+# Optionally chunks=full|compact as a query parameter, or an Accept header of COMPACT_CHUNKS_MIMETYPE for compact
 # --- OUTPUT ---
 # Returns a JSON blob of the form:
 '''
@@ -101,6 +155,7 @@ def get_file(file_id):
     "success": true,
     "name": "<file name>",
     "file_hash": "<hash of the full file>",
+    "manifest_digest": "<digest of the chunk list, see /add_file>",
     "peers": [
         {"ip": "<peer's ip>"},
         ...
@@ -115,6 +170,14 @@ def get_file(file_id):
     ]
 }
 '''
+# or with compact chunks, one array per chunk field, in chunk id order:
+'''
+    "chunks": {
+        "ids": [<chunk id for sequencing>, ...],
+        "names": ["<chunk filename>", ...],
+        "hashes": ["<hash of chunk>", ...]
+    }
+'''
 # --- ON ERROR ---
 # Returns a JSON blob in the form:
 '''
@@ -125,11 +188,140 @@ def get_file(file_id):
 '''
 @app.route('/file_by_hash/<file_full_hash>', methods=['GET'])
 def get_file_by_hash(file_full_hash):
+    try:
+        compact = wants_compact_chunks()
+    except ValidationError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e),
+        })
+
     # pull the file metadata from the db (name, list of peers, list of chunks, etc)
 
-    get_file_by_hash_response = models.get_file_by_hash(file_full_hash)
+    get_file_by_hash_response = models.get_file_by_hash(file_full_hash, compact)
+
+    return file_response(get_file_by_hash_response, compact)
+
+
+# returns true if a /file or /file_by_hash request asked for compact chunks
+# a chunks query parameter wins over the Accept header
+def wants_compact_chunks():
+    validate(request.args.to_dict(), schemas.FILE_SCHEMA)
+    if "chunks" in request.args:
+        return request.args["chunks"] == "compact"
+
+    return request.accept_mimetypes.best_match(["application/json", COMPACT_CHUNKS_MIMETYPE]) == \
+        COMPACT_CHUNKS_MIMETYPE
+
+
+# returns a /file or /file_by_hash response
+# compact chunks are stored encoded, they are put into the response as they are instead of being encoded again
+def file_response(get_file_response, compact):
+    if not compact or not get_file_response["success"]:
+        response = jsonify(get_file_response)
+    else:
+        response_fields = {key: value for (key, value) in get_file_response.items() if key != "chunks"}
+        body = json.dumps(response_fields, separators=(",", ":"))
+        body = body[:-1] + ',"chunks":' + get_file_response["chunks"] + "}"
+        response = Response(body, mimetype=COMPACT_CHUNKS_MIMETYPE)
+
+    # the chunk format can be chosen by the Accept header, so caches have to tell the two apart
+    response.vary.add("Accept")
+    return response
+
+
+# Gets a window of a file's chunks, along with the file's data and peers as in /file
+# For clients that only need some of the chunks, e.g. the first ones to start streaming a video
+# --- INPUT ---
+# The file's id (as known by the tracker) via the url, and any of the optional query parameters:
+#   from=<first chunk id>, to=<chunk id to stop before>, limit=<max chunks, at most CHUNK_RANGE_MAX_SIZE>
+# e.g. /file/2/chunks?from=0&to=50
+# --- OUTPUT ---
+# Returns a JSON blob of the form:
+'''
+{
+    "success": true,
+    "name": "<file name>",
+    "full_hash": "<hash of the full file>",
+    "manifest_digest": "<digest of the whole chunk list, see /add_file>",
+    "peers": [
+        {"ip": "<peer's ip>"},
+        ...
+    ],
+    "chunks": [
+        {
+            "id": <chunk id for sequencing>,
+            "name": "<chunk filename>",
+            "chunk_hash": "<hash of chunk>"
+        },
+        ...
+    ],
+    "next_from": <chunk id to pass as from for the rest of the window, or null if this is all of it>
+}
+'''
+# --- ON ERROR ---
+# Returns a JSON blob in the form:
+'''
+{
+    "success" : false,
+    "error" : "<error reason>",
+}
+'''
+@app.route('/file/<file_id>/chunks', methods=['GET'])
+def get_file_chunks(file_id):
+    try:
+        get_file_chunks_response = models.get_file_chunks(file_id, **chunk_range_args())
+    except ValidationError as e:
+        get_file_chunks_response = {
+            "success": False,
+            "error": str(e),
+        }
+
+    return jsonify(get_file_chunks_response)
+
+
+# Gets a window of a file's chunks by the file's hash, see /file/<file_id>/chunks
+# --- INPUT ---
+# The file's full hash via the url, and the same optional query parameters as /file/<file_id>/chunks
+# e.g. /file_by_hash/<file_full_hash>/chunks?from=0&to=50
+# --- OUTPUT ---
+# The same as /file/<file_id>/chunks
+# --- ON ERROR ---
+# Returns a JSON blob in the form:
+'''
+{
+    "success" : false,
+    "error" : "<error reason>",
+}
+'''
+@app.route('/file_by_hash/<file_full_hash>/chunks', methods=['GET'])
+def get_file_chunks_by_hash(file_full_hash):
+    try:
+        get_file_chunks_response = models.get_file_chunks_by_hash(file_full_hash, **chunk_range_args())
+    except ValidationError as e:
+        get_file_chunks_response = {
+            "success": False,
+            "error": str(e),
+        }
+
+    return jsonify(get_file_chunks_response)
 
-    return jsonify(get_file_by_hash_response)
+
+# returns the query parameters of a chunk range request as get_file_chunks arguments
+def chunk_range_args():
+    # query parameters arrive as strings, convert the numeric ones before validating
+    request_args = request.args.to_dict()
+    for arg in ("from", "to", "limit"):
+        if arg in request_args and request_args[arg].lstrip("-").isdigit():
+            request_args[arg] = int(request_args[arg])
+
+    validate(request_args, schemas.CHUNK_RANGE_SCHEMA)
+
+    return {
+        "chunk_from": request_args.get("from"),
+        "chunk_to": request_args.get("to"),
+        "limit": request_args.get("limit"),
+    }
 
 
 # Gets the list of other trackers the tracker knows about
@@ -205,6 +397,17 @@ def get_tracker_list():
     "seq_number": <client's current sequence number/sequence number of this message>
 }
 '''
+# or, if the tracker already has the file, its manifest digest in place of the chunks:
+# the sha256 (as hex) of [[<id>, "<name>", "<hash>"], ...] in id order, as JSON with no whitespace, utf-8 encoded
+'''
+{
+    "name": "<file name>",
+    "full_hash": "<hash of full file>",
+    "manifest_digest": "<manifest digest of the file's chunks>",
+    "guid": "<client's guid>",
+    "seq_number": <client's current sequence number/sequence number of this message>
+}
+'''
 # --- OUTPUT ---
 # Returns a JSON blob in the form:
 '''
@@ -239,7 +442,7 @@ def add_file():
 
             if add_file_response["success"]:
                 request_data["guid"] = str(add_file_response["guid"])
-                broadcaster.new_event("add_file", requester_ip, request_data)
+                broadcaster.new_event("add_file", requester_ip, models.add_file_sync_data(request_data))
         except ValidationError as e:
             error = str(e)
             success = False
@@ -256,6 +459,104 @@ def add_file():
     return jsonify(add_file_response)
 
 
+# adds several files at once in the given order, for peers coming online with a library of files
+# takes a json array of /add_file requests, each one succeeds or fails on its own
+# requests without a guid are for the same new peer, which is created by the first of them
+# client ip collected from request
+# --- INPUT ---
+# Expects JSON blob in the form:
+'''
+[
+    {
+        "name": "<file name>",
+        "full_hash": "<hash of full file>",
+        "chunks": [ ... ],
+        "guid": "<client's guid>",
+        "seq_number": <client's sequence number for this file>
+    },
+    ...
+]
+'''
+# --- OUTPUT ---
+# Returns a JSON blob in the form: (one /add_file response per file, in order)
+'''
+{
+    "success": true,
+    "results": [
+        {"success": true, "file_id": <file's id>, "guid": "<client's guid>"},
+        {"success": false, "error": "<error reason>"},
+        ...
+    ]
+}
+'''
+# --- ON ERROR ---
+# Returns a JSON blob in the form:
+'''
+{
+    "success": false,
+    "error": "<error reason>"
+}
+'''
+@app.route('/add_files', methods=['POST'])
+def add_files():
+    success = True
+
+    request_data = request.get_json(silent=True)
+    requester_ip = request.remote_addr
+
+    if(request_data is None):
+        error = "Request is not JSON"
+        success = False
+    else:
+        try:
+            validate(request_data, schemas.ADD_FILES_SCHEMA)
+
+            # files that don't fit the schema get an error, the rest are added together
+            results = [None] * len(request_data)
+            valid_files = []
+            for (index, add_file_data) in enumerate(request_data):
+                try:
+                    schemas.ADD_FILE_VALIDATOR.validate(add_file_data)
+                    valid_files.append((index, add_file_data))
+                except ValidationError as e:
+                    results[index] = {
+                        "success": False,
+                        "error": str(e),
+                    }
+
+            responses = models.add_files([add_file_data for (_, add_file_data) in valid_files], requester_ip)
+            for ((index, _), response) in zip(valid_files, responses):
+                results[index] = response
+
+            # the other trackers get every file that was added in one event
+            added_files = [
+                models.add_file_sync_data(dict(add_file_data, guid=str(response["guid"])))
+                for ((_, add_file_data), response) in zip(valid_files, responses)
+                if response["success"]
+            ]
+            if added_files:
+                broadcaster.new_event("add_files", requester_ip, {"files": added_files})
+
+            add_files_response = {
+                "success": success,
+                "results": results,
+            }
+        except ValidationError as e:
+            error = str(e)
+            success = False
+        except Exception as e:
+            error = str(e)
+            success = False
+
+    if(not success):
+        add_files_response = {
+            "success": success,
+            "error": error,
+        }
+
+    return jsonify(add_files_response)
+
+
 # tells the server you're still there hosting
 # takes a json request with the clients guid as an argument
 # client ip collected from request
@@ -297,8 +598,9 @@ def keep_alive():
             validate(request_data, schemas.KEEP_ALIVE_SCHEMA)
             keep_alive_response = models.keep_alive(request_data, requester_ip)
 
+            # goes to the other trackers with the next batch of keep alives, see KeepAliveEventFlushThread
             if keep_alive_response["success"]:
-                broadcaster.new_event("keep_alive", requester_ip, request_data)
+                outbox.queue_keep_alives(requester_ip, [request_data])
         except ValidationError as e:
             error = str(e)
             success = False
@@ -315,6 +617,100 @@ def keep_alive():
     return jsonify(keep_alive_response)
 
 
+# tells the server several peers are still there hosting, for hosts running many peers behind one ip
+# takes a json array of /keep_alive requests, each one succeeds or fails on its own
+# client ip collected from request, and used for every peer in the batch
+# --- INPUT ---
+# Expects JSON blob in the form:
+'''
+[
+    {
+        "guid": "<a client's guid>",
+        "ka_seq_number": <that client's keepalive sequence number>    #integer
+    },
+    ...
+]
+'''
+# --- OUTPUT ---
+# Returns a JSON blob in the form: (one result per keep alive, in order)
+'''
+{
+    "success": true,
+    "results": [
+        {"success": true},
+        {"success": false, "error": "<error reason>"},
+        ...
+    ]
+}
+'''
+# --- ON ERROR ---
+# Returns a JSON blob in the form:
+'''
+{
+    "success": false,
+    "error": "<error reason>"
+}
+'''
+@app.route('/keep_alive_batch', methods=['PUT'])
+def keep_alive_batch():
+    success = True
+
+    request_data = request.get_json(silent=True)
+    requester_ip = request.remote_addr
+
+    if(request_data is None):
+        error = "Request is not JSON"
+        success = False
+    else:
+        try:
+            validate(request_data, schemas.KEEP_ALIVE_BATCH_SCHEMA)
+
+            # keep alives that don't fit the schema get an error, the rest are applied together
+            results = [None] * len(request_data)
+            valid_keep_alives = []
+            for (index, keep_alive_data) in enumerate(request_data):
+                try:
+                    schemas.KEEP_ALIVE_VALIDATOR.validate(keep_alive_data)
+                    valid_keep_alives.append((index, keep_alive_data))
+                except ValidationError as e:
+                    results[index] = {
+                        "success": False,
+                        "error": str(e),
+                    }
+
+            responses = models.keep_alive_batch([keep_alive_data for (_, keep_alive_data) in valid_keep_alives],
+                                                requester_ip)
+            for ((index, _), response) in zip(valid_keep_alives, responses):
+                results[index] = response
+
+            # the other trackers get every keep alive that was applied with the next batch of keep alives
+            applied_keep_alives = [
+                keep_alive_data for ((_, keep_alive_data), response) in zip(valid_keep_alives, responses)
+                if response["success"]
+            ]
+            if applied_keep_alives:
+                outbox.queue_keep_alives(requester_ip, applied_keep_alives)
+
+            keep_alive_batch_response = {
+                "success": success,
+                "results": results,
+            }
+        except ValidationError as e:
+            error = str(e)
+            success = False
+        except Exception as e:
+            error = str(e)
+            success = False
+
+    if(not success):
+        keep_alive_batch_response = {
+            "success": success,
+            "error": error,
+        }
+
+    return jsonify(keep_alive_batch_response)
+
+
 # removes you as a host for this file
 # takes a json req with the client's guid and the file id as args
 # --- INPUT ---
@@ -469,19 +865,27 @@ def peer_status(peer_guid):
 
 
 # updates the tracker's db based on a new operation from another tracker
-# expects JSON blob of information regarding the event
+# expects JSON blob of information regarding the event, or an ordered array of them
 # blob contains event type and a data dictionary that is specific to the event type
 # see the different event's original method (e.g. add_file) for my detail on the data portion
 # If the tracker sending this event does not exist in the DB, the event is ignored
+# An array of events is applied in order in a single transaction, with a result for each event
 # --- INPUT ---
 # Expects JSON blob in the form:
 '''
 {
-    "event": "add_file|keep_alive|deregister_file_by_hash|new_tracker",
+    "event": "add_file|add_files|keep_alive|keep_alive_batch|deregister_file_by_hash|reap_peer|new_tracker",
     "event_ip": "ip address (e.g. 1.2.3.4)",
     "data": { ... }
 }
 '''
+# or
+'''
+[
+    {"event": ..., "event_ip": ..., "data": { ... }},
+    ...
+]
+'''
 # --- OUTPUT ---
 # Returns a JSON blob in the form:
 '''
@@ -489,6 +893,17 @@ def peer_status(peer_guid):
     "success": true
 }
 '''
+# or for an array of events
+'''
+{
+    "success": true,
+    "results": [
+        {"success": true},
+        {"success": false, "error": "<error reason>"},
+        ...
+    ]
+}
+'''
 # --- ON ERROR ---
 # Returns a JSON blob in the form:
 '''
@@ -516,6 +931,9 @@ def tracker_sync():
             "error": "Tracker not in tracker list",
         })
 
+    if isinstance(request_data, list):
+        return jsonify(tracker_sync_batch(request_data, requester_ip))
+
     try:
         validate(request_data, schemas.TRACKER_SYNC_SCHEMA, format_checker=FormatChecker())
     except ValidationError as e:
@@ -524,54 +942,13 @@ def tracker_sync():
             "success": False,
         })
 
-    event = request_data["event"]
-    event_ip = request_data["event_ip"]
-    event_data = request_data["data"]
-
-    # By default, don't rebroadcast and respond with success
-    rebroadcast = False
+    # By default, respond with success
     sync_response = {"success": True}
 
     try:
-        if event == "new_tracker":
-            # If the tracker doesn't exist, rebroadcast and add it
-            if not models.tracker_ip_exists(event_ip):
-                tracker = models.add_tracker(event_ip)
-
-                # Can't just set rebroadcast here since we need to broadcast before adding the tracker
-                broadcaster.new_event(event, event_ip, event_data)
-                broadcaster.new_tracker(tracker)
-
-        elif event == "add_file":
-            peer_guid = event_data["guid"]
-            models.ensure_peer_exists(event_ip, peer_guid, event_data["seq_number"])
-
-            # If the sequence number is new, apply and rebroadcast
-            if event_data["seq_number"] >= models.peer_expected_seq(peer_guid):
-                models.add_file(event_data, event_ip)
-                rebroadcast = True
-
-        elif event == "keep_alive":
-            peer_guid = event_data["guid"]
-            models.ensure_peer_exists(event_ip, peer_guid)
-
-            # If the keepalive sequence number is new, apply and rebroadcast
-            if event_data["ka_seq_number"] >= models.peer_expected_ka_seq(peer_guid):
-                models.keep_alive(event_data, event_ip)
-                rebroadcast = True
-
-        elif event == "deregister_file_by_hash":
-            peer_guid = event_data["guid"]
-            models.ensure_peer_exists(event_ip, peer_guid)
-
-            # If the sequence number is new, apply and rebroadcast
-            if event_data["seq_number"] >= models.peer_expected_seq(peer_guid):
-                models.deregister_file_by_hash(event_data, event_ip)
-                rebroadcast = True
-
-        # Only rebroadcast if specified
-        if rebroadcast:
-            broadcaster.new_event(event, event_ip, event_data)
+        (rebroadcast, new_tracker) = sync.apply_event(request_data)
+        broadcast_sync_event(request_data, rebroadcast, new_tracker)
+        sync.record_version(requester_ip, [request_data])
     except Exception:
         print("Recieved exception during tracker sync", sys.stderr)
         print_exc()
@@ -584,20 +961,116 @@ def tracker_sync():
     return jsonify(sync_response)
 
 
-# adds a new tracker to the tracker list and responds with a full database dump
+# Applies an array of tracker sync events in order inside one transaction
+# Each event gets its own savepoint, so one bad event doesn't undo the others
+# Rebroadcasting waits until the whole batch is committed
+def tracker_sync_batch(sync_events, requester_ip):
+    try:
+        validate(sync_events, schemas.TRACKER_SYNC_BATCH_SCHEMA)
+    except ValidationError as e:
+        return {
+            "error": str(e),
+            "success": False,
+        }
+
+    results = []
+    applied_events = []
+
+    try:
+        with models.db.atomic():
+            for sync_event in sync_events:
+                try:
+                    validate(sync_event, schemas.TRACKER_SYNC_SCHEMA, format_checker=FormatChecker())
+
+                    with models.db.atomic():
+                        (rebroadcast, new_tracker) = sync.apply_event(sync_event)
+
+                    applied_events.append((sync_event, rebroadcast, new_tracker))
+                    results.append({"success": True})
+                except ValidationError as e:
+                    results.append({
+                        "error": str(e),
+                        "success": False,
+                    })
+                except Exception:
+                    print("Recieved exception during tracker sync", sys.stderr)
+                    print_exc()
+
+                    results.append({
+                        "error": "Unexpected error",
+                        "success": False,
+                    })
+    except Exception:
+        print("Recieved exception during tracker sync", sys.stderr)
+        print_exc()
+
+        return {
+            "error": "Unexpected error",
+            "success": False,
+        }
+
+    for (sync_event, rebroadcast, new_tracker) in applied_events:
+        broadcast_sync_event(sync_event, rebroadcast, new_tracker)
+
+    # Events that were rejected won't be any better the next time around, so they count as seen too
+    sync.record_version(requester_ip, sync_events)
+
+    return {
+        "success": True,
+        "results": results,
+    }
+
+
+# Passes an applied sync event on to the other trackers (see sync.apply_event)
+def broadcast_sync_event(sync_event, rebroadcast, new_tracker):
+    if new_tracker is not None:
+        # Can't just rebroadcast here since we need to broadcast before adding the tracker
+        broadcaster.new_event(sync_event["event"], sync_event["event_ip"], sync_event["data"])
+        broadcaster.new_tracker(new_tracker)
+
+    # Only rebroadcast if specified
+    if rebroadcast:
+        broadcaster.new_event(sync_event["event"], sync_event["event_ip"], sync_event["data"])
+
+
+# adds a new tracker to the tracker list and responds with a full database dump, or just the changes
+# since the version of this tracker's change log the new tracker last saw if they are still kept
 # --- INPUT ---
-# Expects JSON blob in the form: (empty)
+# Expects JSON blob in the form: (empty, or with the version and/or the snapshot flag)
 '''
-{ }
+{
+    "since_version": <version>,
+    "snapshot": true
+}
 '''
 # --- OUTPUT ---
 # Returns a JSON blob in the form:
 '''
 {
     "success": true,
+    "version": <this tracker's change log version the dump is from>,
     "data": "... A full database dump"
 }
 '''
+# or, if a full dump is needed and snapshot was set, the dump is left out and streamed from /snapshot instead
+'''
+{
+    "success": true,
+    "version": <this tracker's change log version when the new tracker was added>,
+    "snapshot": "/snapshot"
+}
+'''
+# or, if since_version was given and the changes since then are still kept
+'''
+{
+    "success": true,
+    "version": <this tracker's change log version the events go up to>,
+    "events": [
+        {"event": ..., "event_ip": ..., "data": { ... }, "version": <version>},
+        ...
+    ]
+}
+'''
 # --- ON ERROR ---
 # Returns a JSON blob in the form:
 '''
@@ -623,19 +1096,15 @@ def new_tracker():
             if models.tracker_ip_exists(requester_ip):
                 # If the tracker exists, remove it before dumping the DB and then re-add it but don't broadcast
                 models.remove_tracker_by_ip(requester_ip)
-                data_dump = models.new_tracker_dump()
+                new_tracker_response = tracker_catch_up(request_data, requester_ip)
                 models.add_tracker(requester_ip)
             else:
-                # If the tracker doesn't exist, dump the DB before adding it and then broadcast
-                data_dump = models.new_tracker_dump()
+                # If the tracker doesn't exist, broadcast, then dump the DB before adding it
+                # Broadcasting first keeps the new tracker's own event out of what it gets sent
                 broadcaster.new_event("new_tracker", requester_ip, {})
+                new_tracker_response = tracker_catch_up(request_data, requester_ip)
                 new_tracker = models.add_tracker(requester_ip)
-                broadcaster.new_tracker(new_tracker)
-
-            new_tracker_response = {
-                "success": True,
-                "data": data_dump,
-            }
+                broadcaster.new_tracker(new_tracker, since=new_tracker_response["version"])
         except ValidationError as e:
             error = str(e)
             success = False
@@ -650,3 +1119,135 @@ def new_tracker():
         }
 
     return jsonify(new_tracker_response)
+
+
+# Builds the successful /new_tracker response, with the changes since the requested version if they are
+# still kept and a full database dump otherwise
+# The version is read first, so anything that changes during the dump gets sent again afterwards
+def tracker_catch_up(request_data, requester_ip):
+    version = outbox.last_seq()
+
+    if "since_version" in request_data:
+        events = outbox.events_since(request_data["since_version"], constants.DELTA_SYNC_MAX_EVENTS)
+        if events is not None:
+            return {
+                "success": True,
+                "version": events[-1]["version"] if events else request_data["since_version"],
+                # A tracker can't be told about itself
+                "events": [
+                    event for event in events
+                    if not (event["event"] == "new_tracker" and event["event_ip"] == requester_ip)
+                ],
+            }
+
+    if request_data.get("snapshot", False):
+        # The requester streams the dump from /snapshot itself
+        return {
+            "success": True,
+            "version": version,
+            "snapshot": "/snapshot",
+        }
+
+    return {
+        "success": True,
+        "version": version,
+        "data": models.new_tracker_dump(),
+    }
+
+
+# Streams a full copy of the database for a tracker that registered with /new_tracker
+# --- INPUT ---
+# Nothing
+# --- OUTPUT ---
+# Returns the sqlite database file, gzip compressed (application/gzip)
+# The X-Snapshot-SHA256 header holds the hex SHA-256 of the uncompressed file and the X-Snapshot-Version header
+# holds this tracker's change log version the copy is from
+# The requester's own tracker list entry is left out of the copy
+# --- ON ERROR ---
+# Returns a JSON blob in the form: (only trackers in the tracker list can ask for a snapshot)
+'''
+{
+    "success": false,
+    "error": "<error reason>"
+}
+'''
+@app.route('/snapshot', methods=['GET'])
+def snapshot():
+    requester_ip = request.remote_addr
+
+    if not models.tracker_ip_exists(requester_ip):
+        return jsonify({
+            "success": False,
+            "error": "Tracker not in tracker list",
+        })
+
+    snapshot_path = None
+    try:
+        version = outbox.last_seq()
+        (snapshot_path, checksum) = models.create_snapshot(exclude_tracker_ip=requester_ip)
+
+        response = Response(
+            models.stream_snapshot(snapshot_path),
+            mimetype="application/gzip",
+            headers={
+                "X-Snapshot-SHA256": checksum,
+                "X-Snapshot-Version": str(version),
+            },
+        )
+    except Exception as e:
+        # create_snapshot removes its own file if it fails, this covers anything that fails after it
+        if snapshot_path is not None:
+            models.remove_snapshot(snapshot_path)
+
+        return jsonify({
+            "success": False,
+            "error": str(e),
+        })
+
+    # The response is closed whether it was streamed or not, even if the requester went away before it started
+    response.call_on_close(lambda: models.remove_snapshot(snapshot_path))
+
+    return response
+
+
+# Gets statistics about the tracker's connections to other trackers and its response cache
+# --- INPUT ---
+# Nothing
+# --- OUTPUT ---
+# Returns a JSON blob of the form:
+'''
+{
+    "success": true,
+    "broadcast": {
+        "<tracker id>": {
+            "ip": "<tracker's ip>",
+            "queued_events": <events waiting to be sent>,
+            "failures": <failed sends>,
+            "events_sent": <events delivered>,
+            "propagation_latency_avg": <average seconds from an event being queued to being delivered>,
+            "propagation_latency_max": <longest seconds from an event being queued to being delivered>,
+            "requests": <requests sent>,
+            "connections_opened": <connections opened for those requests>,
+            "connections_reused": <requests sent over an already open connection>
+        },
+        ...
+    },
+    "cache": {
+        "file_hits": <get_file/get_file_by_hash responses served from the cache>,
+        "file_misses": <get_file/get_file_by_hash responses read from the database>,
+        "chunk_hits": <chunk lists served from the cache>,
+        "chunk_misses": <chunk lists read from the database>,
+        "files_cached": <responses in the cache>,
+        "chunks_cached": <chunk lists in the cache>
+    }
+}
+'''
+@app.route('/stats', methods=['GET'])
+def stats():
+    stats_response = {
+        "success": True,
+        "broadcast": broadcaster.stats(),
+        "cache": cache.stats(),
+    }
+
+    return jsonify(stats_response)
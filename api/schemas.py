@@ -1,5 +1,8 @@
 from copy import deepcopy
 
+from api import constants
+from jsonschema.validators import validator_for
+
 # --- CHUNK SCHEMA ---
 # JSON schema for chunks within /add_file endpoint inputs
 # Example:
@@ -21,6 +24,73 @@ CHUNK_SCHEMA = {
     "additionalProperties": False,
 }
 
+# --- FILE_LIST SCHEMA ---
+# JSON schema for the (optional) /file_list query parameters, after integer conversion
+# The largest limit is constants.FILE_LIST_MAX_LIMIT, see set_file_list_max_limit
+# Example:
+'''
+{
+    "limit" : <max number of files in the page>,
+    "after" : <next_cursor from the previous page>,
+    "sort" : "id|name|active_peers",
+    "min_active_peers" : <only list files with at least this many active peers>
+}
+'''
+FILE_LIST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "limit": {"type": "integer", "minimum": 1, "maximum": constants.FILE_LIST_MAX_LIMIT},
+        "after": {"type": "integer"},
+        "sort": {"type": "string", "enum": ["id", "name", "active_peers"]},
+        "min_active_peers": {"type": "integer", "minimum": 0},
+    },
+    "additionalProperties": False,
+}
+
+
+# Sets the largest /file_list page, the schema is built before the config file is read
+def set_file_list_max_limit(max_limit):
+    constants.FILE_LIST_MAX_LIMIT = max_limit
+    FILE_LIST_SCHEMA["properties"]["limit"]["maximum"] = max_limit
+
+
+# --- FILE SCHEMA ---
+# JSON schema for the (optional) /file and /file_by_hash query parameters
+# Other query parameters (e.g. cache busters) are ignored, as they were before there were any
+# Example:
+'''
+{
+    "chunks" : "full|compact"
+}
+'''
+FILE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "chunks": {"type": "string", "enum": ["full", "compact"]},
+    },
+}
+
+# --- CHUNK_RANGE SCHEMA ---
+# JSON schema for the (optional) /file/<file_id>/chunks and /file_by_hash/<file_full_hash>/chunks query parameters,
+# after integer conversion
+# Example:
+'''
+{
+    "from" : <first chunk id in the window>,
+    "to" : <chunk id the window stops before>,
+    "limit" : <max number of chunks in the window>
+}
+'''
+CHUNK_RANGE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "from": {"type": "integer"},
+        "to": {"type": "integer"},
+        "limit": {"type": "integer", "minimum": 1, "maximum": constants.CHUNK_RANGE_MAX_SIZE},
+    },
+    "additionalProperties": False,
+}
+
 # --- ADD_FILE SCHEMA ---
 # JSON schema for /add_file endpoint inputs
 # Example:
@@ -40,6 +110,16 @@ CHUNK_SCHEMA = {
     "seq_number": <client's current sequence number/sequence number of this message>
 }
 '''
+# Or, for a file the tracker already has, the file's manifest digest instead of its chunks
+'''
+{
+    "name" : "<file name>",
+    "full_hash" : "<hash of full file>",
+    "manifest_digest" : "<manifest digest of the file's chunks>",
+    "guid" : "<client's guid>",
+    "seq_number": <client's current sequence number/sequence number of this message>
+}
+'''
 ADD_FILE_SCHEMA = {
     "type": "object",
     "properties": {
@@ -51,10 +131,15 @@ ADD_FILE_SCHEMA = {
             "uniqueItems": True,
             "items": CHUNK_SCHEMA,
         },
+        "manifest_digest": {"type": "string", "pattern": "^[0-9a-f]{64}$"},
         "guid": {"type": ["string", "null"]},
         "seq_number": {"type": "integer"},
     },
-    "required": ["name", "full_hash", "chunks", "guid", "seq_number"],
+    "required": ["name", "full_hash", "guid", "seq_number"],
+    "oneOf": [
+        {"required": ["chunks"]},
+        {"required": ["manifest_digest"]},
+    ],
     "additionalProperties": False,
 }
 
@@ -65,6 +150,52 @@ ADD_FILE_SCHEMA = {
 ADD_FILE_MANDATORY_GUID_SCHEMA = deepcopy(ADD_FILE_SCHEMA)
 ADD_FILE_MANDATORY_GUID_SCHEMA["properties"]["guid"]["type"] = "string"
 
+# Validates single files, for /add_files
+# validate() would check ADD_FILE_SCHEMA itself again for every file in the request
+ADD_FILE_VALIDATOR = validator_for(ADD_FILE_SCHEMA)(ADD_FILE_SCHEMA)
+
+# --- ADD_FILES SCHEMA ---
+# JSON schema for /add_files endpoint inputs, an ordered array of /add_file inputs
+# Each file is validated against ADD_FILE_SCHEMA on its own, so they get individual errors
+# Example:
+'''
+[
+    {"name": ..., "full_hash": ..., "chunks": [ ... ], "guid": ..., "seq_number": ...},
+    ...
+]
+'''
+ADD_FILES_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "maxItems": constants.ADD_FILES_MAX_SIZE,
+    "items": {"type": "object"},
+}
+
+# --- ADD_FILES_SYNC SCHEMA ---
+# JSON schema for the data of add_files tracker sync events, the files of an /add_files request that
+# were added, with their peer's guid filled in
+# Example:
+'''
+{
+    "files": [
+        {"name": ..., "full_hash": ..., "chunks": [ ... ], "guid": "<client's guid>", "seq_number": ...},
+        ...
+    ]
+}
+'''
+ADD_FILES_SYNC_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "files": {
+            "type": "array",
+            "minItems": 1,
+            "items": ADD_FILE_MANDATORY_GUID_SCHEMA,
+        },
+    },
+    "required": ["files"],
+    "additionalProperties": False,
+}
+
 # --- KEEP_ALIVE SCHEMA ---
 # JSON schema for /keep_alive endpoint inputs
 # Example:
@@ -84,6 +215,55 @@ KEEP_ALIVE_SCHEMA = {
 }
 
 
+# Validates single keep alives, for /keep_alive_batch
+# validate() would check KEEP_ALIVE_SCHEMA itself again for every keep alive in the batch
+KEEP_ALIVE_VALIDATOR = validator_for(KEEP_ALIVE_SCHEMA)(KEEP_ALIVE_SCHEMA)
+
+
+# --- KEEP_ALIVE_BATCH SCHEMA ---
+# JSON schema for /keep_alive_batch endpoint inputs, an array of /keep_alive inputs
+# Each keep alive is validated against KEEP_ALIVE_SCHEMA on its own, so they get individual errors
+# Example:
+'''
+[
+    {"guid": "<a client's guid>", "ka_seq_number": <that client's keepalive sequence number>},
+    ...
+]
+'''
+KEEP_ALIVE_BATCH_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "maxItems": constants.KEEP_ALIVE_BATCH_MAX_SIZE,
+    "items": {"type": "object"},
+}
+
+
+# --- KEEP_ALIVE_BATCH_SYNC SCHEMA ---
+# JSON schema for the data of keep_alive_batch tracker sync events, the keep alives of a /keep_alive_batch
+# request that were applied
+# Example:
+'''
+{
+    "keep_alives": [
+        {"guid": "<a client's guid>", "ka_seq_number": <that client's keepalive sequence number>},
+        ...
+    ]
+}
+'''
+KEEP_ALIVE_BATCH_SYNC_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "keep_alives": {
+            "type": "array",
+            "minItems": 1,
+            "items": KEEP_ALIVE_SCHEMA,
+        },
+    },
+    "required": ["keep_alives"],
+    "additionalProperties": False,
+}
+
+
 # --- DEREGISTER_FILE SCHEMA ---
 # JSON schema for /deregister_file endpoint inputs
 # Example:
@@ -128,11 +308,41 @@ DEREGISTER_FILE_BY_HASH_SCHEMA = {
 }
 
 
+# --- REAP_PEER SCHEMA ---
+# JSON schema for the data of reap_peer tracker sync events, sent when a tracker deletes an expired peer
+# Example:
+'''
+{
+    "guid" : "<the deleted peer's guid>"
+}
+'''
+REAP_PEER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "guid": {"type": "string"},
+    },
+    "required": ["guid"],
+    "additionalProperties": False,
+}
+
+
 # --- NEW_TRACKER SCHEMA ---
-# JSON schema for /deregister_file_by_hash endpoint inputs
-# Expects an empty json object
+# JSON schema for /new_tracker endpoint inputs
+# Expects an empty json object, or the version of this tracker's change log the requester last saw
+# and whether it will stream a full dump from /snapshot instead of getting it inline
+# Example:
+'''
+{
+    "since_version": <version>,
+    "snapshot": true
+}
+'''
 NEW_TRACKER_SCHEMA = {
     "type": "object",
+    "properties": {
+        "since_version": {"type": "integer", "minimum": 0},
+        "snapshot": {"type": "boolean"},
+    },
     "additionalProperties": False,
 }
 
@@ -142,9 +352,10 @@ NEW_TRACKER_SCHEMA = {
 # Example:
 '''
 {
-    "event": "add_file|keep_alive|deregister_file_by_hash|new_tracker",
+    "event": "add_file|add_files|keep_alive|keep_alive_batch|deregister_file_by_hash|reap_peer|new_tracker",
     "event_ip": "<ip for event>"
-    "data": { ... }
+    "data": { ... },
+    "version": <the sender's change log version for this event, optional>
 }
 '''
 TRACKER_SYNC_SCHEMA = {
@@ -152,13 +363,22 @@ TRACKER_SYNC_SCHEMA = {
     "properties": {
         "event": {
             "type": "string",
-            "enum": ["add_file", "keep_alive", "deregister_file_by_hash", "new_tracker"],
+            "enum": [
+                "add_file",
+                "add_files",
+                "keep_alive",
+                "keep_alive_batch",
+                "deregister_file_by_hash",
+                "reap_peer",
+                "new_tracker",
+            ],
         },
         "event_ip": {
             "type": "string",
             "format": "ipv4",
         },
         "data": {"type": "object"},
+        "version": {"type": "integer"},
     },
     "required": ["event", "event_ip", "data"],
     "additionalProperties": False,
@@ -171,6 +391,14 @@ TRACKER_SYNC_SCHEMA = {
                 "properties": {"data": ADD_FILE_MANDATORY_GUID_SCHEMA},
             },
         },
+        {
+            "if": {
+                "properties": {"event": {"const": "add_files"}},
+            },
+            "then": {
+                "properties": {"data": ADD_FILES_SYNC_SCHEMA},
+            },
+        },
         {
             "if": {
                 "properties": {"event": {"const": "keep_alive"}},
@@ -179,6 +407,14 @@ TRACKER_SYNC_SCHEMA = {
                 "properties": {"data": KEEP_ALIVE_SCHEMA},
             },
         },
+        {
+            "if": {
+                "properties": {"event": {"const": "keep_alive_batch"}},
+            },
+            "then": {
+                "properties": {"data": KEEP_ALIVE_BATCH_SYNC_SCHEMA},
+            },
+        },
         {
             "if": {
                 "properties": {"event": {"const": "deregister_file_by_hash"}},
@@ -187,6 +423,14 @@ TRACKER_SYNC_SCHEMA = {
                 "properties": {"data": DEREGISTER_FILE_BY_HASH_SCHEMA},
             },
         },
+        {
+            "if": {
+                "properties": {"event": {"const": "reap_peer"}},
+            },
+            "then": {
+                "properties": {"data": REAP_PEER_SCHEMA},
+            },
+        },
         {
             "if": {
                 "properties": {"event": {"const": "new_tracker"}},
@@ -199,3 +443,20 @@ TRACKER_SYNC_SCHEMA = {
         },
     ],
 }
+
+
+# --- TRACKER_SYNC_BATCH SCHEMA ---
+# JSON schema for an ordered array of /tracker_sync events
+# Each event is validated against TRACKER_SYNC_SCHEMA on its own, so they get individual errors
+# Example:
+'''
+[
+    {"event": ..., "event_ip": ..., "data": { ... }},
+    ...
+]
+'''
+TRACKER_SYNC_BATCH_SCHEMA = {
+    "type": "array",
+    "minItems": 1,
+    "items": {"type": "object"},
+}
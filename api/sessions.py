@@ -0,0 +1,40 @@
+from api import constants
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Creates a requests session that keeps its connections alive and reuses them between requests
+# Sessions are not thread safe, so each one should only be used by one thread at a time
+def new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=constants.HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+# The (connect, read) timeout to use for requests to other trackers
+def timeout():
+    return (constants.HTTP_CONNECT_TIMEOUT, constants.HTTP_READ_TIMEOUT)
+
+
+# Returns how many requests the session has made and how many connections it had to open for them
+def session_stats(session):
+    requests_sent = 0
+    connections_opened = 0
+
+    # The same adapter is mounted for both http and https, only count it once
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+
+    return {
+        "requests": requests_sent,
+        "connections_opened": connections_opened,
+        "connections_reused": requests_sent - connections_opened,
+    }
@@ -0,0 +1,132 @@
+import sys
+from traceback import print_exc
+
+from api import cache, models, outbox, schemas
+from jsonschema import FormatChecker, validate, ValidationError
+
+
+# Applies a single tracker sync event (see /tracker_sync) to the database
+# Returns a tuple of (rebroadcast, new_tracker)
+# rebroadcast is true if the event was new to this tracker and should be passed on to the other trackers
+# new_tracker is the newly added Tracker for new_tracker events, which needs to be announced and then
+# given its own event queue (in that order, so it doesn't get told about itself), otherwise None
+def apply_event(sync_event):
+    event = sync_event["event"]
+    event_ip = sync_event["event_ip"]
+    event_data = sync_event["data"]
+
+    if event == "new_tracker":
+        # If the tracker doesn't exist, add it
+        if not models.tracker_ip_exists(event_ip):
+            return (False, models.add_tracker(event_ip))
+
+    elif event == "add_file":
+        peer_guid = event_data["guid"]
+        models.ensure_peer_exists(event_ip, peer_guid, event_data["seq_number"])
+
+        # If the sequence number is new, apply and rebroadcast if it applied here
+        if event_data["seq_number"] >= models.peer_expected_seq(peer_guid):
+            if models.add_file(event_data, event_ip)["success"]:
+                return (True, None)
+
+    elif event == "add_files":
+        # Apply the files with new sequence numbers, and rebroadcast if any of them applied here
+        new_files = []
+        for add_file_data in event_data["files"]:
+            models.ensure_peer_exists(event_ip, add_file_data["guid"], add_file_data["seq_number"])
+            if add_file_data["seq_number"] >= models.peer_expected_seq(add_file_data["guid"]):
+                new_files.append(add_file_data)
+
+        if new_files:
+            responses = models.add_files(new_files, event_ip)
+            if any(response["success"] for response in responses):
+                return (True, None)
+
+    elif event == "keep_alive":
+        peer_guid = event_data["guid"]
+        models.ensure_peer_exists(event_ip, peer_guid)
+
+        # If the keepalive sequence number is new, apply and rebroadcast
+        if event_data["ka_seq_number"] >= models.peer_expected_ka_seq(peer_guid):
+            models.keep_alive(event_data, event_ip)
+            return (True, None)
+
+    elif event == "keep_alive_batch":
+        # Apply the keep alives with new sequence numbers, and rebroadcast if there were any
+        new_keep_alives = []
+        for keep_alive_data in event_data["keep_alives"]:
+            models.ensure_peer_exists(event_ip, keep_alive_data["guid"])
+            if keep_alive_data["ka_seq_number"] >= models.peer_expected_ka_seq(keep_alive_data["guid"]):
+                new_keep_alives.append(keep_alive_data)
+
+        if new_keep_alives:
+            models.keep_alive_batch(new_keep_alives, event_ip)
+            return (True, None)
+
+    elif event == "deregister_file_by_hash":
+        peer_guid = event_data["guid"]
+        models.ensure_peer_exists(event_ip, peer_guid)
+
+        # If the sequence number is new, apply and rebroadcast
+        if event_data["seq_number"] >= models.peer_expected_seq(peer_guid):
+            models.deregister_file_by_hash(event_data, event_ip)
+            return (True, None)
+
+    elif event == "reap_peer":
+        # The sending tracker deleted the peer, only delete it here too (and pass it on) if it has timed out
+        # here as well, this tracker may have heard from it since
+        if models.reap_peer(event_data["guid"]):
+            return (True, None)
+
+    return (False, None)
+
+
+# Records the newest change log version another tracker sent along with its sync events
+# so catching up with that tracker later only needs the events after it (see catch_up)
+# Senders only send a version once every event up to it was delivered, even when events go out concurrently
+def record_version(tracker_ip, sync_events):
+    versions = [
+        sync_event["version"] for sync_event in sync_events
+        if isinstance(sync_event, dict) and isinstance(sync_event.get("version"), int)
+    ]
+
+    if versions:
+        outbox.record_sync_version(tracker_ip, max(versions))
+
+
+# Brings this tracker up to date with a successful /new_tracker response from the tracker at tracker_ip
+# The response holds either a full database dump, which replaces the database, or the events since the
+# version requested, which are applied in order without being rebroadcast (the other trackers have them)
+# A full dump is inline in "data", or was streamed to disk by tracker_init and is at "snapshot_path"
+def catch_up(response, tracker_ip):
+    if "events" in response:
+        print(f"Applying {len(response['events'])} events from tracker {tracker_ip}")
+        with models.db.atomic():
+            for sync_event in response["events"]:
+                try:
+                    validate(sync_event, schemas.TRACKER_SYNC_SCHEMA, format_checker=FormatChecker())
+                    with models.db.atomic():
+                        apply_event(sync_event)
+                except ValidationError as e:
+                    print(f"Skipping invalid event from tracker {tracker_ip}: {e.message}")
+                except Exception:
+                    print(f"Recieved exception while catching up with tracker {tracker_ip}", file=sys.stderr)
+                    print_exc()
+
+        # The events are committed now
+        cache.invalidate_deferred()
+    else:
+        print(f"Replacing the database with a full dump from tracker {tracker_ip}")
+        if "snapshot_path" in response:
+            models.replace_database_from_snapshot(response["snapshot_path"])
+        else:
+            models.replace_database(response["data"])
+
+        # Versions seen from the other trackers don't describe the new database
+        outbox.forget_sync_versions()
+
+    if "version" in response:
+        outbox.record_sync_version(tracker_ip, response["version"])
+
+    if not models.tracker_ip_exists(tracker_ip):
+        models.add_tracker(tracker_ip)
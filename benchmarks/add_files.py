@@ -0,0 +1,75 @@
+# Measures how long a peer takes to register a library of files, one /add_file request per file
+# against a single /add_files request
+# Usage: pipenv run python -m benchmarks.add_files [--files 500] [--chunks 20]
+import argparse
+import time
+
+from api import app, models
+from benchmarks.common import fresh_database
+
+
+# The /add_file request body for the peer's seq_number-th file
+def add_file_data(seq_number, chunk_count, guid):
+    return {
+        "name": "file {}".format(seq_number),
+        "full_hash": "hash{}".format(seq_number),
+        "chunks": [
+            {"id": chunk_id, "name": "chunk {}".format(chunk_id), "hash": "chunk{}-{}".format(seq_number, chunk_id)}
+            for chunk_id in range(chunk_count)
+        ],
+        "guid": guid,
+        "seq_number": seq_number,
+    }
+
+
+# Registers file_count files one request at a time, returns the seconds it took
+def run_single(file_count, chunk_count):
+    fresh_database()
+    client = app.test_client()
+
+    guid = None
+    start = time.perf_counter()
+    for seq_number in range(file_count):
+        response = client.post("/add_file", json=add_file_data(seq_number, chunk_count, guid)).get_json()
+        if not response["success"]:
+            raise RuntimeError(response["error"])
+        guid = response["guid"]
+    elapsed = time.perf_counter() - start
+
+    models.close_database()
+    return elapsed
+
+
+# Registers file_count files in one /add_files request, returns the seconds it took
+def run_batch(file_count, chunk_count):
+    fresh_database()
+    client = app.test_client()
+
+    start = time.perf_counter()
+    response = client.post("/add_files", json=[
+        add_file_data(seq_number, chunk_count, None) for seq_number in range(file_count)
+    ]).get_json()
+    elapsed = time.perf_counter() - start
+
+    for result in response["results"]:
+        if not result["success"]:
+            raise RuntimeError(result["error"])
+
+    models.close_database()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--chunks", type=int, default=20, help="chunks per file")
+    args = parser.parse_args()
+
+    print("{} files, {} chunks each".format(args.files, args.chunks))
+    print("{:>10} {:>10}".format("", "seconds"))
+    print("{:>10} {:10.2f}".format("add_file", run_single(args.files, args.chunks)))
+    print("{:>10} {:10.2f}".format("add_files", run_batch(args.files, args.chunks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Measures end to end event propagation latency from EventBroadcaster.new_event to other trackers
+# Starts fake trackers on 127.0.0.2, 127.0.0.3, ... that record when each event arrives
+# The first --slow-trackers of them take --slow-delay seconds to respond, only the others are measured
+# Usage: pipenv run python -m benchmarks.broadcast_latency [--trackers 20] [--events 50] [--interval 0.1]
+#        [--engine threaded|asyncio] [--slow-trackers 0] [--slow-delay 5]
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import statistics
+from threading import Thread
+import time
+
+from api import constants, models
+from api.async_event_broadcaster import AsyncEventBroadcaster
+from api.event_broadcaster import EventBroadcaster
+from benchmarks.common import fresh_database
+
+BENCHMARK_PORT = 42170
+
+
+# Fake /tracker_sync endpoint, records the latency of every event it receives
+def make_handler(latencies, delay):
+    class SyncHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_PATCH(self):  # noqa: N802
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            events = body if isinstance(body, list) else [body]
+            received_at = time.time()
+            for event in events:
+                latencies.append(received_at - event["data"]["sent_at"])
+
+            time.sleep(delay)
+            response = json.dumps({"success": True, "results": [{"success": True}] * len(events)}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    return SyncHandler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trackers", type=int, default=20)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between events")
+    parser.add_argument("--delay", type=float, default=0.01, help="seconds each fake tracker takes to respond")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--slow-trackers", type=int, default=0)
+    parser.add_argument("--slow-delay", type=float, default=5, help="seconds each slow tracker takes to respond")
+    args = parser.parse_args()
+
+    constants.DEFAULT_SERVER_PORT = BENCHMARK_PORT
+    fresh_database()
+
+    latencies = []
+    handler = make_handler(latencies, args.delay)
+    slow_handler = make_handler([], args.slow_delay)
+    for i in range(args.trackers):
+        ip = "127.0.0.{}".format(i + 2)
+        server = ThreadingHTTPServer((ip, BENCHMARK_PORT), slow_handler if i < args.slow_trackers else handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        with models.db:
+            models.add_tracker(ip)
+
+    broadcaster = AsyncEventBroadcaster() if args.engine == "asyncio" else EventBroadcaster()
+    broadcaster.initialize()
+
+    for i in range(args.events):
+        event_data = {"guid": "benchmark-{}".format(i % 200), "ka_seq_number": i, "sent_at": time.time()}
+        broadcaster.new_event("keep_alive", "10.0.0.{}".format(i % 200 + 1), event_data)
+        time.sleep(args.interval)
+
+    expected = (args.trackers - args.slow_trackers) * args.events
+    deadline = time.time() + 300
+    while len(latencies) < expected and time.time() < deadline:
+        time.sleep(0.1)
+
+    latencies.sort()
+    print("{} trackers ({} slow), {} events, {} engine".format(
+        args.trackers,
+        args.slow_trackers,
+        args.events,
+        args.engine,
+    ))
+    print("delivered {}/{}".format(len(latencies), expected))
+    if latencies:
+        print("latency (ms): mean {:.1f}, p50 {:.1f}, p95 {:.1f}, max {:.1f}".format(
+            statistics.mean(latencies) * 1000,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000,
+            latencies[-1] * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# Measures the database size with chunk hashes stored once in ChunkContent against storing them in every
+# chunk row (the layout before schema version 4), for a catalog where releases are added several times
+# under different full hashes (re-encodes, bundles, duplicate releases) with the same chunks
+# Also times a second peer registering a large file, checked by manifest digest against the old
+# comparison of every chunk row, and registering it with the file's manifest digest instead of its chunks
+# Usage: pipenv run python -m benchmarks.chunk_dedup [--releases 1000] [--copies 3] [--chunks 100]
+import argparse
+import hashlib
+import json
+from operator import itemgetter
+import sqlite3
+
+from api import constants, models
+from benchmarks.common import best_of, fresh_database
+
+
+# /add_file chunk dicts with sha256-sized hashes, the same for every copy of a release
+def release_chunks(release, chunk_count, copy):
+    return [
+        {
+            "id": chunk_id,
+            "name": "release{}.copy{}.{}".format(release, copy, chunk_id),
+            "hash": hashlib.sha256("{}-{}".format(release, chunk_id).encode()).hexdigest(),
+        }
+        for chunk_id in range(chunk_count)
+    ]
+
+
+# Adds every copy of every release for peers with guids, returns the next sequence number of each peer
+def add_releases(guids, release_count, chunk_count):
+    seq_numbers = [0] * len(guids)
+    with models.db.atomic():
+        for release in range(release_count):
+            for (copy, guid) in enumerate(guids):
+                response = models.add_file({
+                    "name": "release {} copy {}".format(release, copy),
+                    "full_hash": "release{}-copy{}".format(release, copy),
+                    "chunks": release_chunks(release, chunk_count, copy),
+                    "guid": guid,
+                    "seq_number": seq_numbers[copy],
+                }, "127.0.0.1")
+                if not response["success"]:
+                    raise RuntimeError(response["error"])
+                seq_numbers[copy] += 1
+
+    return seq_numbers
+
+
+# Returns the size in bytes of a copy of the database at db_path, vacuumed
+# With legacy, the copy has chunk hashes in every chunk row again
+def database_size(db_path, legacy=False):
+    copy_path = db_path.with_name("legacy.db" if legacy else "interned.db")
+    connection = sqlite3.connect(db_path)
+    connection.execute("VACUUM INTO ?", (str(copy_path),))
+    connection.close()
+
+    connection = sqlite3.connect(copy_path)
+    if legacy:
+        connection.executescript("""
+            CREATE TABLE chunk_v3 (id INTEGER NOT NULL PRIMARY KEY, chunk_id INTEGER NOT NULL,
+                                   chunk_hash VARCHAR(255) NOT NULL, name VARCHAR(255) NOT NULL,
+                                   parent_file_id INTEGER NOT NULL);
+            INSERT INTO chunk_v3 SELECT chunk.id, chunk.chunk_id, chunkcontent.chunk_hash, chunk.name,
+                                        chunk.parent_file_id
+                                 FROM chunk JOIN chunkcontent ON chunkcontent.id = chunk.content_id;
+            DROP TABLE chunk;
+            DROP TABLE chunkcontent;
+            ALTER TABLE chunk_v3 RENAME TO chunk;
+            CREATE INDEX chunk_parent_file_id ON chunk (parent_file_id);
+            CREATE INDEX chunk_parent_file_id_chunk_id ON chunk (parent_file_id, chunk_id);
+        """)
+    connection.execute("VACUUM")
+    (page_count,) = connection.execute("PRAGMA page_count").fetchone()
+    (page_size,) = connection.execute("PRAGMA page_size").fetchone()
+    connection.close()
+
+    return page_count * page_size
+
+
+# The check add_file did before manifest digests, every chunk row compared with the submitted chunks
+def legacy_verify(full_hash, chunks):
+    chunk_query = models.Chunk.select(models.Chunk.chunk_id, models.ChunkContent.chunk_hash, models.Chunk.name)\
+        .join(models.ChunkContent, on=(models.ChunkContent.id == models.Chunk.content))\
+        .join(models.File, on=(models.File.id == models.Chunk.parent_file))\
+        .where(models.File.full_hash == full_hash)\
+        .order_by(models.Chunk.chunk_id)\
+        .tuples()
+
+    rows = list(chunk_query)
+    if len(rows) != len(chunks):
+        return False
+
+    return all(
+        (chunk_data["id"], chunk_data["hash"], chunk_data["name"]) == row
+        for (chunk_data, row) in zip(sorted(chunks, key=itemgetter("id")), rows)
+    )
+
+
+# The check add_file does now
+def digest_verify(full_hash, chunks):
+    stored_digest = models.File.select(models.File.manifest_digest)\
+        .where(models.File.full_hash == full_hash)\
+        .scalar()
+    chunks = sorted(chunks, key=itemgetter("id"))
+
+    return stored_digest == models.manifest_digest(map(itemgetter("id", "name", "hash"), chunks))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--releases", type=int, default=1000)
+    parser.add_argument("--copies", type=int, default=3)
+    parser.add_argument("--chunks", type=int, default=100, help="chunks per file")
+    parser.add_argument("--large-file-chunks", type=int, default=10000)
+    args = parser.parse_args()
+
+    constants.CHUNK_CACHE_SIZE = 0
+    db_path = fresh_database()
+    with models.db:
+        guids = [None] * args.copies
+        for copy in range(args.copies):
+            guids[copy] = str(models.add_peer("127.0.0.1").uuid)
+        add_releases(guids, args.releases, args.chunks)
+
+    print("{} releases, {} copies each, {} chunks per file".format(args.releases, args.copies, args.chunks))
+    legacy_size = database_size(db_path, legacy=True)
+    interned_size = database_size(db_path)
+    print("{:>22}: {:8.1f} MB".format("hashes in every chunk", legacy_size / 1e6))
+    print("{:>22}: {:8.1f} MB".format("hashes interned", interned_size / 1e6))
+
+    large_chunks = release_chunks("large", args.large_file_chunks, 0)
+    with models.db:
+        models.add_file({
+            "name": "large",
+            "full_hash": "large",
+            "chunks": large_chunks,
+            "guid": guids[0],
+            "seq_number": args.releases,
+        }, "127.0.0.1")
+
+        legacy = best_of(lambda: legacy_verify("large", large_chunks))
+        digest = best_of(lambda: digest_verify("large", large_chunks))
+
+    print("verifying a {} chunk file".format(args.large_file_chunks))
+    print("{:>22}: {:8.2f} ms".format("every chunk row", legacy * 1000))
+    print("{:>22}: {:8.2f} ms".format("manifest digest", digest * 1000))
+
+    # a second peer adding itself as a host, from parsing the request body, rolled back so every run
+    # registers the same peer again
+    with models.db:
+        large_digest = models.File.select(models.File.manifest_digest)\
+            .where(models.File.full_hash == "large")\
+            .scalar()
+        guid = str(models.add_peer("127.0.0.1").uuid)
+    with_chunks = {
+        "name": "large",
+        "full_hash": "large",
+        "chunks": large_chunks,
+        "guid": guid,
+        "seq_number": 0,
+    }
+    with_digest = dict(with_chunks, manifest_digest=large_digest)
+    del with_digest["chunks"]
+
+    def register(add_file_data):
+        with models.db.atomic() as transaction:
+            response = models.add_file(json.loads(add_file_data), "127.0.0.2")
+            if not response["success"]:
+                raise RuntimeError(response["error"])
+            transaction.rollback()
+
+    print("second peer registering a {} chunk file".format(args.large_file_chunks))
+    for (label, add_file_data) in (("with chunks", with_chunks), ("with manifest digest", with_digest)):
+        body = json.dumps(add_file_data)
+        with models.db:
+            seconds = best_of(lambda: register(body))
+        print("{:>22}: {:8.2f} ms, {:8.1f} KB request".format(label, seconds * 1000, len(body) / 1000))
+
+
+if __name__ == '__main__':
+    main()
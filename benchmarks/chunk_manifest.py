@@ -0,0 +1,55 @@
+# Measures /file response time and size for files with many chunks, with the chunks as a list of objects
+# (the default) against the compact chunk list stored with each file (?chunks=compact)
+# Each is timed with the response cache off and on
+# Usage: pipenv run python -m benchmarks.chunk_manifest [--chunks 100 1000 10000 100000] [--requests 20]
+import argparse
+
+from api import app, cache, constants
+from benchmarks.common import add_large_file, best_of, fresh_database
+
+
+# Requests url requests times and returns the seconds per request and the size of the response body
+def time_requests(client, url, requests):
+    body_size = len(client.get(url).data)
+
+    def run():
+        for _ in range(requests):
+            client.get(url)
+
+    return (best_of(run) / requests, body_size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--requests", type=int, default=20, help="requests per measurement")
+    args = parser.parse_args()
+
+    fresh_database()
+    client = app.test_client()
+    cache_size = constants.FILE_CACHE_SIZE
+
+    print("{:>8} {:>8} {:>12} {:>13} {:>12}".format("chunks", "format", "size (KB)", "uncached (ms)", "cached (ms)"))
+    for chunk_count in args.chunks:
+        file_id = add_large_file(chunk_count)
+
+        for chunk_format in ("full", "compact"):
+            url = "/file/{}?chunks={}".format(file_id, chunk_format)
+            timings = {}
+            for (label, size) in (("uncached", 0), ("cached", cache_size)):
+                constants.FILE_CACHE_SIZE = size
+                constants.CHUNK_CACHE_SIZE = size
+                cache.clear()
+                timings[label] = time_requests(client, url, args.requests)
+
+            print("{:>8} {:>8} {:12.1f} {:13.2f} {:12.2f}".format(
+                chunk_count,
+                chunk_format,
+                timings["uncached"][1] / 1000,
+                timings["uncached"][0] * 1000,
+                timings["cached"][0] * 1000,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# Measures how long a streaming client waits for the first chunks of a file as the file gets longer,
+# getting the whole file from /file against a window of chunks from /file/<id>/chunks
+# The response cache is off, so every request reads the database
+# Usage: pipenv run python -m benchmarks.chunk_range [--chunks 1000 10000 100000] [--window 50] [--requests 20]
+import argparse
+
+from api import app, cache, constants
+from benchmarks.common import add_large_file, best_of, fresh_database
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--window", type=int, default=50, help="chunks the streaming client asks for")
+    parser.add_argument("--requests", type=int, default=20, help="requests per measurement")
+    args = parser.parse_args()
+
+    fresh_database()
+    client = app.test_client()
+    constants.FILE_CACHE_SIZE = 0
+    constants.CHUNK_CACHE_SIZE = 0
+    cache.clear()
+
+    print("{:>8} {:>14} {:>14}".format("chunks", "/file (ms)", "window (ms)"))
+    for chunk_count in args.chunks:
+        file_id = add_large_file(chunk_count)
+
+        timings = []
+        for url in ("/file/{}".format(file_id), "/file/{}/chunks?from=0&to={}".format(file_id, args.window)):
+            def run():
+                for _ in range(args.requests):
+                    client.get(url)
+
+            timings.append(best_of(run) / args.requests)
+
+        print("{:>8} {:14.2f} {:14.2f}".format(chunk_count, timings[0] * 1000, timings[1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# Shared helpers for the benchmark scripts
+# Benchmarks are run from the repository root, e.g. `pipenv run python -m benchmarks.file_list`
+import datetime
+import hashlib
+from pathlib import Path
+import tempfile
+import time
+import uuid
+
+from api import constants, models, outbox
+from peewee import chunked
+
+
+# Points the tracker at a fresh database and outbox in a temporary directory and returns the database's path
+def fresh_database():
+    db_path = Path(tempfile.mkdtemp(prefix="p2pflix-bench-")) / "tracker.db"
+    constants.DB_PATH = db_path
+    constants.OUTBOX_PATH = db_path.with_name("outbox.db")
+    models.load_database(db_path)
+    outbox.load_outbox(constants.OUTBOX_PATH)
+
+    return db_path
+
+
+# Fills the database with file_count files, each hosted by peers_per_file peers
+# Half of the peers are recently keepalived, the other half have timed out
+def populate(file_count, peers_per_file=2, chunks_per_file=4):
+    now = datetime.datetime.now()
+    expired = now - constants.KEEP_ALIVE_TIMEOUT - datetime.timedelta(minutes=1)
+
+    with models.db.atomic():
+        peer_rows = [
+            {
+                "ip": "10.0.0.{}".format(i % 250),
+                "uuid": uuid.uuid4(),
+                "keep_alive_timestamp": now if i % 2 == 0 else expired,
+            }
+            for i in range(peers_per_file * 10)
+        ]
+        for batch in chunked(peer_rows, 100):
+            models.Peer.insert_many(batch).execute()
+        peer_ids = [peer.id for peer in models.Peer.select(models.Peer.id)]
+
+        file_rows = [{"name": "file {}".format(i), "full_hash": "hash{}".format(i)} for i in range(file_count)]
+        for batch in chunked(file_rows, 100):
+            models.File.insert_many(batch).execute()
+
+        # every chunk hash is different, so the nth ChunkContent row inserted has id n
+        content_rows = []
+        chunk_rows = []
+        host_rows = []
+        for file in models.File.select(models.File.id):
+            chunks = []
+            for chunk_id in range(chunks_per_file):
+                chunks.append((chunk_id, "{}.{}".format(file.id, chunk_id), "chunk{}-{}".format(file.id, chunk_id)))
+                content_rows.append({"chunk_hash": chunks[-1][2]})
+                chunk_rows.append({
+                    "chunk_id": chunk_id,
+                    "name": chunks[-1][1],
+                    "content": len(content_rows),
+                    "parent_file": file.id,
+                })
+            models.File.update(
+                manifest_digest=models.manifest_digest(chunks),
+                chunk_manifest=models.encode_chunk_manifest(chunks),
+            ).where(models.File.id == file.id).execute()
+
+            for offset in range(peers_per_file):
+                host_rows.append({
+                    "hosted_file": file.id,
+                    "hosting_peer": peer_ids[(file.id + offset) % len(peer_ids)],
+                })
+
+        for batch in chunked(content_rows, 100):
+            models.ChunkContent.insert_many(batch).execute()
+        for batch in chunked(chunk_rows, 100):
+            models.Chunk.insert_many(batch).execute()
+        for batch in chunked(host_rows, 100):
+            models.Hosts.insert_many(batch).execute()
+
+    # the rows were inserted directly, so the active peer counts have to be worked out afterwards
+    models.rebuild_active_peers()
+
+
+# Adds a file with chunk_count sha256-sized chunk hashes, hosted by an online peer, and returns its id
+def add_large_file(chunk_count):
+    with models.db:
+        peer = models.add_peer("127.0.0.1")
+        response = models.add_file({
+            "name": "large",
+            "full_hash": "large{}".format(chunk_count),
+            "chunks": [
+                {
+                    "id": chunk_id,
+                    "name": "large.{}".format(chunk_id),
+                    "hash": hashlib.sha256(str(chunk_id).encode()).hexdigest(),
+                }
+                for chunk_id in range(chunk_count)
+            ],
+            "guid": str(peer.uuid),
+            "seq_number": 0,
+        }, "127.0.0.1")
+        if not response["success"]:
+            raise RuntimeError(response["error"])
+        models.Peer.update(keep_alive_timestamp=datetime.datetime.now()).where(models.Peer.id == peer.id).execute()
+
+    return response["file_id"]
+
+
+# Runs func repeat times and returns the best wall clock time in seconds
+def best_of(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
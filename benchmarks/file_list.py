@@ -0,0 +1,88 @@
+# Measures how /file_list latency scales with the size of the catalog
+# Compares get_file_list, which reads the stored active peer counts, against counting the peers of every
+# file in one grouped query, and against the old per-file COUNT loop
+# Usage: pipenv run python -m benchmarks.file_list [--sizes 1000 10000 100000] [--legacy-limit 10000]
+import argparse
+import datetime
+
+from api import constants, models
+from api.models import File, fn, Hosts, Peer
+from benchmarks.common import best_of, fresh_database, populate
+from peewee import JOIN
+
+
+# The implementation before active peer counts were stored, counting every file's peers in one query
+# With top_page, only the 100 files with the most active peers (the first page of ?sort=active_peers)
+def grouped_file_list(top_page=False):
+    timeout_time = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
+    peer_count = fn.COUNT(Peer.id)
+    file_list = File.select(File.id, File.name, File.full_hash, peer_count.alias("peer_count"))\
+        .join(Hosts, JOIN.LEFT_OUTER, on=(File.id == Hosts.hosted_file))\
+        .join(Peer, JOIN.LEFT_OUTER, on=((Peer.id == Hosts.hosting_peer) &
+                                         (Peer.keep_alive_timestamp >= timeout_time)))\
+        .group_by(File.id)
+
+    if(top_page):
+        file_list = file_list.order_by(peer_count.desc(), File.id).limit(100)
+    else:
+        file_list = file_list.order_by(File.id)
+
+    return [file.to_dict_full(file.peer_count) for file in file_list]
+
+
+# The pre-aggregation implementation, one COUNT query per file
+def legacy_file_list():
+    files = []
+    timeout_time = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT
+    for file in File.select():
+        peer_query = Peer.select(fn.COUNT(Peer.id).alias("peer_count"))\
+            .join(Hosts, on=(Peer.id == Hosts.hosting_peer))\
+            .join(File, on=(File.id == Hosts.hosted_file))\
+            .where((File.full_hash == file.full_hash) &
+                   (Peer.keep_alive_timestamp >= timeout_time))\
+            .get()
+        files.append(file.to_dict_full(peer_query.peer_count))
+
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--legacy-limit",
+        type=int,
+        default=10000,
+        help="largest catalog to run the (slow) legacy per-file loop against",
+    )
+    args = parser.parse_args()
+
+    print("{:>10} {:>14} {:>14} {:>14} {:>18} {:>18}".format(
+        "files", "stored (ms)", "grouped (ms)", "legacy (ms)", "stored top (ms)", "grouped top (ms)",
+    ))
+    for size in args.sizes:
+        fresh_database()
+        populate(size)
+
+        with models.db:
+            stored = best_of(models.get_file_list)
+            grouped = best_of(grouped_file_list)
+            stored_top = best_of(lambda: models.get_file_list(limit=100, sort="active_peers"))
+            grouped_top = best_of(lambda: grouped_file_list(top_page=True))
+            if size <= args.legacy_limit:
+                legacy = "{:14.1f}".format(best_of(legacy_file_list, repeat=1) * 1000)
+            else:
+                legacy = "{:>14}".format("skipped")
+
+        print("{:>10} {:14.1f} {:14.1f} {} {:18.1f} {:18.1f}".format(
+            size,
+            stored * 1000,
+            grouped * 1000,
+            legacy,
+            stored_top * 1000,
+            grouped_top * 1000,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Measures get_file calls per second with and without the response cache
+# Requests are skewed towards a few popular files, like real traffic (a zipf-like distribution)
+# Usage: pipenv run python -m benchmarks.get_file [--files 10000] [--requests 20000] [--chunks 100]
+import argparse
+import datetime
+import random
+import time
+
+from api import cache, constants, models
+from benchmarks.common import fresh_database, populate
+
+
+# Returns requests file ids, file i + 1 picked with a weight of 1 / (i + 1)
+def popular_file_ids(file_count, requests):
+    weights = [1 / (i + 1) for i in range(file_count)]
+    return random.choices(range(1, file_count + 1), weights=weights, k=requests)
+
+
+# Runs get_file for every id and returns the calls per second
+def calls_per_second(file_ids):
+    start = time.perf_counter()
+    for file_id in file_ids:
+        models.get_file(file_id)
+    return len(file_ids) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--chunks", type=int, default=100, help="chunks per file")
+    args = parser.parse_args()
+
+    fresh_database()
+    populate(args.files, chunks_per_file=args.chunks)
+
+    # populate times half of the peers out, bring them all online so every file has a response to cache
+    with models.db:
+        models.Peer.update(keep_alive_timestamp=datetime.datetime.now()).execute()
+    file_ids = popular_file_ids(args.files, args.requests)
+
+    print("{} files, {} chunks each, {} requests".format(args.files, args.chunks, args.requests))
+    with models.db:
+        for (label, cache_size) in (("uncached", 0), ("cached", constants.FILE_CACHE_SIZE)):
+            constants.FILE_CACHE_SIZE = cache_size
+            constants.CHUNK_CACHE_SIZE = cache_size
+            cache.clear()
+
+            print("{:>10}: {:8.0f} calls/s".format(label, calls_per_second(file_ids)))
+
+
+if __name__ == '__main__':
+    main()
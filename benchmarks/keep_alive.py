@@ -0,0 +1,71 @@
+# Measures /keep_alive throughput with pooled connections against a new connection per request,
+# and against sending every peer's keep alive in one /keep_alive_batch request
+# Usage: pipenv run python -m benchmarks.keep_alive [--requests 5000] [--peers 100]
+import argparse
+import time
+
+from api import app, constants, models
+from benchmarks.common import fresh_database
+
+
+# Sends request_count keep alives round robin over peer_count peers, returns requests per second
+def run(mode, request_count, peer_count):
+    constants.DB_CONNECTION_MODE = mode
+    fresh_database()
+
+    with models.db:
+        guids = [str(models.add_peer("127.0.0.1").uuid) for _ in range(peer_count)]
+
+    client = app.test_client()
+    start = time.perf_counter()
+    for i in range(request_count):
+        response = client.put("/keep_alive", json={
+            "guid": guids[i % peer_count],
+            "ka_seq_number": i // peer_count,
+        })
+        if not response.get_json()["success"]:
+            raise RuntimeError(response.get_json()["error"])
+    elapsed = time.perf_counter() - start
+
+    models.close_database()
+    return request_count / elapsed
+
+
+# Sends request_count keep alives as /keep_alive_batch requests of one keep alive for each of the
+# peer_count peers, returns keep alives per second
+def run_batch(request_count, peer_count):
+    constants.DB_CONNECTION_MODE = "pooled"
+    fresh_database()
+
+    with models.db:
+        guids = [str(models.add_peer("127.0.0.1").uuid) for _ in range(peer_count)]
+
+    client = app.test_client()
+    start = time.perf_counter()
+    for ka_seq_number in range(request_count // peer_count):
+        response = client.put("/keep_alive_batch", json=[
+            {"guid": guid, "ka_seq_number": ka_seq_number} for guid in guids
+        ])
+        for result in response.get_json()["results"]:
+            if not result["success"]:
+                raise RuntimeError(result["error"])
+    elapsed = time.perf_counter() - start
+
+    models.close_database()
+    return (request_count // peer_count) * peer_count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--peers", type=int, default=100)
+    args = parser.parse_args()
+
+    print("{:>12} {:>16}".format("mode", "keep alives/sec"))
+    for mode in ("per_request", "pooled"):
+        print("{:>12} {:16.1f}".format(mode, run(mode, args.requests, args.peers)))
+    print("{:>12} {:16.1f}".format("batch", run_batch(args.requests, args.peers)))
+
+
+if __name__ == '__main__':
+    main()
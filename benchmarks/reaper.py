@@ -0,0 +1,70 @@
+# Measures how long the reaper takes to delete expired peers, and get_file latency before and after,
+# with the response cache off
+# Usage: pipenv run python -m benchmarks.reaper [--files 10000] [--peers-per-file 20]
+import argparse
+import datetime
+import time
+
+from api import constants, models
+from benchmarks.common import best_of, fresh_database, populate
+
+
+def get_every_file(file_ids):
+    for file_id in file_ids:
+        models.get_file(file_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--peers-per-file", type=int, default=20)
+    args = parser.parse_args()
+
+    constants.FILE_CACHE_SIZE = 0
+    constants.CHUNK_CACHE_SIZE = 0
+    fresh_database()
+    populate(args.files, peers_per_file=args.peers_per_file)
+
+    # populate times half of the peers out, make them expired for longer than the grace period
+    grace = datetime.timedelta(seconds=constants.REAPER_GRACE_PERIOD)
+    expired = datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT - grace - datetime.timedelta(minutes=1)
+    with models.db:
+        models.Peer.update(keep_alive_timestamp=expired, registered_timestamp=expired)\
+            .where(models.Peer.keep_alive_timestamp < datetime.datetime.now() - constants.KEEP_ALIVE_TIMEOUT)\
+            .execute()
+        # only time the files that are still there afterwards, the rest only have expired hosts
+        live_hosts = models.Hosts.select(models.Hosts.hosted_file)\
+            .join(models.Peer, on=(models.Peer.id == models.Hosts.hosting_peer))\
+            .where(models.Peer.keep_alive_timestamp > expired)
+        file_ids = [host.hosted_file_id for host in live_hosts.distinct()]
+
+    print("{} files, {} peers each, half of the peers expired".format(args.files, args.peers_per_file))
+    print("{:>8} {:>8} {:>10} {:>10} {:>14}".format("", "peers", "hosts", "files", "get_file (ms)"))
+
+    def report(label):
+        with models.db:
+            print("{:>8} {:8} {:10} {:10} {:14.3f}".format(
+                label,
+                models.Peer.select().count(),
+                models.Hosts.select().count(),
+                models.File.select().count(),
+                best_of(lambda: get_every_file(file_ids)) * 1000 / len(file_ids),
+            ))
+
+    report("before")
+
+    start = time.perf_counter()
+    reaped = 0
+    with models.db.connection_context():
+        while True:
+            (peers, _) = models.reap_expired_peers(grace, constants.REAPER_BATCH_SIZE)
+            if not peers:
+                break
+            reaped += len(peers)
+    print("reaped {} peers in {:.1f} ms".format(reaped, (time.perf_counter() - start) * 1000))
+
+    report("after")
+
+
+if __name__ == '__main__':
+    main()
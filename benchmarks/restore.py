@@ -0,0 +1,86 @@
+# Measures how long a new tracker takes to restore a full copy of the database
+# - executescript: the SQL dump run in place on the emptied database file (how restores used to work)
+# - atomic dump: the SQL dump loaded into a new file that is renamed into place (models.replace_database)
+# - backup: a copy made with sqlite's online backup renamed into place (models.replace_database_from_snapshot)
+# The time the serving tracker takes to make the backup (models.create_snapshot) is shown separately
+# Usage: pipenv run python -m benchmarks.restore [--files 10000 50000 100000]
+import argparse
+import os
+import shutil
+import time
+
+from api import constants, models
+from benchmarks.common import fresh_database, populate
+
+
+# The in-place restore, the database file is emptied and the dump is run on it statement by statement
+def restore_in_place(dump):
+    models.close_database()
+    open(constants.DB_PATH, "w").close()
+    for suffix in ("-wal", "-shm"):
+        try:
+            os.unlink(str(constants.DB_PATH) + suffix)
+        except FileNotFoundError:
+            pass
+
+    models.load_database(constants.DB_PATH)
+    models.db.connection().executescript(dump)
+    models.migrate_database()
+    models.db.close()
+
+
+def restore_atomic_dump(dump):
+    models.replace_database(dump)
+
+
+def restore_backup(snapshot_path):
+    models.replace_database_from_snapshot(snapshot_path)
+
+
+# Times func on a fresh copy of the database at db_path, returns the time in seconds
+def timed_restore(db_path, func, arg):
+    constants.DB_PATH = db_path.with_name("restored.db")
+    shutil.copyfile(db_path, constants.DB_PATH)
+    models.load_database(constants.DB_PATH)
+
+    start = time.perf_counter()
+    func(arg)
+    elapsed = time.perf_counter() - start
+
+    models.close_database()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, nargs="+", default=[10000, 50000, 100000])
+    args = parser.parse_args()
+
+    print("{:>8}  {:>14}  {:>14}  {:>14}  {:>14}".format(
+        "files", "executescript", "atomic dump", "backup", "make backup",
+    ))
+    for file_count in args.files:
+        db_path = fresh_database()
+        populate(file_count)
+        with models.db:
+            dump = models.new_tracker_dump()
+        start = time.perf_counter()
+        (snapshot_path, _) = models.create_snapshot()
+        backup_time = time.perf_counter() - start
+        models.close_database()
+
+        results = [
+            timed_restore(db_path, restore_in_place, dump),
+            timed_restore(db_path, restore_atomic_dump, dump),
+            timed_restore(db_path, restore_backup, snapshot_path),
+            backup_time,
+        ]
+
+        print("{:>8}  {:>14}  {:>14}  {:>14}  {:>14}".format(
+            file_count,
+            *["{:.2f} s".format(result) for result in results],
+        ))
+
+
+if __name__ == '__main__':
+    main()
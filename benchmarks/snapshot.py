@@ -0,0 +1,85 @@
+# Measures peak memory and time for a full database transfer, inline /new_tracker dump vs streamed /snapshot
+# Each measurement runs in its own process, since peak RSS can only go up (Linux only, it reads /proc)
+# Usage: pipenv run python -m benchmarks.snapshot [--files 10000 50000 100000]
+import argparse
+import json
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+from api import constants, models
+from benchmarks.common import fresh_database, populate
+import tracker_init
+
+
+# Peak RSS of this process in MB
+# ru_maxrss would include the parent's memory from before the fork, VmHWM starts over on exec
+def peak_rss():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+    return 0
+
+
+# Runs one transfer of the database at db_path, the way a new tracker would get it, and prints the
+# peak RSS growth (in MB) and the time it took
+def worker(mode, db_path):
+    constants.DB_PATH = Path(db_path)
+    models.load_database(constants.DB_PATH)
+    baseline = peak_rss()
+
+    start = time.perf_counter()
+    if mode == "inline":
+        response = json.dumps({"success": True, "data": models.new_tracker_dump()})
+        models.replace_database(json.loads(response)["data"])
+    else:
+        (served_path, checksum) = models.create_snapshot()
+        snapshot_path = Path(db_path + ".snapshot")
+        try:
+            if not tracker_init.write_snapshot(models.stream_snapshot(served_path), snapshot_path, checksum):
+                raise RuntimeError("snapshot checksum mismatch")
+        finally:
+            models.remove_snapshot(served_path)
+        models.replace_database_from_snapshot(snapshot_path)
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({"rss_mb": peak_rss() - baseline, "seconds": elapsed}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--worker", nargs=2, metavar=("MODE", "DB_PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(*args.worker)
+        return
+
+    print("{:>8}  {:>18}  {:>18}".format("files", "inline", "streamed"))
+    for file_count in args.files:
+        db_path = fresh_database()
+        populate(file_count)
+        models.close_database()
+
+        results = []
+        for mode in ("inline", "stream"):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.snapshot", "--worker", mode, str(db_path)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            results.append(json.loads(output.splitlines()[-1]))
+
+        print("{:>8}  {:>18}  {:>18}".format(
+            file_count,
+            *["{:.0f} MB {:.2f} s".format(result["rss_mb"], result["seconds"]) for result in results],
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import datetime
+import time
+
+from api import constants, liveness, maintenance, models
+
+
+def active_peers(client):
+    return {file["full_hash"]: file["active_peers"] for file in client.get("/file_list").get_json()["files"]}
+
+
+# Waits up to timeout seconds for the active peer counts to become expected
+def wait_for_active_peers(client, expected, timeout=5):
+    deadline = time.time() + timeout
+    while active_peers(client) != expected and time.time() < deadline:
+        time.sleep(0.05)
+
+    return active_peers(client)
+
+
+def test_counts_follow_hosts_and_keep_alives(client, add_file, keep_alive):
+    guid = add_file("hash-a", None, 0, "10.0.0.1")["guid"]
+    # a peer that never kept alive isn't online yet
+    assert active_peers(client) == {"hash-a": 0}
+
+    keep_alive(guid, 0, "10.0.0.1")
+    assert active_peers(client) == {"hash-a": 1}
+
+    other_guid = add_file("hash-a", None, 0, "10.0.0.2")["guid"]
+    keep_alive(other_guid, 0, "10.0.0.2")
+    add_file("hash-b", guid, 1, "10.0.0.1")
+    assert active_peers(client) == {"hash-a": 2, "hash-b": 1}
+
+    deregister_data = {"file_hash": "hash-a", "guid": other_guid, "seq_number": 1}
+    response = client.delete("/deregister_file_by_hash", json=deregister_data,
+                             environ_base={"REMOTE_ADDR": "10.0.0.2"}).get_json()
+    assert response["success"]
+    assert active_peers(client) == {"hash-a": 1, "hash-b": 1}
+
+
+def test_counts_drop_when_peers_time_out(client, monkeypatch, add_file, keep_alive):
+    monkeypatch.setattr(constants, "KEEP_ALIVE_TIMEOUT", datetime.timedelta(seconds=0.5))
+    expiry_thread = maintenance.ActivePeerExpiryThread()
+    expiry_thread.start()
+    try:
+        guid = add_file("hash-a", None, 0, "10.0.0.1")["guid"]
+        other_guid = add_file("hash-a", None, 0, "10.0.0.2")["guid"]
+        keep_alive(guid, 0, "10.0.0.1")
+        keep_alive(other_guid, 0, "10.0.0.2")
+        assert active_peers(client) == {"hash-a": 2}
+        assert liveness.live_count() == 2
+
+        assert wait_for_active_peers(client, {"hash-a": 0}) == {"hash-a": 0}
+        assert liveness.live_count() == 0
+
+        # and go back up when they come back
+        keep_alive(guid, 1, "10.0.0.1")
+        assert active_peers(client) == {"hash-a": 1}
+    finally:
+        expiry_thread.interrupt()
+        expiry_thread.join()
+
+
+# Peers whose files couldn't be recounted when they timed out are tried again
+def test_failed_recount_is_retried(client, monkeypatch, add_file, keep_alive):
+    monkeypatch.setattr(constants, "KEEP_ALIVE_TIMEOUT", datetime.timedelta(seconds=0.5))
+    recount_peer_files = models.recount_peer_files
+    failures = []
+
+    def failing_recount_peer_files(peer_id):
+        if not failures:
+            failures.append(peer_id)
+            raise Exception("database is locked")
+        recount_peer_files(peer_id)
+
+    expiry_thread = maintenance.ActivePeerExpiryThread()
+    expiry_thread.start()
+    try:
+        guid = add_file("hash-a", None, 0, "10.0.0.1")["guid"]
+        keep_alive(guid, 0, "10.0.0.1")
+        assert active_peers(client) == {"hash-a": 1}
+
+        # the first recount once the peer times out fails
+        monkeypatch.setattr(models, "recount_peer_files", failing_recount_peer_files)
+        assert wait_for_active_peers(client, {"hash-a": 0}) == {"hash-a": 0}
+        assert len(failures) == 1
+    finally:
+        expiry_thread.interrupt()
+        expiry_thread.join()
@@ -0,0 +1,48 @@
+from api import models
+
+
+def test_results_per_file(client, broadcaster, file_request):
+    response = client.post("/add_files", json=[
+        file_request("hash-a", None, 0),
+        # the first file created the peer, the rest without a guid are for the same peer
+        file_request("hash-b", None, 1),
+        # doesn't fit the schema
+        {"name": "c", "full_hash": "hash-c", "guid": None, "seq_number": 2},
+        # wrong sequence number
+        file_request("hash-d", None, 5),
+        file_request("hash-e", None, 2),
+    ]).get_json()
+
+    assert response["success"]
+    results = response["results"]
+    assert [result["success"] for result in results] == [True, True, False, False, True]
+    guid = results[0]["guid"]
+    assert results[1]["guid"] == guid and results[4]["guid"] == guid
+    assert "expecting sequence number 2" in results[3]["error"]
+
+    with models.db:
+        assert models.Peer.select().count() == 1
+        assert sorted(file.full_hash for file in models.File.select()) == ["hash-a", "hash-b", "hash-e"]
+
+    # the files that were added go to the other trackers as one event
+    assert len(broadcaster.events) == 1
+    (event_type, _, event_data) = broadcaster.events[0]
+    assert event_type == "add_files"
+    assert [add_file_data["full_hash"] for add_file_data in event_data["files"]] == ["hash-a", "hash-b", "hash-e"]
+    assert all(add_file_data["guid"] == guid for add_file_data in event_data["files"])
+
+
+def test_already_hosting(client, broadcaster, add_file, file_request):
+    guid = add_file("hash-a", None, 0)["guid"]
+
+    results = client.post("/add_files", json=[file_request("hash-a", guid, 1)]).get_json()["results"]
+
+    assert not results[0]["success"]
+    assert "already hosting" in results[0]["error"]
+    assert [event[0] for event in broadcaster.events] == ["add_file"]
+
+
+def test_not_a_list(client, file_request):
+    response = client.post("/add_files", json=file_request("hash-a", None, 0)).get_json()
+
+    assert not response["success"]
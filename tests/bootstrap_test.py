@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import time
+
+import tracker_init
+
+
+def snapshot_files(db_path):
+    return list(db_path.parent.glob("*.snapshot"))
+
+
+# A tracker whose attempt fails is skipped and the next one is asked
+def test_failed_attempt_tries_next_tracker(database, monkeypatch):
+    def request_database(tracker_ip, deadline):
+        if tracker_ip == "10.0.0.1":
+            raise KeyError("success")
+        return {"success": True, "version": 1, "data": ""}
+
+    monkeypatch.setattr(tracker_init, "_request_database", request_database)
+    (json, tracker_ip) = tracker_init.get_database(["10.0.0.1", "10.0.0.2"])
+    assert tracker_ip == "10.0.0.2"
+    assert json["version"] == 1
+
+
+def test_no_tracker_answers(database, monkeypatch):
+    def request_database(tracker_ip, deadline):
+        raise OSError("database is locked")
+
+    monkeypatch.setattr(tracker_init, "_request_database", request_database)
+    assert tracker_init.get_database(["10.0.0.1", "10.0.0.2"]) == (None, None)
+
+
+# Stands in for a tracker that sends its snapshot slower than the attempt allows
+class SlowSnapshotSession:
+    def get(self, url, stream, timeout):
+        return SlowSnapshotResponse()
+
+
+class SlowSnapshotResponse:
+    status_code = 200
+    headers = {"X-Snapshot-SHA256": "", "X-Snapshot-Version": "1"}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_content(self, chunk_size):
+        while True:
+            time.sleep(0.05)
+            yield b""
+
+
+def test_snapshot_download_stops_at_deadline(database):
+    start = time.monotonic()
+    json = tracker_init._download_snapshot(SlowSnapshotSession(), "10.0.0.1", {"snapshot": "/snapshot"},
+                                           start + 0.2)
+    assert json is None
+    assert time.monotonic() - start < 1
+    assert snapshot_files(database) == []
+
+
+# Stands in for a tracker whose snapshot arrives intact but isn't a database
+class BadSnapshotSession:
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, url, stream, timeout):
+        return BadSnapshotResponse(self.data)
+
+
+class BadSnapshotResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.headers = {"X-Snapshot-SHA256": hashlib.sha256(data).hexdigest(), "X-Snapshot-Version": "1"}
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield gzip.compress(self.data)
+
+
+def test_failed_snapshot_is_removed(database):
+    session = BadSnapshotSession(b"not a database")
+    deadline = time.monotonic() + 5
+    assert tracker_init._download_snapshot(session, "10.0.0.1", {"snapshot": "/snapshot"}, deadline) is None
+    assert snapshot_files(database) == []
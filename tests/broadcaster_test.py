@@ -0,0 +1,56 @@
+from api import constants, models
+from api.event_broadcaster import BroadCasterThread, EventBroadcaster
+import pytest
+
+
+@pytest.fixture
+def event_broadcaster(database, monkeypatch):
+    # No threads, so nothing is sent and the queue of ready trackers can be looked at
+    monkeypatch.setattr(constants, "BROADCAST_THREAD_COUNT", 0)
+    event_broadcaster = EventBroadcaster()
+    event_broadcaster.initialize()
+    yield event_broadcaster
+
+    event_broadcaster.stop()
+
+
+# Without any trackers the broadcaster is initialized once, and not again for every event
+def test_initialized_without_trackers(event_broadcaster):
+    ready_condition = event_broadcaster.ready_condition
+    assert event_broadcaster.initialized
+
+    event_broadcaster.new_event("keep_alive", "10.0.0.1", {})
+    assert event_broadcaster.initialized
+    assert event_broadcaster.ready_condition is ready_condition
+    assert event_broadcaster.tracker_list == {}
+
+
+def test_new_tracker_gets_events_since(event_broadcaster):
+    event_broadcaster.new_event("keep_alive", "10.0.0.1", {})
+    since = event_broadcaster.last_seq
+    event_broadcaster.new_event("keep_alive", "10.0.0.1", {})
+
+    with models.db:
+        tracker = models.add_tracker("10.0.0.2")
+    event_broadcaster.new_tracker(tracker, since=since)
+    assert event_broadcaster.tracker_list[tracker.id]["acked"] == since
+    assert list(event_broadcaster.ready) == [tracker.id]
+
+    # Already queued up, so not queued again
+    event_broadcaster.new_event("keep_alive", "10.0.0.1", {})
+    event_broadcaster.new_tracker(tracker, since=since)
+    assert list(event_broadcaster.ready) == [tracker.id]
+
+
+# A sending thread can still count a failure for a tracker another thread removed
+def test_failure_for_removed_tracker(event_broadcaster):
+    with models.db:
+        tracker = models.add_tracker("10.0.0.2")
+    event_broadcaster.new_tracker(tracker)
+
+    thread = BroadCasterThread(event_broadcaster)
+    with models.db:
+        event_broadcaster.remove_tracker(tracker.id)
+        assert thread._increment_tracker_fails(tracker.id)
+        event_broadcaster.remove_tracker(tracker.id)
+    assert event_broadcaster.tracker_list == {}
@@ -0,0 +1,75 @@
+import datetime
+
+from api import cache, models
+
+
+def peer_ips(client):
+    return sorted(peer["ip"] for peer in client.get("/file/1").get_json()["peers"])
+
+
+def test_repeated_requests_are_cached(client, add_file, keep_alive):
+    guid = add_file("hash-a", None, 0, "10.0.0.1", chunk_count=3)["guid"]
+    keep_alive(guid, 0, "10.0.0.1")
+
+    first = client.get("/file/1").get_json()
+    hits = cache.stats()["file_hits"]
+    assert client.get("/file/1").get_json() == first
+    assert cache.stats()["file_hits"] == hits + 1
+
+
+def test_new_host_invalidates(client, add_file, keep_alive):
+    guid = add_file("hash-a", None, 0, "10.0.0.1", chunk_count=3)["guid"]
+    keep_alive(guid, 0, "10.0.0.1")
+    assert peer_ips(client) == ["10.0.0.1"]
+
+    other_guid = add_file("hash-a", None, 0, "10.0.0.2", chunk_count=3)["guid"]
+    keep_alive(other_guid, 0, "10.0.0.2")
+    assert peer_ips(client) == ["10.0.0.1", "10.0.0.2"]
+
+
+def test_deregister_invalidates(client, add_file, keep_alive):
+    guid = add_file("hash-a", None, 0, "10.0.0.1", chunk_count=3)["guid"]
+    keep_alive(guid, 0, "10.0.0.1")
+    other_guid = add_file("hash-a", None, 0, "10.0.0.2", chunk_count=3)["guid"]
+    keep_alive(other_guid, 0, "10.0.0.2")
+    assert peer_ips(client) == ["10.0.0.1", "10.0.0.2"]
+
+    response = client.delete("/deregister_file", json={"file_id": 1, "guid": other_guid, "seq_number": 1},
+                             environ_base={"REMOTE_ADDR": "10.0.0.2"}).get_json()
+    assert response["success"]
+    assert peer_ips(client) == ["10.0.0.1"]
+
+
+def test_peer_coming_back_online_invalidates(client, add_file, keep_alive):
+    guid = add_file("hash-a", None, 0, "10.0.0.1", chunk_count=3)["guid"]
+    keep_alive(guid, 0, "10.0.0.1")
+    other_guid = add_file("hash-a", None, 0, "10.0.0.2", chunk_count=3)["guid"]
+    keep_alive(other_guid, 0, "10.0.0.2")
+
+    with models.db:
+        models.Peer.update(keep_alive_timestamp=datetime.datetime(2000, 1, 1))\
+            .where(models.Peer.uuid == other_guid).execute()
+    cache.clear()
+    assert peer_ips(client) == ["10.0.0.1"]
+
+    keep_alive(other_guid, 1, "10.0.0.2")
+    assert peer_ips(client) == ["10.0.0.1", "10.0.0.2"]
+
+
+def test_peer_moving_invalidates(client, add_file, keep_alive):
+    guid = add_file("hash-a", None, 0, "10.0.0.1", chunk_count=3)["guid"]
+    keep_alive(guid, 0, "10.0.0.1")
+    assert peer_ips(client) == ["10.0.0.1"]
+
+    keep_alive(guid, 1, "10.0.0.3")
+    assert peer_ips(client) == ["10.0.0.3"]
+
+
+# A response read before an invalidation may be out of date, it must not be cached after it
+def test_response_read_before_invalidation_is_not_cached(database):
+    generation = cache.generation()
+    cache.invalidate_files([1])
+    cache.put_file(("id", 1), 1, {"success": True}, datetime.datetime.now() + datetime.timedelta(minutes=1),
+                   generation)
+
+    assert cache.get_file(("id", 1)) is None
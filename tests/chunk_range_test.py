@@ -0,0 +1,67 @@
+from api import constants
+
+
+def add_online_file(add_file, keep_alive):
+    guid = add_file("hash-a", None, 0, chunk_count=25)["guid"]
+    keep_alive(guid, 0)
+
+
+def chunk_ids(response):
+    return [chunk["id"] for chunk in response["chunks"]]
+
+
+def test_window(client, add_file, keep_alive):
+    add_online_file(add_file, keep_alive)
+
+    response = client.get("/file/1/chunks?from=5&to=10").get_json()
+    assert response["success"]
+    assert chunk_ids(response) == [5, 6, 7, 8, 9]
+    assert response["chunks"][0] == {"id": 5, "name": "hash-a.5", "chunk_hash": "hash-a5"}
+    assert response["next_from"] is None
+    assert response["full_hash"] == "hash-a"
+    assert response["manifest_digest"] == client.get("/file/1").get_json()["manifest_digest"]
+    assert [peer["ip"] for peer in response["peers"]] == ["127.0.0.1"]
+
+    assert chunk_ids(client.get("/file/1/chunks?to=3").get_json()) == [0, 1, 2]
+    assert chunk_ids(client.get("/file/1/chunks?from=22").get_json()) == [22, 23, 24]
+    assert chunk_ids(client.get("/file/1/chunks").get_json()) == list(range(25))
+    assert chunk_ids(client.get("/file/1/chunks?from=30").get_json()) == []
+
+
+def test_limit_pages_through_window(client, add_file, keep_alive):
+    add_online_file(add_file, keep_alive)
+
+    chunks = []
+    chunk_from = 3
+    while chunk_from is not None:
+        response = client.get("/file_by_hash/hash-a/chunks?from={}&to=20&limit=5".format(chunk_from)).get_json()
+        assert len(response["chunks"]) <= 5
+        chunks.extend(chunk_ids(response))
+        chunk_from = response["next_from"]
+
+    assert chunks == list(range(3, 20))
+
+
+def test_limit_is_capped(client, add_file, keep_alive):
+    add_online_file(add_file, keep_alive)
+
+    response = client.get("/file/1/chunks?limit={}".format(constants.CHUNK_RANGE_MAX_SIZE + 1)).get_json()
+    assert not response["success"]
+
+
+def test_bad_parameters(client, add_file, keep_alive):
+    add_online_file(add_file, keep_alive)
+
+    assert not client.get("/file/1/chunks?from=a").get_json()["success"]
+    assert not client.get("/file/1/chunks?limit=0").get_json()["success"]
+    assert not client.get("/file/1/chunks?size=5").get_json()["success"]
+
+
+def test_missing_or_offline_file(client, add_file):
+    response = client.get("/file/1/chunks").get_json()
+    assert response == {"success": False, "error": "File with id 1 does not exist"}
+    response = client.get("/file_by_hash/hash-a/chunks").get_json()
+    assert response == {"success": False, "error": "File with hash hash-a does not exist"}
+
+    add_file("hash-a", None, 0, chunk_count=25)
+    assert not client.get("/file/1/chunks").get_json()["success"]
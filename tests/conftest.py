@@ -0,0 +1,86 @@
+from api import app, cache, constants, liveness, models, outbox, routes
+import pytest
+
+
+# Stands in for the event broadcaster, keeps the events the routes would have sent to the other trackers
+class RecordingBroadcaster:
+    def __init__(self):
+        self.events = []
+
+    def new_event(self, event_type, event_ip, event_data):
+        self.events.append((event_type, event_ip, event_data))
+
+
+# Points the tracker at a fresh database and outbox in the test's temporary directory
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "DB_PATH", tmp_path / "tracker.db")
+    monkeypatch.setattr(constants, "OUTBOX_PATH", tmp_path / "outbox.db")
+    cache.clear()
+    liveness.reset()
+
+    models.load_database(constants.DB_PATH)
+    outbox.load_outbox(constants.OUTBOX_PATH)
+    outbox.take_queued_keep_alives()
+    yield constants.DB_PATH
+
+    models.close_database()
+    outbox.take_queued_keep_alives()
+    cache.clear()
+    liveness.reset()
+
+
+@pytest.fixture
+def broadcaster(monkeypatch):
+    recording_broadcaster = RecordingBroadcaster()
+    monkeypatch.setattr(routes, "broadcaster", recording_broadcaster)
+
+    return recording_broadcaster
+
+
+@pytest.fixture
+def client(database, broadcaster):
+    return app.test_client()
+
+
+# Builds an /add_file request for the file full_hash (also its name) with chunk_count chunks,
+# chunk n is named "<full_hash>.<n>" and has the hash "<full_hash><n>"
+@pytest.fixture
+def file_request():
+    def file_request(full_hash, guid, seq_number, chunk_count=1):
+        return {
+            "name": full_hash,
+            "full_hash": full_hash,
+            "chunks": [
+                {
+                    "id": chunk_id,
+                    "name": "{}.{}".format(full_hash, chunk_id),
+                    "hash": "{}{}".format(full_hash, chunk_id),
+                }
+                for chunk_id in range(chunk_count)
+            ],
+            "guid": guid,
+            "seq_number": seq_number,
+        }
+
+    return file_request
+
+
+# Sends file_request's /add_file request from ip and returns the response
+@pytest.fixture
+def add_file(client, file_request):
+    def add_file(full_hash, guid, seq_number, ip="127.0.0.1", chunk_count=1):
+        return client.post("/add_file", json=file_request(full_hash, guid, seq_number, chunk_count),
+                           environ_base={"REMOTE_ADDR": ip}).get_json()
+
+    return add_file
+
+
+# Sends a /keep_alive from ip and returns the response
+@pytest.fixture
+def keep_alive(client):
+    def keep_alive(guid, ka_seq_number, ip="127.0.0.1"):
+        return client.put("/keep_alive", json={"guid": guid, "ka_seq_number": ka_seq_number},
+                          environ_base={"REMOTE_ADDR": ip}).get_json()
+
+    return keep_alive
@@ -0,0 +1,35 @@
+from api import constants, schemas
+import pytest
+
+
+@pytest.fixture
+def max_limit():
+    previous_max_limit = constants.FILE_LIST_MAX_LIMIT
+    schemas.set_file_list_max_limit(2)
+    yield 2
+
+    schemas.set_file_list_max_limit(previous_max_limit)
+
+
+def file_ids(response):
+    return [file["id"] for file in response["files"]]
+
+
+def test_limit_is_capped(client, add_file, max_limit):
+    for name in ("a", "b", "c"):
+        add_file("hash-" + name, None, 0)
+
+    response = client.get("/file_list?limit=3").get_json()
+    assert not response["success"]
+    assert "is greater than the maximum of 2" in response["error"]
+
+    # paging without a limit gets pages of the largest limit
+    response = client.get("/file_list?sort=name").get_json()
+    assert file_ids(response) == [1, 2]
+    assert response["next_cursor"] == 2
+    response = client.get("/file_list?sort=name&after=2").get_json()
+    assert file_ids(response) == [3]
+    assert response["next_cursor"] is None
+
+    # without any paging arguments every file is listed, as before there was paging
+    assert file_ids(client.get("/file_list").get_json()) == [1, 2, 3]
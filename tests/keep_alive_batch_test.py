@@ -0,0 +1,82 @@
+from api import maintenance, models
+
+
+def flush_keep_alive_events(broadcaster):
+    maintenance.KeepAliveEventFlushThread(broadcaster).flush()
+
+
+def test_results_per_keep_alive(client, broadcaster, add_file):
+    guids = [add_file("hash-" + str(i), None, 0)["guid"] for i in range(3)]
+    broadcaster.events.clear()
+
+    response = client.put("/keep_alive_batch", json=[
+        {"guid": guids[0], "ka_seq_number": 0},
+        # wrong sequence number
+        {"guid": guids[1], "ka_seq_number": 3},
+        # doesn't fit the schema
+        {"guid": guids[2]},
+        # unknown peer
+        {"guid": "33333333-3333-3333-3333-333333333333", "ka_seq_number": 0},
+        # a peer can be in the batch more than once
+        {"guid": guids[0], "ka_seq_number": 1},
+        {"guid": guids[2], "ka_seq_number": 0},
+    ]).get_json()
+
+    assert response["success"]
+    results = response["results"]
+    assert [result["success"] for result in results] == [True, False, False, False, True, True]
+    assert "expecting keep_alive sequence number 0" in results[1]["error"]
+    assert "does not exist" in results[3]["error"]
+
+    with models.db:
+        ka_seq_numbers = {str(peer.uuid): peer.ka_expected_seq_number for peer in models.Peer.select()}
+    assert ka_seq_numbers == {guids[0]: 2, guids[1]: 0, guids[2]: 1}
+
+    # the keep alives that were applied go to the other trackers as one event, with the next flush
+    assert broadcaster.events == []
+    flush_keep_alive_events(broadcaster)
+    assert broadcaster.events == [("keep_alive_batch", "127.0.0.1", {"keep_alives": [
+        {"guid": guids[0], "ka_seq_number": 0},
+        {"guid": guids[0], "ka_seq_number": 1},
+        {"guid": guids[2], "ka_seq_number": 0},
+    ]})]
+
+
+def test_nothing_applied(client, broadcaster):
+    response = client.put("/keep_alive_batch", json=[
+        {"guid": "33333333-3333-3333-3333-333333333333", "ka_seq_number": 0},
+    ]).get_json()
+
+    assert response["success"]
+    assert not response["results"][0]["success"]
+    flush_keep_alive_events(broadcaster)
+    assert broadcaster.events == []
+
+
+# Keep alives from single /keep_alive requests are sent together too, one event per ip
+def test_keep_alives_sent_together(client, broadcaster, add_file, keep_alive):
+    guids = [add_file("hash-" + str(i), None, 0, "10.0.0.1")["guid"] for i in range(2)]
+    other_guid = add_file("hash-2", None, 0, "10.0.0.2")["guid"]
+    broadcaster.events.clear()
+
+    keep_alive(guids[0], 0, "10.0.0.1")
+    keep_alive(other_guid, 0, "10.0.0.2")
+    keep_alive(guids[1], 0, "10.0.0.1")
+    keep_alive(guids[0], 1, "10.0.0.1")
+    assert broadcaster.events == []
+
+    flush_keep_alive_events(broadcaster)
+    assert broadcaster.events == [
+        ("keep_alive_batch", "10.0.0.1", {"keep_alives": [
+            {"guid": guids[0], "ka_seq_number": 0},
+            {"guid": guids[1], "ka_seq_number": 0},
+            {"guid": guids[0], "ka_seq_number": 1},
+        ]}),
+        ("keep_alive_batch", "10.0.0.2", {"keep_alives": [
+            {"guid": other_guid, "ka_seq_number": 0},
+        ]}),
+    ]
+
+    # and only once
+    flush_keep_alive_events(broadcaster)
+    assert len(broadcaster.events) == 2
@@ -0,0 +1,26 @@
+from api import models
+
+
+def test_digest_is_unambiguous():
+    assert models.manifest_digest([(0, "a", "h\n1\tb\tg")]) != models.manifest_digest([(0, "a", "h"), (1, "b", "g")])
+    assert models.manifest_digest([(0, "a\"", "b")]) != models.manifest_digest([(0, "a", "\"b")])
+
+
+# Chunk hashes shared between files are stored once, each file keeps its own chunk names
+def test_shared_chunks_are_stored_once(add_file, file_request):
+    add_file("hash-a", None, 0, chunk_count=3)
+    add_file("hash-b", None, 0, chunk_count=2)
+
+    with models.db:
+        assert models.Chunk.select().count() == 5
+        assert models.ChunkContent.select().count() == 5
+
+    request = file_request("hash-c", None, 0, chunk_count=3)
+    for chunk in request["chunks"]:
+        chunk["hash"] = "hash-a{}".format(chunk["id"])
+    with models.db:
+        assert models.add_file(request, "127.0.0.1")["success"]
+        assert models.Chunk.select().count() == 8
+        assert models.ChunkContent.select().count() == 5
+        digests = {file.full_hash: file.manifest_digest for file in models.File.select()}
+    assert digests["hash-c"] != digests["hash-a"]
@@ -0,0 +1,125 @@
+import datetime
+import json
+import sqlite3
+
+from api import constants, models
+
+# The schema the first version of the tracker created, which has no user_version (version 0)
+V0_SCHEMA = '''
+CREATE TABLE "file" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL,
+    "full_hash" VARCHAR(255) NOT NULL);
+CREATE TABLE "chunk" ("id" INTEGER NOT NULL PRIMARY KEY, "chunk_id" INTEGER NOT NULL,
+    "chunk_hash" VARCHAR(255) NOT NULL, "name" VARCHAR(255) NOT NULL, "parent_file_id" INTEGER NOT NULL,
+    FOREIGN KEY ("parent_file_id") REFERENCES "file" ("id") ON DELETE cascade ON UPDATE cascade);
+CREATE INDEX "chunk_parent_file_id" ON "chunk" ("parent_file_id");
+CREATE TABLE "peer" ("id" INTEGER NOT NULL PRIMARY KEY, "ip" VARCHAR(255) NOT NULL, "uuid" TEXT NOT NULL,
+    "keep_alive_timestamp" DATETIME NOT NULL, "expected_seq_number" INTEGER NOT NULL,
+    "ka_expected_seq_number" INTEGER NOT NULL);
+CREATE TABLE "hosts" ("id" INTEGER NOT NULL PRIMARY KEY, "hosted_file_id" INTEGER NOT NULL,
+    "hosting_peer_id" INTEGER NOT NULL,
+    FOREIGN KEY ("hosted_file_id") REFERENCES "file" ("id") ON DELETE cascade ON UPDATE cascade,
+    FOREIGN KEY ("hosting_peer_id") REFERENCES "peer" ("id") ON DELETE cascade ON UPDATE cascade);
+CREATE INDEX "hosts_hosted_file_id" ON "hosts" ("hosted_file_id");
+CREATE INDEX "hosts_hosting_peer_id" ON "hosts" ("hosting_peer_id");
+CREATE UNIQUE INDEX "hosts_hosted_file_id_hosting_peer_id" ON "hosts" ("hosted_file_id", "hosting_peer_id");
+CREATE TABLE "tracker" ("id" INTEGER NOT NULL PRIMARY KEY, "ip" VARCHAR(255) NOT NULL);
+CREATE UNIQUE INDEX "tracker_ip" ON "tracker" ("ip");
+'''
+
+# Chunks of each file in the version 0 database, as (chunk id, name, hash)
+# "b" re-encodes part of "a", so they share chunk hashes, and "a" was added twice (a bug version 1 fixed)
+V0_CHUNKS = {
+    1: [(0, "a.0", "shared0"), (1, "a.1", "shared1"), (2, "a.2", "a2")],
+    2: [(0, "b.0", "shared0"), (1, "b.1", "shared1")],
+    3: [(0, "a.0", "shared0"), (1, "a.1", "shared1"), (2, "a.2", "a2")],
+}
+
+
+# Creates a version 0 database at db_path: an online peer hosting files 1 and 2, and an offline one hosting 3
+def create_v0_database(db_path):
+    now = datetime.datetime.now()
+    offline = now - constants.KEEP_ALIVE_TIMEOUT - datetime.timedelta(minutes=1)
+
+    connection = sqlite3.connect(str(db_path))
+    connection.executescript(V0_SCHEMA)
+    connection.executemany("INSERT INTO file VALUES (?, ?, ?)", [
+        (1, "a", "hash-a"),
+        (2, "b", "hash-b"),
+        (3, "a", "hash-a"),
+    ])
+    connection.executemany("INSERT INTO peer VALUES (?, ?, ?, ?, ?, ?)", [
+        (1, "10.0.0.1", "11111111-1111-1111-1111-111111111111", str(now), 2, 1),
+        (2, "10.0.0.2", "22222222-2222-2222-2222-222222222222", str(offline), 1, 1),
+    ])
+    connection.executemany("INSERT INTO hosts VALUES (?, ?, ?)", [(1, 1, 1), (2, 2, 1), (3, 3, 2)])
+    connection.executemany("INSERT INTO chunk (chunk_id, name, chunk_hash, parent_file_id) VALUES (?, ?, ?, ?)", [
+        chunk + (file_id,) for (file_id, chunks) in V0_CHUNKS.items() for chunk in chunks
+    ])
+    connection.commit()
+    connection.close()
+
+
+def check_migrated():
+    with models.db:
+        assert models.db.pragma("user_version") == models.SCHEMA_VERSION
+
+        # the duplicate of "a" was merged into the first copy, along with its host
+        files = {file.full_hash: file for file in models.File.select()}
+        assert sorted(files) == ["hash-a", "hash-b"]
+        assert files["hash-a"].id == 1
+        assert models.Hosts.select().where(models.Hosts.hosted_file == 1).count() == 2
+
+        # the offline peer doesn't count
+        assert files["hash-a"].active_peers == 1
+        assert files["hash-b"].active_peers == 1
+
+        # each chunk hash is only stored once
+        assert models.ChunkContent.select().count() == 3
+        assert models.Chunk.select().count() == 5
+
+        for (file_id, chunks) in ((1, V0_CHUNKS[1]), (2, V0_CHUNKS[2])):
+            file = models.File.get_by_id(file_id)
+            assert file.manifest_digest == models.manifest_digest(chunks)
+            assert json.loads(models.decode_chunk_manifest(file.chunk_manifest)) == {
+                "ids": [chunk[0] for chunk in chunks],
+                "names": [chunk[1] for chunk in chunks],
+                "hashes": [chunk[2] for chunk in chunks],
+            }
+
+        assert models.Peer.select().where(models.Peer.registered_timestamp.is_null()).count() == 0
+
+
+def test_load_migrates_v0_database(tmp_path, monkeypatch):
+    db_path = tmp_path / "tracker.db"
+    monkeypatch.setattr(constants, "DB_PATH", db_path)
+    create_v0_database(db_path)
+
+    models.load_database(db_path)
+    try:
+        check_migrated()
+    finally:
+        models.close_database()
+
+
+# A dump doesn't carry the schema version, so a received database is migrated from version 0
+def test_v0_dump_is_migrated(database, tmp_path):
+    create_v0_database(tmp_path / "v0.db")
+    connection = sqlite3.connect(str(tmp_path / "v0.db"))
+    dump = "\n".join(connection.iterdump())
+    connection.close()
+
+    models.replace_database(dump)
+    check_migrated()
+
+
+# Every migration runs again on a dump of an up to date database, which must leave it as it was
+def test_current_dump_is_migrated_again(database, tmp_path):
+    create_v0_database(tmp_path / "v0.db")
+    connection = sqlite3.connect(str(tmp_path / "v0.db"))
+    models.replace_database("\n".join(connection.iterdump()))
+    connection.close()
+
+    with models.db:
+        dump = models.new_tracker_dump()
+    models.replace_database(dump)
+    check_migrated()
@@ -0,0 +1,97 @@
+import datetime
+
+from api import constants, maintenance, models
+
+
+def reap_events(broadcaster):
+    return [event for event in broadcaster.events if event[0] == "reap_peer"]
+
+
+# Makes a peer look like it was last heard from a long time ago
+def expire_peer(guid):
+    long_ago = datetime.datetime(2000, 1, 1)
+    with models.db:
+        models.Peer.update(keep_alive_timestamp=long_ago, registered_timestamp=long_ago)\
+            .where(models.Peer.uuid == guid).execute()
+
+
+def test_reaps_expired_peers_and_their_files(broadcaster, add_file):
+    expired_guid = add_file("hash-a", None, 0, "10.0.0.1")["guid"]
+    add_file("hash-b", expired_guid, 1, "10.0.0.1")
+    live_guid = add_file("hash-b", None, 0, "10.0.0.2")["guid"]
+    expire_peer(expired_guid)
+
+    maintenance.PeerReaperThread(broadcaster).reap_expired_peers()
+
+    with models.db:
+        assert [str(peer.uuid) for peer in models.Peer.select()] == [live_guid]
+        # hash-a had no other host, hash-b is still hosted by the live peer
+        assert [file.full_hash for file in models.File.select()] == ["hash-b"]
+        assert models.Hosts.select().count() == 1
+        assert models.Chunk.select().count() == 1
+
+    assert reap_events(broadcaster) == [("reap_peer", "10.0.0.1", {"guid": expired_guid})]
+
+
+def test_keeps_peers_within_grace_period(broadcaster, add_file):
+    guid = add_file("hash-a", None, 0, "10.0.0.1")["guid"]
+
+    maintenance.PeerReaperThread(broadcaster).reap_expired_peers()
+
+    with models.db:
+        assert models.Peer.select().count() == 1
+        assert models.File.select().count() == 1
+    assert reap_events(broadcaster) == []
+
+    expire_peer(guid)
+    maintenance.PeerReaperThread(broadcaster).reap_expired_peers()
+    with models.db:
+        assert models.Peer.select().count() == 0
+
+
+# Another tracker reaping a peer only deletes it here if it has timed out here too
+def test_reap_peer_event(add_file, keep_alive):
+    expired_guid = add_file("hash-a", None, 0, "10.0.0.1")["guid"]
+    live_guid = add_file("hash-b", None, 0, "10.0.0.2")["guid"]
+    keep_alive(live_guid, 0, "10.0.0.2")
+    expire_peer(expired_guid)
+
+    with models.db:
+        assert models.reap_peer(expired_guid)
+        assert not models.reap_peer(live_guid)
+        assert [file.full_hash for file in models.File.select()] == ["hash-b"]
+
+
+def test_reaps_orphans(broadcaster, add_file):
+    guid = add_file("hash-a", None, 0, "10.0.0.1")["guid"]
+    add_file("hash-b", guid, 1, "10.0.0.1")
+
+    # rows older versions of the tracker could leave behind
+    with models.db:
+        models.db.execute_sql("PRAGMA foreign_keys = OFF")
+        models.Hosts.delete().where(models.Hosts.hosted_file == 2).execute()
+        models.Hosts.insert(hosted_file=1, hosting_peer=99).execute()
+        models.db.execute_sql("PRAGMA foreign_keys = ON")
+
+    maintenance.PeerReaperThread(broadcaster).reap_orphans()
+
+    with models.db:
+        assert [file.full_hash for file in models.File.select()] == ["hash-a"]
+        assert [host.hosting_peer_id for host in models.Hosts.select()] == [1]
+        assert models.Chunk.select().count() == 1
+
+
+# The other trackers are told about a batch once the reaper has let go of the database
+def test_events_sent_after_database_released(broadcaster, add_file, monkeypatch):
+    users_at_event = []
+
+    def new_event(event_type, event_ip, event_data):
+        users_at_event.append(models.database_users)
+
+    monkeypatch.setattr(constants, "REAPER_BATCH_SIZE", 1)
+    for ip in ("10.0.0.1", "10.0.0.2"):
+        expire_peer(add_file("hash-" + ip, None, 0, ip)["guid"])
+    monkeypatch.setattr(broadcaster, "new_event", new_event)
+
+    maintenance.PeerReaperThread(broadcaster).reap_expired_peers()
+    assert users_at_event == [0, 0]
@@ -0,0 +1,72 @@
+import gzip
+import threading
+
+from api import models
+
+
+def snapshot_files(db_path):
+    return list(db_path.parent.glob("snapshot-*.db"))
+
+
+def test_snapshot_removed_after_streaming(client, database):
+    with models.db:
+        models.add_tracker("127.0.0.1")
+
+    response = client.get("/snapshot")
+    assert gzip.decompress(response.get_data()).startswith(b"SQLite format 3")
+    response.close()
+
+    assert snapshot_files(database) == []
+
+
+# The requester can go away before the snapshot starts streaming
+def test_snapshot_removed_if_never_streamed(client, database):
+    with models.db:
+        models.add_tracker("127.0.0.1")
+
+    response = client.get("/snapshot", buffered=False)
+    assert snapshot_files(database) != []
+    response.close()
+
+    assert snapshot_files(database) == []
+
+
+def test_snapshot_only_for_trackers(client, database):
+    response = client.get("/snapshot").get_json()
+    assert response == {"success": False, "error": "Tracker not in tracker list"}
+
+    assert snapshot_files(database) == []
+
+
+def test_snapshot_error_leaves_no_file(client, database, monkeypatch):
+    with models.db:
+        models.add_tracker("127.0.0.1")
+
+    def failing_stream_snapshot(snapshot_path):
+        raise OSError("no space left on device")
+
+    monkeypatch.setattr(models, "stream_snapshot", failing_stream_snapshot)
+    response = client.get("/snapshot").get_json()
+    assert response == {"success": False, "error": "no space left on device"}
+
+    assert snapshot_files(database) == []
+
+
+# Replacing the database waits for the requests still using it
+def test_replacement_waits_for_requests(database):
+    with models.db:
+        dump = models.new_tracker_dump()
+
+    models.acquire_database()
+    replacement = threading.Thread(target=models.replace_database, args=(dump,))
+    replacement.start()
+    try:
+        replacement.join(0.2)
+        assert replacement.is_alive()
+    finally:
+        models.release_database()
+
+    replacement.join(5)
+    assert not replacement.is_alive()
+    with models.database_in_use(), models.db:
+        assert models.db.pragma("user_version") == models.SCHEMA_VERSION
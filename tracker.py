@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 from pathlib import Path
+import time
 
-from api import app, constants, models
+from api import app, constants, models, outbox, routes, schemas
+from api.async_event_broadcaster import AsyncEventBroadcaster
+from api.maintenance import (ActivePeerExpiryThread, KeepAliveEventFlushThread, KeepAliveFlushThread,
+                             OutboxCompactThread, PeerReaperThread)
 import toml
 from tracker_init import tracker_init
 
@@ -14,6 +19,8 @@ DB_PATH = Path("tracker.db")
 KEEPALIVE_TIMEOUT = 5 * 60    # 5 minutes
 
 if __name__ == '__main__':
+    start_time = time.monotonic()
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", metavar="[config filename]", help="specify a nonstandard config file")
     parser.add_argument(
@@ -36,15 +43,61 @@ if __name__ == '__main__':
 
     try:
         with Path(config_file).open() as config:
-            settings = toml.load(config)["settings"]
+            config_data = toml.load(config)
+            settings = config_data["settings"]
+            database_settings = config_data.get("database", {})
 
         print("Loading settings from \"{}\"...".format(config_file))
         port = settings["server_port"]
         debug_mode = settings["debug_mode"]
         constants.DB_PATH = Path(settings["db_path"])
+        constants.OUTBOX_PATH = Path(settings.get("outbox_path", constants.OUTBOX_PATH))
+        constants.OUTBOX_COMPACT_INTERVAL = settings.get("outbox_compact_interval", constants.OUTBOX_COMPACT_INTERVAL)
+        constants.OUTBOX_RETENTION = settings.get("outbox_retention", constants.OUTBOX_RETENTION)
+        constants.DELTA_SYNC_MAX_EVENTS = settings.get("delta_sync_max_events", constants.DELTA_SYNC_MAX_EVENTS)
+        constants.BOOTSTRAP_PARALLELISM = settings.get("bootstrap_parallelism", constants.BOOTSTRAP_PARALLELISM)
+        constants.BOOTSTRAP_ATTEMPT_TIMEOUT = settings.get(
+            "bootstrap_attempt_timeout",
+            constants.BOOTSTRAP_ATTEMPT_TIMEOUT,
+        )
         keepalive_timeout = settings["keepalive_timeout"]
+        constants.BROADCAST_ENGINE = settings.get("broadcast_engine", constants.BROADCAST_ENGINE)
         constants.BROADCAST_THREAD_COUNT = settings["broadcast_thread_count"]
+        constants.ASYNC_CONCURRENCY_PER_TRACKER = settings.get(
+            "async_concurrency_per_tracker",
+            constants.ASYNC_CONCURRENCY_PER_TRACKER,
+        )
+        constants.ASYNC_MAX_IN_FLIGHT = settings.get("async_max_in_flight", constants.ASYNC_MAX_IN_FLIGHT)
         constants.MAX_TRACKER_FAILURES = settings["max_tracker_failures"]
+        constants.HTTP_POOL_SIZE = settings.get("http_pool_size", constants.HTTP_POOL_SIZE)
+        constants.HTTP_CONNECT_TIMEOUT = settings.get("http_connect_timeout", constants.HTTP_CONNECT_TIMEOUT)
+        constants.HTTP_READ_TIMEOUT = settings.get("http_read_timeout", constants.HTTP_READ_TIMEOUT)
+        constants.BROADCAST_BATCH_SIZE = settings.get("broadcast_batch_size", constants.BROADCAST_BATCH_SIZE)
+        constants.BROADCAST_BATCH_MAX_AGE = settings.get("broadcast_batch_max_age", constants.BROADCAST_BATCH_MAX_AGE)
+        constants.KEEP_ALIVE_BUFFER = settings.get("keepalive_buffer", constants.KEEP_ALIVE_BUFFER)
+        constants.KEEP_ALIVE_FLUSH_INTERVAL = settings.get(
+            "keepalive_flush_interval",
+            constants.KEEP_ALIVE_FLUSH_INTERVAL,
+        )
+        constants.KEEP_ALIVE_EVENT_INTERVAL = settings.get(
+            "keepalive_event_interval",
+            constants.KEEP_ALIVE_EVENT_INTERVAL,
+        )
+        constants.FILE_CACHE_SIZE = settings.get("file_cache_size", constants.FILE_CACHE_SIZE)
+        constants.FILE_CACHE_TTL = settings.get("file_cache_ttl", constants.FILE_CACHE_TTL)
+        constants.CHUNK_CACHE_SIZE = settings.get("chunk_cache_size", constants.CHUNK_CACHE_SIZE)
+        schemas.set_file_list_max_limit(settings.get("file_list_max_limit", constants.FILE_LIST_MAX_LIMIT))
+        constants.REAPER_INTERVAL = settings.get("reaper_interval", constants.REAPER_INTERVAL)
+        constants.REAPER_GRACE_PERIOD = settings.get("reaper_grace_period", constants.REAPER_GRACE_PERIOD)
+        constants.REAPER_BATCH_SIZE = settings.get("reaper_batch_size", constants.REAPER_BATCH_SIZE)
+
+        constants.DB_CONNECTION_MODE = database_settings.get("connection_mode", constants.DB_CONNECTION_MODE)
+        constants.DB_MAX_CONNECTIONS = database_settings.get("max_connections", constants.DB_MAX_CONNECTIONS)
+        constants.DB_STALE_TIMEOUT = database_settings.get("stale_timeout", constants.DB_STALE_TIMEOUT)
+
+        for pragma in constants.DB_PRAGMAS:
+            if pragma in database_settings:
+                constants.DB_PRAGMAS[pragma] = database_settings[pragma]
 
     except Exception:
         print("Error in config file \"{}\", loading default settings...".format(config_file))
@@ -54,5 +107,36 @@ if __name__ == '__main__':
 
     constants.set_keepalive_timeout(keepalive_timeout)
     models.load_database(constants.DB_PATH)
+    outbox.load_outbox(constants.OUTBOX_PATH)
+    print("Database connection mode: {}".format(constants.DB_CONNECTION_MODE))
+    print("Database settings: {}".format(
+        ", ".join("{}={}".format(pragma, value) for pragma, value in models.get_database_settings().items()),
+    ))
     tracker_init(initial_tracker)
+
+    print("Broadcast engine: {}".format(constants.BROADCAST_ENGINE))
+    if constants.BROADCAST_ENGINE == "asyncio":
+        routes.broadcaster = AsyncEventBroadcaster()
+
+    # Start sending right away, so events left in the outbox from the last run go out
+    routes.broadcaster.initialize()
+    print("Compacting the outbox every {} seconds".format(constants.OUTBOX_COMPACT_INTERVAL))
+    OutboxCompactThread().start()
+    ActivePeerExpiryThread().start()
+    print("Deleting peers offline for {} seconds past the keep alive timeout every {} seconds".format(
+        constants.REAPER_GRACE_PERIOD,
+        constants.REAPER_INTERVAL,
+    ))
+    PeerReaperThread(routes.broadcaster).start()
+    print("Sending keep alives to the other trackers every {} seconds".format(constants.KEEP_ALIVE_EVENT_INTERVAL))
+    keep_alive_event_thread = KeepAliveEventFlushThread(routes.broadcaster)
+    keep_alive_event_thread.start()
+    atexit.register(keep_alive_event_thread.flush)
+
+    if constants.KEEP_ALIVE_BUFFER:
+        print("Buffering keep alives, writing them every {} seconds".format(constants.KEEP_ALIVE_FLUSH_INTERVAL))
+        KeepAliveFlushThread().start()
+        atexit.register(models.flush_keep_alive_buffer)
+
+    print("Ready in {:.2f} seconds".format(time.monotonic() - start_time))
     app.run(host="0.0.0.0", port=port, debug=debug_mode)
@@ -1,7 +1,15 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
 import ipaddress
+import os
+from pathlib import Path
 import pprint
+import tempfile
+import time
+import zlib
 
-from api import constants, models
+from api import constants, models, outbox, sessions, sync
 from peewee import DoesNotExist
 import requests
 
@@ -29,32 +37,209 @@ def tracker_init(initial_tracker):
         print("Could not initialize database, try a different initial tracker (see --help)")
         exit(1)
 
-    models.replace_database(database)
-    models.add_tracker(ip)
+    sync.catch_up(database, ip)
 
 
+# Asks the trackers for a copy of their database, returns the first successful /new_tracker response and
+# the ip of the tracker that sent it, or (None, None)
+# Up to constants.BOOTSTRAP_PARALLELISM trackers are asked at once, quickest first (see outbox.order_by_latency),
+# and one that hasn't answered within constants.BOOTSTRAP_ATTEMPT_TIMEOUT seconds is given up on
+# Trackers this tracker has seen events from before are asked for just the changes since then
+# A full dump is streamed from /snapshot straight to disk by the attempt, the response then holds its path
+# (see sync.catch_up)
 def get_database(tracker_list):
-    for tracker_ip in tracker_list:
-        response = requests.post(f"http://{tracker_ip}:{constants.DEFAULT_SERVER_PORT}/new_tracker", json={})
+    start = time.monotonic()
+    candidates = deque(outbox.order_by_latency([str(tracker_ip) for tracker_ip in tracker_list]))
 
-        if response.status_code != requests.codes.ok:
-            # Couldn't talk to tracker, try next
-            print(f"Got bad response code: {response.status_code} from tracker {tracker_ip}. Trying next tracker")
-            continue
+    # Every attempt gets its own thread, one that is given up on can't hold up the next
+    executor = ThreadPoolExecutor(max_workers=max(len(candidates), 1), thread_name_prefix="bootstrap")
+    attempts = {}   # future: (tracker ip, deadline)
+    try:
+        while candidates or attempts:
+            while candidates and len(attempts) < constants.BOOTSTRAP_PARALLELISM:
+                tracker_ip = candidates.popleft()
+                deadline = time.monotonic() + constants.BOOTSTRAP_ATTEMPT_TIMEOUT
+                attempts[executor.submit(_request_database, tracker_ip, deadline)] = (tracker_ip, deadline)
 
-        try:
-            json = response.json()
-        except ValueError:
-            # Couldn't parse JSON, try next
-            print(f"Could not parse response from tracker {tracker_ip}. Trying next tracker")
-            continue
+            next_deadline = min(deadline for (_, deadline) in attempts.values())
+            (done, _) = wait(attempts, timeout=max(next_deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                (tracker_ip, _) = attempts.pop(future)
+                try:
+                    json = future.result()
+                    if json is None:
+                        continue
+                except Exception as e:
+                    # One tracker's bad answer (or a failure recording it) shouldn't stop the others being tried
+                    print(f"Error while getting the database from tracker {tracker_ip}: {e!r}. Trying next tracker")
+                    continue
+
+                print(f"Got the database from tracker {tracker_ip} in {time.monotonic() - start:.2f} seconds")
+                return (json, tracker_ip)
+
+            now = time.monotonic()
+            for (future, (tracker_ip, deadline)) in list(attempts.items()):
+                if deadline <= now:
+                    # Its thread still records the latency once the request times out or it answers
+                    print(f"Tracker {tracker_ip} did not answer in time. Trying next tracker")
+                    del attempts[future]
+
+        return (None, None)
+    finally:
+        # Attempts that haven't started yet are dropped, ones that are running finish on their own
+        # and have their snapshot removed
+        for future in attempts:
+            if not future.cancel():
+                future.add_done_callback(_discard_attempt)
+        executor.shutdown(wait=False)
+
+
+# Removes the snapshot an attempt that finished after it was given up on downloaded
+def _discard_attempt(future):
+    if future.exception() is None and future.result() is not None and "snapshot_path" in future.result():
+        models.remove_snapshot(future.result()["snapshot_path"])
+
+
+# Asks one tracker for a copy of its database
+# If the response points to a snapshot, it is downloaded too, and has to have arrived by deadline
+# Returns the response JSON, or None if the tracker couldn't be reached or the request failed
+def _request_database(tracker_ip, deadline):
+    with sessions.new_session() as session:
+        json = _new_tracker(session, tracker_ip)
+        if json is None or "snapshot" not in json:
+            return json
+
+        json = _download_snapshot(session, tracker_ip, json, deadline)
+        if json is None:
+            print(f"Could not download a snapshot from tracker {tracker_ip}. Trying next tracker")
+
+        return json
+
+
+# Sends one tracker a /new_tracker request and records how long it took to answer
+# Returns the response JSON, or None if the tracker couldn't be reached or the request failed
+def _new_tracker(session, tracker_ip):
+    request_data = {"snapshot": True}
+    since_version = outbox.sync_version(tracker_ip)
+    if since_version is not None:
+        request_data["since_version"] = since_version
+
+    start = time.monotonic()
+    try:
+        response = session.post(
+            f"http://{tracker_ip}:{constants.DEFAULT_SERVER_PORT}/new_tracker",
+            json=request_data,
+            timeout=(constants.HTTP_CONNECT_TIMEOUT, constants.BOOTSTRAP_ATTEMPT_TIMEOUT),
+        )
+    except requests.RequestException as e:
+        # Couldn't talk to tracker, try next
+        print(f"Could not reach tracker {tracker_ip}: {e}. Trying next tracker")
+        outbox.record_latency(tracker_ip, constants.BOOTSTRAP_ATTEMPT_TIMEOUT)
+        return None
+
+    outbox.record_latency(tracker_ip, time.monotonic() - start)
+
+    if response.status_code != requests.codes.ok:
+        # Couldn't talk to tracker, try next
+        print(f"Got bad response code: {response.status_code} from tracker {tracker_ip}. Trying next tracker")
+        return None
+
+    try:
+        json = response.json()
+    except ValueError:
+        # Couldn't parse JSON, try next
+        print(f"Could not parse response from tracker {tracker_ip}. Trying next tracker")
+        return None
+
+    if not json.get("success", False):
+        # Error making request, try next
+        print(f"Request to {tracker_ip}, failed, response JSON follows. Trying next tracker")
+        pprint.pprint(json)
+        return None
+
+    return json
+
+
+# Streams a tracker's snapshot into a file next to the database, giving up once deadline has passed
+# Every attempt gets its own file, attempts that run at the same time would otherwise write to the same one
+# Returns the /new_tracker response with the snapshot's path and version added, or None if the download failed
+def _download_snapshot(session, tracker_ip, json, deadline):
+    (handle, snapshot_path) = tempfile.mkstemp(dir=Path(constants.DB_PATH).parent,
+                                               prefix=Path(constants.DB_PATH).name + ".", suffix=".snapshot")
+    os.close(handle)
+
+    version = None
+    try:
+        version = _fetch_snapshot(session, tracker_ip, json["snapshot"], deadline, snapshot_path)
+    finally:
+        # Whatever went wrong, even something unexpected, the file is of no use
+        if version is None:
+            models.remove_snapshot(snapshot_path)
+
+    if version is None:
+        return None
+
+    return dict(json, version=version, snapshot_path=snapshot_path)
+
+
+# Downloads the snapshot at path from tracker_ip into snapshot_path and checks it
+# Returns the snapshot's version, or None if the download failed
+def _fetch_snapshot(session, tracker_ip, path, deadline, snapshot_path):
+    try:
+        with session.get(
+            f"http://{tracker_ip}:{constants.DEFAULT_SERVER_PORT}{path}",
+            stream=True,
+            timeout=sessions.timeout(),
+        ) as response:
+            if response.status_code != requests.codes.ok:
+                print(f"Got bad response code: {response.status_code} for the snapshot from tracker {tracker_ip}")
+                return None
+
+            checksum = response.headers["X-Snapshot-SHA256"]
+            chunks = _until(deadline, response.iter_content(constants.SNAPSHOT_CHUNK_SIZE))
+            if not write_snapshot(chunks, snapshot_path, checksum):
+                if time.monotonic() >= deadline:
+                    print(f"The snapshot from tracker {tracker_ip} did not arrive in time")
+                else:
+                    print(f"The snapshot from tracker {tracker_ip} is incomplete or does not match its checksum")
+                return None
+
+            version = int(response.headers["X-Snapshot-Version"])
+    except (requests.RequestException, zlib.error, KeyError, ValueError) as e:
+        print(f"Error while downloading the snapshot from tracker {tracker_ip}: {e}")
+        return None
+
+    if not models.check_snapshot(snapshot_path):
+        print(f"The snapshot from tracker {tracker_ip} is not an intact database")
+        return None
+
+    return version
+
+
+# Yields the chunks until deadline has passed
+def _until(deadline, chunks):
+    for chunk in chunks:
+        if time.monotonic() >= deadline:
+            return
+        yield chunk
+
+
+# Decompresses the gzip compressed chunks of a snapshot (see models.stream_snapshot) into the file at
+# snapshot_path, one chunk at a time
+# Returns true if the whole snapshot arrived and its SHA-256 matches checksum
+def write_snapshot(chunks, snapshot_path, checksum):
+    decompressor = zlib.decompressobj(wbits=31)  # wbits=31 expects a gzip stream
+    digest = hashlib.sha256()
 
-        if not json["success"]:
-            # Error making request, try next
-            print(f"Request to {tracker_ip}, failed, response JSON follows. Trying next tracker")
-            pprint.pprint(json)
-            continue
+    with open(snapshot_path, "wb") as snapshot_file:
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            snapshot_file.write(data)
+            digest.update(data)
 
-        return (json["data"], tracker_ip)
+        data = decompressor.flush()
+        snapshot_file.write(data)
+        digest.update(data)
 
-    return (None, None)
+    return decompressor.eof and digest.hexdigest() == checksum